@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Memory and GC cost of holding collected samples, per representation.
+
+Parses an if_mib walk of about ``--samples`` samples and keeps every sample
+alive in three forms:
+
+- ``dicts``: a metric dict per sample, then the nested document dict built
+  from it, as the forwarder originally did;
+- ``tuples``: ``(name, labels, value, timestamp)`` with a labels dict per
+  sample, as the collector yielded them before batches;
+- ``columnar``: SampleBatch columns over an interned SeriesTable, as
+  ``PrometheusCollector.iter_batches`` yields them. The table is kept warm
+  from a previous scrape of the same walk, as it is in steady state, and
+  its own size is reported separately since it lives across scrapes.
+
+For each it reports the bytes allocated per 100k samples (tracemalloc),
+the objects the cyclic GC has to track and the time of a full collection
+with the samples alive.
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from common import if_mib_exposition
+from common import load_forwarder
+
+
+def parse_tuples(forwarder, data: bytes) -> list:
+    parser = forwarder.ExpositionParser()
+    timestamp = int(time.time() * 1000)
+    return [(name, labels, value, timestamp) for name, labels, value in parser.feed(data) + parser.close()]
+
+
+def parse_dicts(forwarder, data: bytes) -> list:
+    documents = []
+    for name, labels, value, timestamp in parse_tuples(forwarder, data):
+        metric = {
+            'name': name,
+            'labels': labels,
+            'value': value,
+            'timestamp': timestamp,
+            'target': '192.0.2.1',
+            'tags': {'auth': 'public_v2', 'module': ['if_mib']},
+        }
+        documents.append({
+            '@timestamp': timestamp,
+            'prometheus': {'metric': metric, 'tags': metric['tags']},
+        })
+    return documents
+
+
+def parse_columnar(forwarder, data: bytes, table) -> list:
+    parser = forwarder.ExpositionParser()
+    timestamp = int(time.time() * 1000)
+    batches = []
+    chunk = forwarder.READ_CHUNK_SIZE
+    for start in range(0, len(data), chunk):
+        batch = forwarder.SampleBatch(table, timestamp)
+        parser.parse_into(data[start:start + chunk], batch)
+        batches.append(batch)
+    batch = forwarder.SampleBatch(table, timestamp)
+    parser.parse_into(None, batch)
+    batches.append(batch)
+    return batches
+
+
+def measure(build) -> tuple[int, int, float]:
+    """Bytes allocated by ``build()``, GC-tracked objects it adds and a full collection's time."""
+    gc.collect()
+    gc.disable()
+    try:
+        tracked = len(gc.get_objects())
+        tracemalloc.start()
+        held = build()
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracked = len(gc.get_objects()) - tracked
+        pauses = []
+        for _ in range(5):
+            start = time.perf_counter()
+            gc.collect()
+            pauses.append(time.perf_counter() - start)
+    finally:
+        gc.enable()
+    del held
+    return allocated, tracked, min(pauses)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--samples', type=int, default=100000,
+        help='Approximate samples to hold (default: 100000)',
+    )
+    args = parser.parse_args()
+
+    forwarder = load_forwarder()
+    # 31 if_mib columns per interface.
+    data = if_mib_exposition(max(1, args.samples // 31)).encode('utf-8')
+    samples = len(parse_tuples(forwarder, data))
+    table = forwarder.SeriesTable()
+    tracemalloc.start()
+    parse_columnar(forwarder, data, table)
+    table_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # The table lives as long as the target, whatever representation is used.
+    print(f'{samples} samples held at once; the series table of {len(table)} series holds {table_bytes / 2 ** 20:.1f} MiB')
+    print(f"{'representation':<15} {'MiB/100k':>9} {'bytes/sample':>12} {'GC objects':>11} {'full GC ms':>10}")
+    for name, build in (
+        ('dicts', lambda: parse_dicts(forwarder, data)),
+        ('tuples', lambda: parse_tuples(forwarder, data)),
+        ('columnar', lambda: parse_columnar(forwarder, data, table)),
+    ):
+        allocated, tracked, pause = measure(build)
+        print(
+            f'{name:<15} {allocated / samples * 100000 / 2 ** 20:>9.1f} {allocated / samples:>12.0f} '
+            f'{tracked:>11,} {pause * 1000:>10.2f}',
+        )
+
+
+if __name__ == '__main__':
+    main()
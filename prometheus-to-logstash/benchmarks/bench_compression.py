@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Bytes on the wire and CPU cost of each Content-Encoding and level.
+
+Builds ndjson batches the way the forwarder does, from an if_mib walk
+rendered through DocumentTemplate, then compresses every batch with the
+forwarder's Compressor. Reports the compression ratio, wire bytes per
+document, throughput over the uncompressed body and CPU time per
+document. zstd levels are skipped when zstandard is not installed.
+"""
+from __future__ import annotations
+
+import argparse
+import platform
+import socket
+import time
+
+from common import if_mib_exposition
+from common import load_forwarder
+from prometheus_client.parser import text_string_to_metric_families
+
+GZIP_LEVELS = [1, 3, 6, 9]
+ZSTD_LEVELS = [1, 3, 6, 9, 19]
+
+
+def build_batches(forwarder, ports: int, batch_docs: int) -> list[tuple[bytes, int]]:
+    samples = [
+        (sample.name, sample.labels, sample.value)
+        for family in text_string_to_metric_families(if_mib_exposition(ports))
+        for sample in family.samples
+    ]
+    target = forwarder.Target.parse('192.0.2.1&auth=public_v2&module=if_mib')
+    render = forwarder.DocumentTemplate(
+        socket.gethostname(), platform.node(), target,
+    ).render
+    timestamp = int(time.time() * 1000)
+    documents = [
+        render(name, labels, value, timestamp)
+        for name, labels, value in samples
+    ]
+    fmt = forwarder.BATCH_FORMATS['ndjson']
+    batches = []
+    for start in range(0, len(documents), batch_docs):
+        chunk = documents[start:start + batch_docs]
+        batches.append(
+            (fmt.start + fmt.separator.join(chunk) + fmt.end, len(chunk)),
+        )
+    return batches
+
+
+def measure(compressor, batches: list[tuple[bytes, int]], repeat: int) -> tuple[int, float, float]:
+    """Wire bytes of one pass, and the best wall and CPU seconds over ``repeat`` passes."""
+    wire = sum(len(compressor.compress(body)) for body, _ in batches)
+    best_wall = best_cpu = float('inf')
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        for body, _ in batches:
+            compressor.compress(body)
+        best_wall = min(best_wall, time.perf_counter() - wall)
+        best_cpu = min(best_cpu, time.process_time() - cpu)
+    return wire, best_wall, best_cpu
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--ports', type=int, default=480,
+        help='Interfaces in the if_mib walk (default: 480)',
+    )
+    parser.add_argument(
+        '--batch-docs', type=int, default=500,
+        help='Documents per batch (default: 500)',
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Passes per level, best is reported (default: 5)',
+    )
+    args = parser.parse_args()
+
+    forwarder = load_forwarder()
+    batches = build_batches(forwarder, args.ports, args.batch_docs)
+    raw = sum(len(body) for body, _ in batches)
+    documents = sum(count for _, count in batches)
+
+    variants = [('gzip', level) for level in GZIP_LEVELS]
+    if forwarder.zstandard is not None:
+        variants += [('zstd', level) for level in ZSTD_LEVELS]
+    else:
+        print('zstandard is not installed, skipping zstd')
+
+    print(f'{documents} documents in {len(batches)} batches, {raw / documents:.0f} bytes/doc uncompressed')
+    print(f"{'encoding':<8} {'level':>5} {'ratio':>7} {'bytes/doc':>9} {'MB/s':>8} {'CPU us/doc':>10}")
+    for encoding, level in variants:
+        compressor = forwarder.Compressor(encoding, level)
+        wire, wall, cpu = measure(compressor, batches, args.repeat)
+        print(
+            f'{encoding:<8} {level:>5} {raw / wire:>7.1f} {wire / documents:>9.1f} '
+            f'{raw / wall / 1e6:>8.1f} {cpu / documents * 1e6:>10.2f}',
+        )
+
+
+if __name__ == '__main__':
+    main()
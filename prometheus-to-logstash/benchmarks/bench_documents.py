@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Documents/sec of the per-sample document build, before and after templating.
+
+"before" is the original path: a metric dict per sample with its own
+time.time(), platform.node() and module split, then an ECS dict per sample
+serialised with json.dumps(). "after" renders the same samples through the
+forwarder's DocumentTemplate, once with each installed JSON serializer.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import socket
+import time
+from datetime import datetime
+from datetime import timezone
+
+from common import if_mib_exposition
+from common import load_forwarder
+from prometheus_client.parser import text_string_to_metric_families
+
+
+def before(samples: list, target_info: dict[str, str], hostname: str) -> list[bytes]:
+    documents = []
+    for name, labels, value in samples:
+        metric = {
+            'name': name,
+            'labels': labels,
+            'value': value,
+            'timestamp': int(time.time() * 1000),
+            'target': target_info['host'],
+            'tags': {
+                'auth': target_info['auth'],
+                'module': target_info['module'].split(',') if target_info['module'] else [],
+            },
+        }
+        data = {
+            '@timestamp': datetime.fromtimestamp(metric['timestamp'] / 1000, tz=timezone.utc).isoformat(),
+            'agent': {
+                'hostname': hostname,
+                'name': platform.node(),
+                'type': 'prometheus-to-logstash',
+                'version': '1.0.0',
+            },
+            'event': {
+                'module': 'prometheus',
+                'dataset': 'prometheus.metrics',
+            },
+            'prometheus': {
+                'metric': {
+                    'name': metric['name'],
+                    'labels': metric['labels'],
+                    'value': metric['value'],
+                    'timestamp': metric['timestamp'],
+                    'target': metric['target'],
+                },
+                'tags': metric['tags'],
+            },
+        }
+        document = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        documents.append(document)
+    return documents
+
+
+def after(samples: list, target_info: dict[str, str], hostname: str, forwarder, dumps) -> list[bytes]:
+    render = forwarder.DocumentTemplate(
+        hostname,
+        platform.node(),
+        forwarder.Target(**target_info),
+        dumps=dumps,
+    ).render
+    timestamp = int(time.time() * 1000)
+    return [render(name, labels, value, timestamp) for name, labels, value in samples]
+
+
+def best_of(repeat: int, func, *args) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--ports', type=int, default=480,
+        help='Interfaces in the if_mib walk (default: 480)',
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Runs per variant, best is reported (default: 5)',
+    )
+    args = parser.parse_args()
+
+    forwarder = load_forwarder()
+    samples = [
+        (sample.name, sample.labels, sample.value)
+        for family in text_string_to_metric_families(if_mib_exposition(args.ports))
+        for sample in family.samples
+    ]
+    target_info = {
+        'host': '192.0.2.1',
+        'auth': 'public_v2',
+        'module': 'if_mib',
+    }
+    hostname = socket.gethostname()
+
+    old = before(samples, target_info, hostname)
+    for serializer in forwarder.SERIALIZERS.values():
+        new = after(
+            samples, target_info, hostname,
+            forwarder, serializer.dumps,
+        )
+        # Timestamps differ between the two runs; everything else must match.
+        for a, b in zip(old, new):
+            a, b = json.loads(a), json.loads(b)
+            for doc in (a, b):
+                del doc['@timestamp'], doc['prometheus']['metric']['timestamp']
+            assert a == b, (serializer.name, a, b)
+
+    print(f'{len(samples)} samples, best of {args.repeat}')
+    before_time = best_of(args.repeat, before, samples, target_info, hostname)
+    print(f'before:        {len(samples) / before_time:12,.0f} docs/s')
+    for serializer in forwarder.SERIALIZERS.values():
+        after_time = best_of(
+            args.repeat, after, samples,
+            target_info, hostname, forwarder, serializer.dumps,
+        )
+        print(
+            f'after {serializer.name + ":":8}{len(samples) / after_time:12,.0f} docs/s '
+            f'({before_time / after_time:.1f}x)',
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""End-to-end throughput of the forwarder against local stand-in services.
+
+Starts the fake snmp_exporter and fake Logstash from fake_services.py in
+their own processes, then runs the forwarder in a fresh process per mode,
+scraping every target back to back for ``--duration`` seconds. For each
+mode it reports documents/sec as counted and validated by the sink, the
+p50/p99 delay between a sample being scraped and reaching the sink, the
+forwarder's peak RSS and its CPU time per document.
+
+    python bench_forwarder.py --targets 20 --modules if_mib --rows 48 --latency 0.02
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import socket
+import subprocess
+import sys
+import time
+from typing import Any
+
+import requests
+from common import load_forwarder
+from fake_services import serve_exporter
+from fake_services import serve_sink
+
+# Forwarder configuration per mode, on top of the defaults main() would use.
+MODES = {
+    'batch-ndjson': {'send_mode': 'batch', 'batch_format': 'ndjson'},
+    'batch-json': {'send_mode': 'batch', 'batch_format': 'json'},
+    'single': {'send_mode': 'single'},
+    'serial-scrape': {'concurrency': 1},
+    'delta': {'delta': True},
+    'rates': {'rates': True},
+    'gzip': {'compression': 'gzip'},
+    'parallel-send': {'sender_concurrency': 4},
+    'opensearch': {'output': 'opensearch', 'sender_concurrency': 4},
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def run_worker(spec: dict[str, Any]) -> dict[str, Any]:
+    """Run the forwarder in this process for one mode and report its usage."""
+    logging.basicConfig(level=logging.WARNING)
+    forwarder_module = load_forwarder()
+    config = {
+        'prometheus_url': spec['prometheus_url'],
+        'logstash_url': spec['logstash_url'],
+        # The sink answers the bulk API as well.
+        'opensearch_url': spec['logstash_url'],
+        'targets': spec['targets'],
+        'interval': 60,
+        'timeout': 30,
+        'concurrency': spec['concurrency'],
+        'serializer': spec['serializer'],
+    }
+    config.update(MODES[spec['mode']])
+    forwarder = forwarder_module.PrometheusToLogstash(config)
+    start = time.monotonic()
+    cycles = 0
+    while cycles == 0 or time.monotonic() - start < spec['duration']:
+        forwarder.collect_and_send_prometheus_metrics()
+        cycles += 1
+    elapsed = time.monotonic() - start
+    forwarder.close()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'cycles': cycles,
+        'elapsed': elapsed,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        # Kilobytes on Linux.
+        'max_rss': usage.ru_maxrss * 1024,
+        'stats': forwarder.stats(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--targets', type=int, default=10,
+        help='Number of fake devices (default: 10)',
+    )
+    parser.add_argument(
+        '--modules', default='if_mib',
+        help='Comma-separated snmp-local.yml modules per target',
+    )
+    parser.add_argument(
+        '--rows', type=int, default=48,
+        help='Rows in every table (default: 48)',
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.01,
+        help='Exporter response delay in seconds',
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0.0,
+        help='Extra random exporter delay in seconds',
+    )
+    parser.add_argument(
+        '--exposition', help='Serve this recorded exposition instead of generated ones',
+    )
+    parser.add_argument(
+        '--duration', type=float, default=10.0,
+        help='Seconds to run each mode (default: 10)',
+    )
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--serializer', default='auto')
+    parser.add_argument(
+        '--mode', action='append',
+        choices=sorted(MODES), help='Modes to run (default: all)',
+    )
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(json.loads(args.worker))))
+        return
+
+    exporter_port = free_port()
+    sink_port = free_port()
+    services = [
+        multiprocessing.Process(
+            target=serve_exporter,
+            args=(
+                exporter_port, args.rows, args.latency,
+                args.jitter, 4, args.exposition,
+            ),
+            daemon=True,
+        ),
+        multiprocessing.Process(
+            target=serve_sink, args=(sink_port,), daemon=True,
+        ),
+    ]
+    for service in services:
+        service.start()
+    sink_url = f'http://127.0.0.1:{sink_port}'
+    wait_for(f'http://127.0.0.1:{exporter_port}/')
+    wait_for(f'{sink_url}/stats')
+
+    targets = [
+        f'10.0.{i // 256}.{i % 256}&auth=public_v2&module={args.modules}'
+        for i in range(args.targets)
+    ]
+    # Warm the exporter's cache so rendering walks is not charged to the first mode.
+    for _ in range(4):
+        requests.get(
+            f'http://127.0.0.1:{exporter_port}/snmp'
+            f'?target=warmup&module={args.modules}',
+            timeout=120,
+        )
+
+    print(
+        f'{args.targets} targets x {args.modules} ({args.rows} rows), '
+        f'exporter latency {args.latency}s, {args.duration:g}s per mode',
+    )
+    print(
+        f"{'mode':<14} {'docs':>9} {'docs/s':>9} {'invalid':>7} {'p50 ms':>8} "
+        f"{'p99 ms':>8} {'RSS MiB':>8} {'CPU us/doc':>10}",
+    )
+    try:
+        for mode in args.mode or list(MODES):
+            requests.post(f'{sink_url}/reset', timeout=10)
+            spec = {
+                'mode': mode,
+                'prometheus_url': f'http://127.0.0.1:{exporter_port}',
+                'logstash_url': sink_url,
+                'targets': targets,
+                'concurrency': args.concurrency,
+                'serializer': args.serializer,
+                'duration': args.duration,
+            }
+            output = subprocess.run(
+                [sys.executable, __file__, '--worker', json.dumps(spec)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            sink = requests.get(f'{sink_url}/stats', timeout=10).json()
+            documents = sink['documents']
+            print(
+                f"{mode:<14} {documents:>9} {documents / result['elapsed']:>9.0f} {sink['invalid']:>7} "
+                f"{sink['latency_p50'] * 1000:>8.1f} {sink['latency_p99'] * 1000:>8.1f} "
+                f"{result['max_rss'] / 2 ** 20:>8.1f} {result['cpu'] / max(documents, 1) * 1e6:>10.1f}",
+            )
+    finally:
+        for service in services:
+            service.terminate()
+
+
+if __name__ == '__main__':
+    main()
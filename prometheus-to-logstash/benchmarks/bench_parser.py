@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Compare the speed of ExpositionParser and prometheus_client.
+
+The timing run uses a synthetic if_mib walk, with the columnar path timed
+against a warm table as in steady state. That both parsers agree on every
+file in fixtures/ is checked by test_prometheus_to_logstash.py.
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+from common import if_mib_exposition
+from common import load_forwarder
+from prometheus_client.parser import text_string_to_metric_families
+
+
+def reference(data: bytes) -> list:
+    return [
+        (sample.name, sample.labels, sample.value)
+        for family in text_string_to_metric_families(data.decode('utf-8'))
+        for sample in family.samples
+    ]
+
+
+def streamed(parser_class, data: bytes, chunk_sizes) -> list:
+    parser = parser_class()
+    samples = []
+    position = 0
+    for size in chunk_sizes:
+        if position >= len(data):
+            break
+        samples.extend(parser.feed(data[position:position + size]))
+        position += size
+    if position < len(data):
+        samples.extend(parser.feed(data[position:]))
+    samples.extend(parser.close())
+    return samples
+
+
+def split(data: bytes, chunk_sizes) -> list[bytes]:
+    chunks = []
+    position = 0
+    for size in chunk_sizes:
+        if position >= len(data):
+            break
+        chunks.append(data[position:position + size])
+        position += size
+    if position < len(data):
+        chunks.append(data[position:])
+    return chunks
+
+
+def columnar(forwarder, chunks: list[bytes], table) -> list:
+    """Parse into one SampleBatch per chunk, as PrometheusCollector.iter_batches does."""
+    parser = forwarder.ExpositionParser()
+    batches = []
+    for chunk in chunks + [None]:
+        batch = forwarder.SampleBatch(table, 0)
+        parser.parse_into(chunk, batch)
+        batches.append(batch)
+    return batches
+
+
+def best_of(repeat: int, func, *args) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--ports', type=int, default=480,
+        help='Interfaces in the if_mib walk (default: 480)',
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Runs per parser, best is reported (default: 5)',
+    )
+    args = parser.parse_args()
+
+    forwarder = load_forwarder()
+    data = if_mib_exposition(args.ports).encode('utf-8')
+    chunk = forwarder.READ_CHUNK_SIZE
+    samples = len(reference(data))
+    print(f'{samples} samples, {len(data):,} bytes, best of {args.repeat}')
+    old = best_of(args.repeat, reference, data)
+    new = best_of(
+        args.repeat, streamed, forwarder.ExpositionParser,
+        data, [chunk] * (len(data) // chunk + 1),
+    )
+    chunks = split(data, [chunk] * (len(data) // chunk + 1))
+    table = forwarder.SeriesTable()
+    columnar(forwarder, chunks, table)
+    warm = best_of(args.repeat, columnar, forwarder, chunks, table)
+    print(f'prometheus_client: {samples / old:12,.0f} samples/s')
+    print(
+        f'ExpositionParser:  {samples / new:12,.0f} samples/s ({old / new:.1f}x)',
+    )
+    print(
+        f'columnar, warm:    {samples / warm:12,.0f} samples/s ({old / warm:.1f}x)',
+    )
+
+
+if __name__ == '__main__':
+    main()
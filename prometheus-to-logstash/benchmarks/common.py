@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import importlib.util
+import os
+import sys
+from types import ModuleType
+
+FORWARDER_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'prometheus-to-logstash.py',
+)
+
+# Per-interface series snmp_exporter produces for the if_mib module.
+IF_MIB_COUNTERS = [
+    'ifInOctets',
+    'ifInUcastPkts',
+    'ifInDiscards',
+    'ifInErrors',
+    'ifInUnknownProtos',
+    'ifOutOctets',
+    'ifOutUcastPkts',
+    'ifOutDiscards',
+    'ifOutErrors',
+    'ifInMulticastPkts',
+    'ifInBroadcastPkts',
+    'ifOutMulticastPkts',
+    'ifOutBroadcastPkts',
+    'ifHCInOctets',
+    'ifHCInUcastPkts',
+    'ifHCInMulticastPkts',
+    'ifHCInBroadcastPkts',
+    'ifHCOutOctets',
+    'ifHCOutUcastPkts',
+    'ifHCOutMulticastPkts',
+    'ifHCOutBroadcastPkts',
+]
+IF_MIB_GAUGES = [
+    'ifType',
+    'ifMtu',
+    'ifSpeed',
+    'ifAdminStatus',
+    'ifOperStatus',
+    'ifLastChange',
+    'ifHighSpeed',
+    'ifPromiscuousMode',
+    'ifConnectorPresent',
+    'ifCounterDiscontinuityTime',
+]
+
+
+def load_forwarder() -> ModuleType:
+    """Import prometheus-to-logstash.py, which is not importable by name."""
+    module = sys.modules.get('prometheus_to_logstash')
+    if module is not None:
+        return module
+    spec = importlib.util.spec_from_file_location(
+        'prometheus_to_logstash', FORWARDER_PATH,
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['prometheus_to_logstash'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def if_mib_exposition(ports: int = 48, seed: int = 0) -> str:
+    """Render an if_mib walk of a switch with ``ports`` interfaces."""
+    lines = [
+        '# HELP ifNumber The number of network interfaces - 1.3.6.1.2.1.2.1',
+        '# TYPE ifNumber gauge',
+        f'ifNumber {ports}',
+    ]
+    for position, name in enumerate(IF_MIB_COUNTERS + IF_MIB_GAUGES):
+        kind = 'counter' if name in IF_MIB_COUNTERS else 'gauge'
+        lines.append(f'# HELP {name} {name} - 1.3.6.1.2.1.2.2.1.{position}')
+        lines.append(f'# TYPE {name} {kind}')
+        for port in range(1, ports + 1):
+            value = (port * 7919 + position * 104729 + seed) % 4294967296
+            lines.append(
+                f'{name}{{ifAlias="uplink {port}",ifDescr="GigabitEthernet1/0/{port}",'
+                f'ifIndex="{port}",ifName="Gi1/0/{port}"}} {value}',
+            )
+    lines += [
+        '# HELP sysUpTime The time since the network management portion of the system was last re-initialized. - 1.3.6.1.2.1.1.3',
+        '# TYPE sysUpTime gauge',
+        f'sysUpTime {123456789 + seed}',
+    ]
+    return '\n'.join(lines) + '\n'
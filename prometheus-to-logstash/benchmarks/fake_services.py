@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""Stand-ins for snmp_exporter and Logstash, for benchmarking without a network.
+
+The fake exporter answers ``/snmp?target=...&module=...`` with a synthetic
+walk of the requested modules, generated from the module definitions in
+snmp-local.yml: every table gets ``--rows`` rows, labelled from the module's
+indexes and lookups the way snmp_exporter labels them. A recorded
+exposition can be served instead with ``--exposition``. Counter values move
+between requests so that delta and rate modes have something to do, and
+every response can be delayed to stand in for a slow device.
+
+The fake Logstash accepts the bodies the forwarder sends (single JSON
+documents, JSON arrays and NDJSON, optionally gzip or zstd encoded),
+checks every document has the fields the forwarder always sets and keeps
+the delay between each sample being scraped and its arrival. ``GET /stats``
+returns the counts and latency percentiles; ``POST /reset`` clears them.
+Requests to ``/<data stream>/_bulk`` are answered like the OpenSearch bulk
+API, refusing a ``--reject-rate`` fraction of documents with status 429 so
+that per-document retries are exercised.
+
+Run either one on its own to point a real forwarder at it::
+
+    python fake_services.py exporter --port 9116 --rows 48 --latency 0.05
+    python fake_services.py logstash --port 8080
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from array import array
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SNMP_CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'snmp-local.yml',
+)
+
+# snmp_exporter types rendered as a 1-valued gauge carrying the string as a label.
+STRING_TYPES = {
+    'DisplayString',
+    'OctetString',
+    'PhysAddress48',
+    'InetAddress',
+    'InetAddressIPv4',
+    'InetAddressIPv6',
+    'IpAddr',
+    'DateAndTime',
+}
+
+
+def load_modules(path: str = SNMP_CONFIG_PATH) -> dict[str, dict[str, Any]]:
+    """Module definitions from an snmp_exporter generator output file."""
+    import yaml
+
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path) as f:
+        return yaml.load(f, Loader=loader)['modules']
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _escape_help(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _row_labels(metric: dict[str, Any], row: int) -> dict[str, str]:
+    labels = {}
+    for index in metric.get('indexes', []):
+        labels[index['labelname']] = str(row)
+    for lookup in metric.get('lookups', []):
+        if not lookup.get('labels') and 'oid' not in lookup:
+            # Generator output uses this to drop an index once looked up.
+            labels.pop(lookup['labelname'], None)
+        else:
+            labels[lookup['labelname']] = f"{lookup['labelname']} {row}"
+    return labels
+
+
+def render_module(module: dict[str, Any], rows: int = 48, variant: int = 0, seed: int = 0) -> str:
+    """A synthetic snmp_exporter exposition for one module.
+
+    ``variant`` only changes counter values, so consecutive variants look
+    like consecutive scrapes of the same device.
+    """
+    lines = []
+    for position, metric in enumerate(module.get('metrics', [])):
+        name = metric['name']
+        kind = metric.get('type', 'gauge')
+        table_rows = range(1, rows + 1) if metric.get('indexes') else [None]
+        family = 'counter' if kind == 'counter' else 'gauge'
+        lines.append(f"# HELP {name} {_escape_help(metric.get('help', name))}")
+        lines.append(f'# TYPE {name} {family}')
+        for row in table_rows:
+            labels = _row_labels(metric, row) if row is not None else {}
+            base = ((row or 0) * 7919 + position * 104729 + seed) % 4294967296
+            if kind == 'counter':
+                values = [
+                    (None, str(base + variant * ((row or 1) * 1000 + position))),
+                ]
+            elif kind in STRING_TYPES:
+                values = [(name, f'{name} {row or 0}')]
+            elif kind == 'EnumAsInfo':
+                enum_values = (
+                    list(metric.get('enum_values', {}).values()) or ['unknown']
+                )
+                values = [(name, str(enum_values[base % len(enum_values)]))]
+            elif kind in ('EnumAsStateSet', 'Bits'):
+                states = metric.get('enum_values', {}).values()
+                values = [
+                    (name, str(state))
+                    for state in states
+                ] or [(None, '0')]
+            elif kind in ('Float', 'Double'):
+                values = [(None, repr(base / 100))]
+            else:
+                values = [(None, str(base % 100000))]
+            for extra_label, value in values:
+                row_labels = dict(labels)
+                if kind in STRING_TYPES or kind == 'EnumAsInfo':
+                    row_labels[extra_label] = value
+                    value = '1'
+                elif kind in ('EnumAsStateSet', 'Bits') and extra_label is not None:
+                    row_labels[extra_label] = value
+                    value = '1' if value == values[0][1] else '0'
+                if row_labels:
+                    rendered = ','.join(
+                        f'{key}="{_escape_label(label)}"'
+                        for key, label in row_labels.items()
+                    )
+                    lines.append(f'{name}{{{rendered}}} {value}')
+                else:
+                    lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class ExporterServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        modules: dict[str, dict[str, Any]],
+        rows: int = 48,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        variants: int = 4,
+        exposition: bytes | None = None,
+    ) -> None:
+        super().__init__(address, ExporterHandler)
+        self.modules = modules
+        self.rows = rows
+        self.latency = latency
+        self.jitter = jitter
+        self.variants = variants
+        self.exposition = exposition
+        self.scrapes: dict[tuple[str, str], int] = {}
+        self._cache: dict[tuple[str, int], bytes] = {}
+        self._lock = threading.Lock()
+
+    def body(self, target: str, module_names: str) -> bytes | None:
+        if self.exposition is not None:
+            return self.exposition
+        with self._lock:
+            scrape = self.scrapes.get((target, module_names), 0)
+            self.scrapes[(target, module_names)] = scrape + 1
+        variant = scrape % self.variants
+        key = (module_names, variant)
+        body = self._cache.get(key)
+        if body is None:
+            parts = []
+            for name in module_names.split(','):
+                module = self.modules.get(name)
+                if module is None:
+                    return None
+                parts.append(render_module(module, self.rows, variant))
+            # Rendering is done once per module and variant, not per request,
+            # so the exporter's own CPU use stays out of the measurements.
+            body = self._cache[key] = ''.join(parts).encode()
+        return body
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+    server: ExporterServer
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != '/snmp':
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        target = query.get('target', [''])[0]
+        module = query.get('module', ['if_mib'])[0]
+        body = self.server.body(target, module)
+        if body is None:
+            self.send_error(400, 'Unknown module')
+            return
+        delay = self.server.latency + random.uniform(0, self.server.jitter)
+        if delay:
+            time.sleep(delay)
+        self.send_response(200)
+        self.send_header(
+            'Content-Type', 'text/plain; version=0.0.4; charset=utf-8',
+        )
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+REQUIRED_METRIC_FIELDS = ('name', 'labels', 'value', 'timestamp', 'target')
+
+
+def validate_document(document: Any) -> int | None:
+    """Return the sample timestamp of a well-formed document, else ``None``."""
+    if not isinstance(document, dict) or not isinstance(document.get('@timestamp'), str):
+        return None
+    if not isinstance(document.get('agent'), dict) or not isinstance(document.get('event'), dict):
+        return None
+    metric = document.get('prometheus', {}).get('metric')
+    if not isinstance(metric, dict) or any(field not in metric for field in REQUIRED_METRIC_FIELDS):
+        return None
+    if not isinstance(metric['name'], str) or not isinstance(metric['labels'], dict):
+        return None
+    if not isinstance(metric['value'], (int, float)) or not isinstance(metric['timestamp'], int):
+        return None
+    return metric['timestamp']
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class SinkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], reject_rate: float = 0.0) -> None:
+        super().__init__(address, SinkHandler)
+        self.reject_rate = reject_rate
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.documents = 0
+            self.invalid = 0
+            self.rejected = 0
+            self.bytes = 0
+            self.latencies = array('d')
+            self.first = 0.0
+            self.last = 0.0
+
+    def record(self, size: int, timestamps: list[int | None]) -> None:
+        now = time.time()
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            self.first = self.first or now
+            self.last = now
+            for timestamp in timestamps:
+                if timestamp is None:
+                    self.invalid += 1
+                else:
+                    self.documents += 1
+                    self.latencies.append(now - timestamp / 1000)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            latencies = list(self.latencies)
+            return {
+                'requests': self.requests,
+                'documents': self.documents,
+                'invalid': self.invalid,
+                'rejected': self.rejected,
+                'bytes': self.bytes,
+                'first': self.first,
+                'last': self.last,
+                'latency_p50': percentile(latencies, 0.5),
+                'latency_p99': percentile(latencies, 0.99),
+            }
+
+
+def decode_body(body: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'deflate':
+        return zlib.decompress(body)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd body but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return body
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+    server: SinkServer
+
+    def _reply(self, status: int, payload: dict[str, Any]) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path == '/stats':
+            self._reply(200, self.server.stats())
+        else:
+            self.send_error(404)
+
+    def do_POST(self) -> None:
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/reset':
+            self.server.reset()
+            self._reply(200, {})
+            return
+        bulk = urlsplit(self.path).path.endswith('/_bulk')
+        try:
+            body = decode_body(raw, self.headers.get('Content-Encoding', ''))
+            if bulk:
+                lines = body.splitlines()
+                if any(json.loads(action) != {'create': {}} for action in lines[0::2]):
+                    raise ValueError('bulk action other than create')
+                documents = [json.loads(line) for line in lines[1::2]]
+            elif self.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+                documents = [
+                    json.loads(line)
+                    for line in body.splitlines() if line.strip()
+                ]
+            else:
+                documents = json.loads(body)
+                if not isinstance(documents, list):
+                    documents = [documents]
+        except ValueError:
+            self.server.record(len(raw), [None])
+            self._reply(400, {'error': 'unparseable body'})
+            return
+        if not bulk:
+            self.server.record(
+                len(raw),
+                [validate_document(document) for document in documents],
+            )
+            self._reply(200, {})
+            return
+        accepted = []
+        items = []
+        for document in documents:
+            if random.random() < self.server.reject_rate:
+                error = {'type': 'es_rejected_execution_exception'}
+                items.append({'create': {'status': 429, 'error': error}})
+                continue
+            timestamp = validate_document(document)
+            accepted.append(timestamp)
+            if timestamp is None:
+                error = {'type': 'document_parsing_exception'}
+                items.append({'create': {'status': 400, 'error': error}})
+            else:
+                items.append({'create': {'status': 201}})
+        with self.server._lock:
+            self.server.rejected += len(documents) - len(accepted)
+        self.server.record(len(raw), accepted)
+        errors = len(accepted) != len(documents) or None in accepted
+        self._reply(200, {'errors': errors, 'items': items})
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def serve_exporter(
+    port: int,
+    rows: int = 48,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    variants: int = 4,
+    exposition_path: str | None = None,
+    modules_path: str = SNMP_CONFIG_PATH,
+) -> None:
+    exposition = None
+    modules: dict[str, dict[str, Any]] = {}
+    if exposition_path:
+        with open(exposition_path, 'rb') as f:
+            exposition = f.read()
+    else:
+        modules = load_modules(modules_path)
+    ExporterServer(
+        ('127.0.0.1', port), modules, rows, latency,
+        jitter, variants, exposition,
+    ).serve_forever()
+
+
+def serve_sink(port: int, reject_rate: float = 0.0) -> None:
+    SinkServer(('127.0.0.1', port), reject_rate).serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    exporter = commands.add_parser(
+        'exporter', help='Serve synthetic snmp_exporter walks',
+    )
+    exporter.add_argument('--port', type=int, default=9116)
+    exporter.add_argument(
+        '--rows', type=int, default=48,
+        help='Rows in every table (default: 48)',
+    )
+    exporter.add_argument(
+        '--latency', type=float, default=0.0,
+        help='Seconds to delay every response',
+    )
+    exporter.add_argument(
+        '--jitter', type=float, default=0.0,
+        help='Up to this many extra seconds of delay',
+    )
+    exporter.add_argument(
+        '--variants', type=int, default=4,
+        help='Distinct walks to cycle through per target',
+    )
+    exporter.add_argument(
+        '--exposition', help='Serve this recorded exposition for every request',
+    )
+    exporter.add_argument('--modules-file', default=SNMP_CONFIG_PATH)
+    sink = commands.add_parser(
+        'logstash', help='Accept and validate forwarder documents',
+    )
+    sink.add_argument('--port', type=int, default=8080)
+    sink.add_argument(
+        '--reject-rate', type=float, default=0.0,
+        help='Fraction of bulk documents refused with 429',
+    )
+    args = parser.parse_args()
+
+    if args.command == 'exporter':
+        serve_exporter(
+            args.port,
+            rows=args.rows,
+            latency=args.latency,
+            jitter=args.jitter,
+            variants=args.variants,
+            exposition_path=args.exposition,
+            modules_path=args.modules_file,
+        )
+    else:
+        serve_sink(args.port, args.reject_rate)
+
+
+if __name__ == '__main__':
+    main()
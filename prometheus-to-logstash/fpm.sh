@@ -17,6 +17,7 @@ fpm \
   --depends python3-tenacity \
   --depends python3-urllib3 \
   --depends python3-prometheus-client \
+  --depends python3-yaml \
   --force \
   --maintainer "Matthew Hollick <matthew@hedgehoganalytics.uk>" \
   --name prometheus-to-logstash \
@@ -2,194 +2,3688 @@
 from __future__ import annotations
 
 import argparse
+import bisect
+import cProfile
+import hashlib
+import heapq
 import json
 import logging
+import math
+import mmap
+import multiprocessing
+import os
 import platform
+import pstats
+import queue
+import random
+import re
 import signal
 import socket
+import struct
 import sys
+import threading
 import time
+import zlib
+from array import array
+from collections.abc import Iterator
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timezone
 from typing import Any
+from typing import BinaryIO
+from typing import Callable
 from typing import Dict
+from typing import NamedTuple
 from typing import NoReturn
 from typing import Optional
 
 import requests
-from prometheus_client.parser import text_string_to_metric_families
+from prometheus_client import CollectorRegistry
+from prometheus_client import Histogram
+from prometheus_client import start_http_server
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.core import GaugeMetricFamily
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 session = requests.Session()
 
 
-def setup_logging(log_level: str = 'INFO') -> None:
-    numeric_level = getattr(logging, log_level.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError(f'Invalid log level: {log_level}')
+def setup_logging(log_level: str = 'INFO') -> None:
+    numeric_level = getattr(logging, log_level.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError(f'Invalid log level: {log_level}')
+
+    logging.basicConfig(
+        level=numeric_level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    )
+
+
+_ESCAPES = {'\\\\': '\\', '\\n': '\n', '\\"': '"'}
+_ESCAPE_RE = re.compile(r'\\[\\n"]')
+
+# Sample name suffixes that stay in a family of the given type; anything
+# else starts a new untyped family, as in prometheus_client.
+_TYPE_SUFFIXES = {
+    'summary': ('_count', '_sum', ''),
+    'histogram': ('_count', '_sum', '_bucket'),
+}
+
+
+def _unescape(value: str) -> str:
+    return _ESCAPE_RE.sub(lambda match: _ESCAPES[match.group(0)], value)
+
+
+def _is_escaped(text: str, position: int) -> bool:
+    backslashes = 0
+    while position > backslashes and text[position - 1 - backslashes] == '\\':
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+def _parse_labels(text: str) -> dict[str, str]:
+    labels: dict[str, str] = {}
+    if '=' not in text:
+        return labels
+    escaped = '\\' in text
+    end_of_text = len(text.rstrip())
+    position = 0
+    try:
+        while position < end_of_text:
+            equals = text.index('=', position)
+            start = text.index('"', equals + 1) + 1
+            end = text.index('"', start)
+            if escaped:
+                while _is_escaped(text, end):
+                    end = text.index('"', end + 1)
+                value = _unescape(text[start:end])
+            else:
+                value = text[start:end]
+            labels[sys.intern(text[position:equals].strip())] = value
+            comma = text.find(',', end + 1)
+            position = end + 1 if comma < 0 else comma + 1
+    except ValueError:
+        raise ValueError(f'Invalid labels: {text}')
+    return labels
+
+
+class ExpositionParser:
+    """Incremental parser for the Prometheus text exposition format.
+
+    Raw bytes are fed in as they arrive and complete lines are turned
+    straight into ``(name, labels, value)`` tuples without building metric
+    family objects. Metric names and label keys are interned, and the names
+    of counter samples are collected in ``counters``. Sample names
+    and values match ``prometheus_client.parser.text_string_to_metric_families``,
+    including its renaming of counter samples to ``<name>_total``.
+
+    With ``keep``, lines whose metric name (as exposed, before any
+    ``_total`` renaming) it rejects are skipped before their labels are
+    parsed and counted in ``skipped``.
+
+    ``parse_into`` appends to a columnar ``SampleBatch`` instead, looking
+    every series up in the batch's ``SeriesTable`` by its raw label text,
+    so labels are only parsed the first time a series is seen. Series the
+    table's filter rejects are counted in ``skipped`` as well.
+    """
+
+    def __init__(
+        self,
+        counters: set[str] | None = None,
+        keep: Callable[[str], bool] | None = None,
+    ) -> None:
+        # Names of samples seen in counter families are added here.
+        self.counters = counters if counters is not None else set()
+        self.keep = keep
+        self.skipped = 0
+        self._pending = b''
+        self._family = ''
+        self._type = 'untyped'
+        self._allowed: frozenset[str] = frozenset()
+        self._counter_names: dict[str, str] = {}
+
+    def _complete_lines(self, data: bytes) -> list[str]:
+        end = data.rfind(b'\n')
+        if end < 0:
+            self._pending += data
+            return []
+        text = (self._pending + data[:end]).decode('utf-8', 'replace')
+        self._pending = data[end + 1:]
+        return text.split('\n')
+
+    def _last_line(self) -> list[str]:
+        text = self._pending.decode('utf-8', 'replace')
+        self._pending = b''
+        return [text]
+
+    def feed(self, data: bytes) -> list[tuple[str, dict[str, str], float]]:
+        """Parse every complete line in ``data`` plus any earlier partial line."""
+        return self._parse_lines(self._complete_lines(data))
+
+    def close(self) -> list[tuple[str, dict[str, str], float]]:
+        """Parse a final line that was not terminated by a newline."""
+        return self._parse_lines(self._last_line())
+
+    def parse_into(self, data: bytes | None, batch: SampleBatch) -> None:
+        """Like ``feed``, or ``close`` when ``data`` is None, but appending to ``batch``."""
+        lines = (
+            self._complete_lines(data) if data is not None
+            else self._last_line()
+        )
+        self._parse_lines(lines, batch)
+
+    def _comment(self, line: str) -> None:
+        parts = line.split(None, 3)
+        if len(parts) < 2:
+            return
+        if parts[1] == 'HELP':
+            if parts[2] != self._family:
+                self._family = parts[2]
+                self._type = 'untyped'
+                self._allowed = frozenset((self._family,))
+        elif parts[1] == 'TYPE':
+            self._family = parts[2]
+            self._type = parts[3]
+            self._allowed = frozenset(
+                self._family + suffix
+                for suffix in _TYPE_SUFFIXES.get(self._type, ('',))
+            )
+
+    def _parse_lines(
+        self,
+        lines: list[str],
+        batch: SampleBatch | None = None,
+    ) -> list[tuple[str, dict[str, str], float]]:
+        samples = []
+        append = samples.append
+        intern = sys.intern
+        if batch is not None:
+            table = batch.table
+            series_ids = table.ids
+            append_id = batch.ids.append
+            append_value = batch.values.append
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == '#':
+                self._comment(line)
+                continue
+
+            open_brace = line.find('{')
+            close_brace = line.rfind('}')
+            if open_brace >= 0 and close_brace >= 0:
+                name = line[:open_brace].strip()
+                fields = line[close_brace + 1:].split(None, 1)
+            else:
+                fields = line.split(None, 2)
+                name = fields.pop(0)
+                open_brace = -1
+            if not fields:
+                raise ValueError(f'Missing value: {line}')
+            value = float(fields[0])
+            exposed = name
+
+            if name in self._allowed:
+                if self._type != 'counter':
+                    name = intern(name)
+                elif self._family.endswith('_total'):
+                    name = intern(name)
+                    self.counters.add(name)
+                else:
+                    renamed = self._counter_names.get(name)
+                    if renamed is None:
+                        renamed = self._counter_names[name] = intern(
+                            name + '_total',
+                        )
+                        self.counters.add(renamed)
+                    name = renamed
+            else:
+                # prometheus_client turns a sample outside the current family
+                # into an untyped family of its own and forgets the current one.
+                self._family = ''
+                self._type = 'untyped'
+                self._allowed = frozenset()
+                name = intern(name)
+
+            if self.keep is not None and not self.keep(exposed):
+                self.skipped += 1
+                continue
+            if batch is not None:
+                key = (
+                    name,
+                    line[open_brace + 1:close_brace] if open_brace >= 0 else '',
+                )
+                series_id = series_ids.get(key)
+                if series_id is None:
+                    series_id = table.add(key, _parse_labels(key[1]))
+                if series_id < 0:
+                    self.skipped += 1
+                    continue
+                append_id(series_id)
+                append_value(value)
+                continue
+            labels = (
+                _parse_labels(line[open_brace + 1:close_brace])
+                if open_brace >= 0 else {}
+            )
+            append((name, labels, value))
+        return samples
+
+
+class SeriesTable:
+    """Interned series of one target: name, labels and their encodings, by id.
+
+    Series are keyed by name and raw label text as exposed, and parsed,
+    filtered and projected once; series rejected by ``series_filter`` get
+    the id -1. The JSON fragment a document template renders for a series
+    and the key it has in the SeriesIndex are cached here too.
+    """
+
+    def __init__(self, series_filter: SeriesFilter | None = None):
+        self.series_filter = series_filter
+        self.ids: dict[tuple[str, str], int] = {}
+        self.names: list[str] = []
+        self.labels: list[dict[str, str]] = []
+        self.index_keys: list[tuple | None] = []
+        self.fragments: list[bytes | None] = []
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, key: tuple[str, str], labels: dict[str, str]) -> int:
+        series_filter = self.series_filter
+        if series_filter is not None:
+            if not series_filter.keep_labels(labels):
+                self.ids[key] = -1
+                return -1
+            if series_filter.projects:
+                labels = series_filter.project(labels)
+        series_id = self.ids[key] = len(self.names)
+        self.names.append(key[0])
+        self.labels.append(labels)
+        self.index_keys.append(None)
+        self.fragments.append(None)
+        return series_id
+
+    def index_key(self, series_id: int) -> tuple:
+        key = self.index_keys[series_id]
+        if key is None:
+            key = self.index_keys[series_id] = (
+                self.names[series_id], tuple(self.labels[series_id].items()),
+            )
+        return key
+
+    def prune(self, live: int) -> None:
+        """Forget every series once far more are interned than a scrape returns.
+
+        Interfaces and sensors come and go; starting over is cheaper than
+        tracking which series are stale, and costs one full parse.
+        """
+        if len(self.ids) > 2 * live + 1024:
+            self.__init__(self.series_filter)
+
+
+class SampleBatch:
+    """Samples of one read of a scrape, as columns.
+
+    ``ids`` index the target's SeriesTable and ``values`` hold the matching
+    values; every sample of a scrape shares ``timestamp``.
+    """
+
+    __slots__ = ('table', 'timestamp', 'ids', 'values')
+
+    def __init__(self, table: SeriesTable, timestamp: int):
+        self.table = table
+        self.timestamp = timestamp
+        self.ids = array('i')
+        self.values = array('d')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        names = self.table.names
+        labels = self.table.labels
+        for series_id, value in zip(self.ids, self.values):
+            yield names[series_id], labels[series_id], value
+
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def _parse_seconds(value: Any) -> float:
+    """Seconds from a number or a Prometheus-style duration such as ``30s`` or ``5m``."""
+    if isinstance(value, str) and value[-1:] in _DURATION_UNITS:
+        seconds = float(value[:-1]) * _DURATION_UNITS[value[-1]]
+    else:
+        seconds = float(value)
+    if not seconds > 0:
+        raise ValueError(
+            f'interval must be a positive duration, got {value!r}',
+        )
+    return seconds
+
+
+class Target(NamedTuple):
+    """A scrape target, parsed once when it is added."""
+
+    host: str
+    auth: str = ''
+    module: str = ''
+    interval: float | None = None
+    # Extra labels from a targets file, added to every document's tags.
+    labels: tuple[tuple[str, str], ...] = ()
+
+    @classmethod
+    def parse(cls, target: str) -> Target:
+        """Parse the ``host&auth=..&module=..[&interval=..]`` command line spelling."""
+        parts = target.split('&')
+        # The IP/hostname is always the first part
+        fields: dict[str, Any] = {'host': parts[0]}
+        for part in parts[1:]:
+            if '=' in part:
+                key, value = part.split('=', 1)
+                if key == 'interval':
+                    fields[key] = _parse_seconds(value)
+                elif key in ('auth', 'module'):
+                    fields[key] = value
+        return cls(**fields)
+
+    @property
+    def modules(self) -> list[str]:
+        return self.module.split(',') if self.module else []
+
+
+def _load_config_file(path: str) -> Any:
+    """Read a JSON file, or a YAML one if its name ends in .yml or .yaml."""
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            if yaml is None:
+                raise ValueError(f'PyYAML is needed to read {path}')
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def load_targets_file(path: str) -> dict[str, Target]:
+    """Read a file_sd-style targets file, keyed by the target's command line spelling.
+
+    The file holds a list of groups, each with ``targets`` (hosts) and
+    optional ``labels``. The ``auth``, ``module`` and ``interval`` labels
+    (or ``__param_auth``, ``__param_module`` and ``__scrape_interval__``)
+    configure the scrape; any other label is added to the documents' tags.
+    Files ending in .yml or .yaml are read as YAML, anything else as JSON.
+    """
+    groups = _load_config_file(path) or []
+    if not isinstance(groups, list):
+        raise ValueError(f'{path} must contain a list of target groups')
+
+    targets = {}
+    for group in groups:
+        labels = {
+            str(key): str(value)
+            for key, value in (group.get('labels') or {}).items()
+        }
+        auth = labels.pop('auth', '') or labels.pop('__param_auth', '')
+        module = labels.pop('module', '') or labels.pop('__param_module', '')
+        interval = (
+            labels.pop('interval', '')
+            or labels.pop('__scrape_interval__', '')
+        )
+        for key in [key for key in labels if key.startswith('__')]:
+            del labels[key]
+        for host in group.get('targets', []):
+            target = Target(
+                host=str(host),
+                auth=auth,
+                module=module,
+                interval=_parse_seconds(interval) if interval else None,
+                labels=tuple(sorted(labels.items())),
+            )
+            key = '&'.join(
+                [target.host] + [
+                    f'{name}={value}'
+                    for name, value in (('auth', auth), ('module', module))
+                    if value
+                ],
+            )
+            targets[key] = target
+    return targets
+
+
+def _alternation(patterns: list[str]) -> re.Pattern | None:
+    """One regex matching any of ``patterns``, or ``None`` when there are none."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+
+class SeriesFilter:
+    """Allow/deny rules and label projection for one target, compiled once.
+
+    Metric names are matched in full against a single alternation of the
+    allow patterns and one of the deny patterns, and the verdict is cached
+    per name, so the exposition parser can skip rejected lines before
+    parsing their labels. Label matchers (``match``) must all match and
+    none of the ``exclude`` ones may. Label projection works out which
+    labels to keep and what to call them once per set of label names.
+    """
+
+    __slots__ = (
+        '_allow',
+        '_deny',
+        '_names',
+        'matchers',
+        'excluders',
+        '_drop',
+        '_rename',
+        '_plans',
+        'projects',
+    )
+
+    def __init__(
+        self,
+        allow: list[str] | None = None,
+        deny: list[str] | None = None,
+        match: dict[str, list[str]] | None = None,
+        exclude: dict[str, list[str]] | None = None,
+        drop_labels: list[str] | None = None,
+        rename_labels: dict[str, str] | None = None,
+    ):
+        self._allow = _alternation(allow or [])
+        self._deny = _alternation(deny or [])
+        self._names: dict[str, bool] = {}
+        self.matchers = [
+            (label, _alternation(patterns))
+            for label, patterns in (match or {}).items()
+        ]
+        self.excluders = [
+            (label, _alternation(patterns))
+            for label, patterns in (exclude or {}).items()
+        ]
+        self._drop = frozenset(drop_labels or ())
+        self._rename = dict(rename_labels or {})
+        self._plans: dict[tuple[str, ...], tuple[tuple[str, str], ...]] = {}
+        self.projects = bool(self._drop or self._rename)
+
+    def keep_name(self, name: str) -> bool:
+        kept = self._names.get(name)
+        if kept is None:
+            kept = self._names[name] = (
+                (self._allow is None or self._allow.fullmatch(name) is not None)
+                and (self._deny is None or self._deny.fullmatch(name) is None)
+            )
+        return kept
+
+    def keep_labels(self, labels: dict[str, str]) -> bool:
+        for label, pattern in self.matchers:
+            if pattern.fullmatch(labels.get(label, '')) is None:
+                return False
+        for label, pattern in self.excluders:
+            if pattern.fullmatch(labels.get(label, '')) is not None:
+                return False
+        return True
+
+    def project(self, labels: dict[str, str]) -> dict[str, str]:
+        keys = tuple(labels)
+        plan = self._plans.get(keys)
+        if plan is None:
+            plan = self._plans[keys] = tuple(
+                (key, self._rename.get(key, key)) for key in keys if key not in self._drop
+            )
+        return {new: labels[old] for old, new in plan}
+
+
+# Keys of a module's rules in a filter file.
+FILTER_KEYS = (
+    'allow', 'deny', 'match', 'exclude',
+    'drop_labels', 'rename_labels',
+)
+
+
+class FilterRules:
+    """Per-module series filters from ``--filter-file``.
+
+    The file maps snmp_exporter module names, or ``*`` for every module, to
+    rules::
+
+        if_mib:
+          allow: ['if(HC)?(In|Out)Octets', 'ifOperStatus', 'sysUpTime']
+          deny: ['ifHCIn.*Pkts']
+          match: {ifType: ['ethernetCsmacd', 'ieee8023adLag']}
+          exclude: {ifAdminStatus: ['2']}
+          drop_labels: [ifName]
+          rename_labels: {ifDescr: interface}
+
+    Names are matched as snmp_exporter exposes them, before counters get
+    their ``_total`` suffix. A target scraping several modules keeps a
+    series if any of its modules' allow lists (together with ``*``'s)
+    accepts it, or if one of its modules has no allow list at all; deny
+    rules, label matchers and label projection of all its modules and
+    ``*`` apply together.
+    """
+
+    def __init__(self, rules: dict[str, dict[str, Any]]):
+        for module, rule in rules.items():
+            if not isinstance(rule, dict):
+                raise ValueError(
+                    f'rules for module {module!r} must be a mapping',
+                )
+            unknown = set(rule) - set(FILTER_KEYS)
+            if unknown:
+                raise ValueError(
+                    f"unknown keys for module {module!r}: {', '.join(sorted(unknown))}",
+                )
+        self.rules = rules
+        self._filters: dict[str, SeriesFilter | None] = {}
+        # Compile everything up front so that a bad pattern fails at startup.
+        for module in rules:
+            if module != '*':
+                self.for_module(module)
+
+    def for_module(self, module: str) -> SeriesFilter | None:
+        """The filter for a target's ``module`` parameter, or ``None`` to keep everything."""
+        if module in self._filters:
+            return self._filters[module]
+        star = self.rules.get('*', {})
+        applicable = [star] + [
+            self.rules.get(name, {})
+            for name in module.split(',') if name
+        ]
+        if not any(applicable):
+            series_filter = None
+        else:
+            allow: list[str] | None = []
+            for name in module.split(',') or ['']:
+                patterns = (
+                    list(self.rules.get(name, {}).get('allow', []))
+                    + list(star.get('allow', []))
+                )
+                if not patterns:
+                    allow = None
+                    break
+                allow += patterns
+            match: dict[str, list[str]] = {}
+            exclude: dict[str, list[str]] = {}
+            rename: dict[str, str] = {}
+            for rule in applicable:
+                for label, patterns in rule.get('match', {}).items():
+                    match.setdefault(label, []).extend(
+                        [patterns] if isinstance(patterns, str) else patterns,
+                    )
+                for label, patterns in rule.get('exclude', {}).items():
+                    exclude.setdefault(label, []).extend(
+                        [patterns] if isinstance(patterns, str) else patterns,
+                    )
+                rename.update(rule.get('rename_labels', {}))
+            try:
+                series_filter = SeriesFilter(
+                    allow=allow,
+                    deny=[
+                        pattern
+                        for rule in applicable
+                        for pattern in rule.get('deny', [])
+                    ],
+                    match=match,
+                    exclude=exclude,
+                    drop_labels=[
+                        label
+                        for rule in applicable
+                        for label in rule.get('drop_labels', [])
+                    ],
+                    rename_labels=rename,
+                )
+            except re.error as e:
+                raise ValueError(
+                    f'invalid pattern in rules for {module!r}: {str(e)}',
+                )
+        self._filters[module] = series_filter
+        return series_filter
+
+
+def load_filter_file(path: str) -> FilterRules:
+    rules = _load_config_file(path) or {}
+    if not isinstance(rules, dict):
+        raise ValueError(f'{path} must map module names to rules')
+    return FilterRules(rules)
+
+
+# Response times kept per target for its adaptive timeout, and how many are
+# needed before the timeout adapts at all.
+LATENCY_WINDOW = 64
+MIN_LATENCY_SAMPLES = 8
+
+
+class TargetStats:
+    """Latency and failure bookkeeping for a single scrape target."""
+
+    __slots__ = (
+        'scrapes',
+        'failures',
+        'consecutive_failures',
+        'last_latency',
+        'last_parse_time',
+        'last_slot_wait',
+        'last_samples',
+        'last_filtered',
+        'last_error',
+        'response_times',
+        'response_time_next',
+        'breaker_open_until',
+        'breaker_trips',
+        'breaker_skips',
+    )
+
+    def __init__(self) -> None:
+        self.scrapes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_latency = 0.0
+        self.last_parse_time = 0.0
+        self.last_slot_wait = 0.0
+        self.last_samples = 0
+        self.last_filtered = 0
+        self.last_error = ''
+        # Ring of the latest seconds until snmp_exporter answered, which is
+        # what the request timeout bounds: the walk happens before it replies.
+        self.response_times = array('d')
+        self.response_time_next = 0
+        self.breaker_open_until = 0.0
+        self.breaker_trips = 0
+        self.breaker_skips = 0
+
+    def p99_response_time(self) -> float | None:
+        """99th percentile of the recent response times, or None with too few of them."""
+        if len(self.response_times) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.response_times)
+        return ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+
+    def record_success(
+        self,
+        latency: float,
+        samples: int,
+        parse_time: float = 0.0,
+        slot_wait: float = 0.0,
+        filtered: int = 0,
+        response_time: float | None = None,
+    ) -> None:
+        self.scrapes += 1
+        self.consecutive_failures = 0
+        if response_time is not None:
+            if len(self.response_times) < LATENCY_WINDOW:
+                self.response_times.append(response_time)
+            else:
+                self.response_times[self.response_time_next] = response_time
+            self.response_time_next += 1
+            self.response_time_next %= LATENCY_WINDOW
+        self.last_latency = latency
+        self.last_parse_time = parse_time
+        self.last_slot_wait = slot_wait
+        self.last_samples = samples
+        self.last_filtered = filtered
+        self.last_error = ''
+
+    def record_failure(
+        self,
+        latency: float,
+        error: Exception,
+        parse_time: float = 0.0,
+        slot_wait: float = 0.0,
+    ) -> None:
+        self.scrapes += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_latency = latency
+        self.last_parse_time = parse_time
+        self.last_slot_wait = slot_wait
+        self.last_samples = 0
+        self.last_filtered = 0
+        self.last_error = str(error)
+
+
+# Bytes read from snmp_exporter per call while streaming an exposition.
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class PrometheusCollector:
+    """Scrape targets through snmp_exporter.
+
+    Each target's timeout adapts to ``timeout_factor`` times the p99 of its
+    recent response times, between ``min_timeout`` and ``timeout``, so a
+    device that stops answering is given up on long before ``timeout`` when
+    it normally answers quickly. After ``breaker_failures`` failures in a
+    row a target's circuit opens: it is not scraped for ``breaker_backoff``
+    seconds, doubling after every failed probe up to
+    ``breaker_max_backoff``, so dead devices stop holding scrape workers.
+    A factor or failure count of 0 disables the respective mechanism.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        targets: list[str],
+        timeout: int = 10,
+        concurrency: int = 8,
+        per_host_concurrency: int = 1,
+        filters: FilterRules | None = None,
+        timeout_factor: float = 3.0,
+        min_timeout: float = 1.0,
+        breaker_failures: int = 5,
+        breaker_backoff: float = 60.0,
+        breaker_max_backoff: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.base_url = url
+        self.filters = filters
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.breaker_failures = breaker_failures
+        self.breaker_backoff = breaker_backoff
+        self.breaker_max_backoff = breaker_max_backoff
+        self.clock = clock
+        # Replaced rather than modified when targets change, so that it can
+        # be iterated while a targets file is being reloaded.
+        self.targets = list(targets)
+        self.target_info: dict[str, Target] = {}
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.logger = logging.getLogger(__name__)
+        self.target_stats: dict[str, TargetStats] = {}
+        self.series_tables: dict[str, SeriesTable] = {}
+        # Names of every counter sample seen, whatever the target.
+        self.counter_names: set[str] = set()
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix='scrape',
+        )
+        self._host_slots: dict[str, threading.Semaphore] = {}
+        self._host_slots_lock = threading.Lock()
+        # One pooled connection per scrape worker, otherwise urllib3 discards
+        # connections once more than its default ten are in flight.
+        session.mount(self.base_url, HTTPAdapter(pool_maxsize=concurrency))
+
+    def parse_target(self, target: str) -> Target:
+        """Return the parsed form of a target, parsing it only the first time."""
+        info = self.target_info.get(target)
+        if info is None:
+            info = self.target_info[target] = Target.parse(target)
+        return info
+
+    def add_target(self, target: str, info: Target | None = None) -> None:
+        if info is not None:
+            self.target_info[target] = info
+        if target not in self.targets:
+            self.targets = self.targets + [target]
+
+    def remove_target(self, target: str) -> None:
+        """Stop scraping a target; its parsed form and stats stay until forget_target()."""
+        self.targets = [
+            existing for existing in self.targets if existing != target
+        ]
+
+    def forget_target(self, target: str) -> None:
+        self.target_info.pop(target, None)
+        self.target_stats.pop(target, None)
+        self.series_tables.pop(target, None)
+
+    def timeout_for(self, stats: TargetStats) -> float:
+        """Request timeout for the next scrape of a target."""
+        # The full timeout after a failure, in case the device just got slower.
+        if not self.timeout_factor or stats.consecutive_failures:
+            return self.timeout
+        p99 = stats.p99_response_time()
+        if p99 is None:
+            return self.timeout
+        return min(self.timeout, max(self.min_timeout, p99 * self.timeout_factor))
+
+    def allow(self, target: str) -> bool:
+        """Return False while a target's circuit is open; once it is due, let a probe through."""
+        stats = self.target_stats.get(target)
+        if stats is None or not stats.breaker_open_until:
+            return True
+        if self.clock() < stats.breaker_open_until:
+            stats.breaker_skips += 1
+            return False
+        return True
+
+    def breakers_open(self) -> int:
+        return sum(1 for stats in list(self.target_stats.values()) if stats.breaker_open_until)
+
+    def breaker_skips(self) -> int:
+        return sum(stats.breaker_skips for stats in list(self.target_stats.values()))
+
+    def _record_failure(
+        self,
+        target: str,
+        stats: TargetStats,
+        latency: float,
+        error: Exception,
+        parse_time: float = 0.0,
+        slot_wait: float = 0.0,
+    ) -> None:
+        stats.record_failure(latency, error, parse_time, slot_wait)
+        if not self.breaker_failures or stats.consecutive_failures < self.breaker_failures:
+            return
+        backoff = min(
+            self.breaker_backoff * 2 ** stats.breaker_trips,
+            self.breaker_max_backoff,
+        )
+        stats.breaker_trips += 1
+        stats.breaker_open_until = self.clock() + backoff
+        if stats.breaker_trips == 1:
+            self.logger.warning(
+                f'{target} failed {stats.consecutive_failures} times in a row, '
+                f'pausing its scrapes for {backoff:g}s before probing it',
+            )
+        else:
+            self.logger.info(
+                f'Probe of {target} failed, next one in {backoff:g}s',
+            )
+
+    def _close_breaker(self, target: str, stats: TargetStats) -> None:
+        if stats.breaker_open_until:
+            self.logger.info(f'{target} answered again, resuming its scrapes')
+            stats.breaker_open_until = 0.0
+            stats.breaker_trips = 0
+
+    def _host_slot(self, host: str) -> threading.Semaphore:
+        with self._host_slots_lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.Semaphore(
+                    self.per_host_concurrency,
+                )
+            return slot
+
+    def iter_batches(
+        self,
+        target: str,
+        trace: ScrapeTrace | None = None,
+    ) -> Iterator[SampleBatch]:
+        """Scrape a single target, yielding a SampleBatch per read of the exposition.
+
+        Every sample of a scrape carries the same millisecond timestamp, taken
+        once the exposition has been fetched. The latency recorded for the
+        target covers fetching the exposition, not the time the caller spends
+        consuming the samples; time spent parsing it is recorded separately.
+        With a ``trace``, the wall and CPU time of every read and parse is
+        recorded in it as well. Samples rejected by the target's filter
+        rules are dropped here, before any document is built for them.
+        A batch is only valid until the next one is requested.
+        """
+        stats = self.target_stats.setdefault(target, TargetStats())
+        target_info = self.parse_target(target)
+        table = self.series_tables.get(target)
+        if table is None:
+            series_filter = (
+                self.filters.for_module(target_info.module)
+                if self.filters is not None else None
+            )
+            table = self.series_tables[target] = SeriesTable(series_filter)
+        else:
+            table.prune(stats.last_samples + stats.last_filtered)
+        series_filter = table.series_filter
+        requested = time.monotonic()
+        with self._host_slot(target_info.host):
+            # Latency is measured once the host slot is held so that waiting
+            # behind another module on the same device is not charged here.
+            start = time.monotonic()
+            slot_wait = start - requested
+            latency = 0.0
+            parse_time = 0.0
+            count = 0
+            filtered = 0
+            if trace is not None:
+                trace.add('slot_wait', requested, slot_wait, 0.0)
+                cpu_start = time.thread_time()
+            try:
+                url = f'{self.base_url}/snmp?target={target_info.host}&auth={target_info.auth}&module={target_info.module}'
+                timeout = self.timeout_for(stats)
+                self.logger.debug(
+                    f'Collecting metrics from {url} (timeout {timeout:.1f}s)',
+                )
+                with session.get(url, timeout=timeout, stream=True) as response:
+                    response.raise_for_status()
+                    latency = response_time = time.monotonic() - start
+                    if trace is not None:
+                        trace.add(
+                            'fetch', start, latency,
+                            time.thread_time() - cpu_start,
+                        )
+                    # Milliseconds
+                    timestamp = int(time.time() * 1000)
+
+                    parser = ExpositionParser(
+                        self.counter_names,
+                        series_filter.keep_name if series_filter is not None else None,
+                    )
+                    chunks = response.iter_content(chunk_size=READ_CHUNK_SIZE)
+                    while True:
+                        # Only the reads count towards latency, not the time
+                        # the caller spends on the samples in between.
+                        read_start = time.monotonic()
+                        if trace is not None:
+                            cpu_start = time.thread_time()
+                        data = next(chunks, None)
+                        parse_start = time.monotonic()
+                        latency += parse_start - read_start
+                        if trace is not None:
+                            parse_cpu_start = time.thread_time()
+                            trace.add(
+                                'read',
+                                read_start,
+                                parse_start - read_start,
+                                parse_cpu_start - cpu_start,
+                            )
+                        batch = SampleBatch(table, timestamp)
+                        parser.parse_into(data, batch)
+                        parse_end = time.monotonic()
+                        parse_time += parse_end - parse_start
+                        if trace is not None:
+                            trace.add(
+                                'parse',
+                                parse_start,
+                                parse_end - parse_start,
+                                time.thread_time() - parse_cpu_start,
+                            )
+                        if batch.ids:
+                            yield batch
+                        count += len(batch)
+                        if data is None:
+                            break
+                    filtered = parser.skipped
+
+            except Exception as e:
+                self._record_failure(
+                    target,
+                    stats,
+                    latency or time.monotonic() - start,
+                    e,
+                    parse_time,
+                    slot_wait,
+                )
+                raise
+
+        stats.record_success(
+            latency,
+            count,
+            parse_time,
+            slot_wait,
+            filtered,
+            response_time,
+        )
+        self._close_breaker(target, stats)
+        self.logger.debug(
+            f'Collected {count} metrics from {target_info.host} in {latency:.3f}s',
+        )
+
+
+# Default level per Content-Encoding: zlib's own default for gzip and the
+# zstd library's for zstd.
+COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+
+
+class Compressor:
+    """Compress request bodies for one ``Content-Encoding``, safely across sender threads."""
+
+    def __init__(self, encoding: str = 'gzip', level: int | None = None):
+        if encoding not in COMPRESSION_LEVELS:
+            raise ValueError(f'Unknown compression: {encoding}')
+        if encoding == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        self.encoding = encoding
+        self.level = COMPRESSION_LEVELS[encoding] if level is None else level
+        # ZstdCompressor objects must not be shared between threads.
+        self._local = threading.local()
+
+    def compress(self, body: bytes) -> bytes:
+        if self.encoding == 'gzip':
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            return compressor.compress(body) + compressor.flush()
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(
+                level=self.level,
+            )
+        return compressor.compress(body)
+
+
+class Endpoint:
+    """One output URL and its load and health."""
+
+    __slots__ = ('url', 'in_flight', 'failures', 'ejected_until')
+
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+
+class EndpointPool:
+    """Choose an output endpoint per request and eject the ones that keep failing.
+
+    ``balance`` is ``round-robin`` or ``least-loaded`` (fewest requests in
+    flight). An endpoint is ejected for ``eject_seconds`` after
+    ``eject_after`` consecutive failures; if every endpoint is ejected, the
+    one due back first is tried anyway so that recovery is noticed.
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        balance: str = 'round-robin',
+        eject_after: int = 3,
+        eject_seconds: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+        name: str = 'Logstash',
+    ):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.balance = balance
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.clock = clock
+        self.name = name
+        self.logger = logging.getLogger(__name__)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude: tuple[Endpoint, ...] = ()) -> Endpoint | None:
+        """Pick an endpoint not in ``exclude``; ``None`` once all have been tried."""
+        with self._lock:
+            candidates = [
+                endpoint for endpoint in self.endpoints if endpoint not in exclude
+            ]
+            if not candidates:
+                return None
+            now = self.clock()
+            healthy = [
+                endpoint for endpoint in candidates if endpoint.ejected_until <= now
+            ]
+            if not healthy:
+                endpoint = min(
+                    candidates, key=lambda endpoint: endpoint.ejected_until,
+                )
+            elif self.balance == 'least-loaded':
+                endpoint = min(
+                    healthy, key=lambda endpoint: endpoint.in_flight,
+                )
+            else:
+                endpoint = healthy[self._next % len(healthy)]
+                self._next += 1
+            endpoint.in_flight += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, ok: bool) -> None:
+        with self._lock:
+            endpoint.in_flight -= 1
+            if ok:
+                if endpoint.failures >= self.eject_after:
+                    self.logger.info(
+                        f'{self.name} endpoint {endpoint.url} is healthy again',
+                    )
+                endpoint.failures = 0
+                endpoint.ejected_until = 0.0
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.eject_after:
+                now = self.clock()
+                # Requests already in flight when it was ejected fail too.
+                already_ejected = endpoint.ejected_until > now
+                endpoint.ejected_until = now + self.eject_seconds
+                if len(self.endpoints) > 1 and not already_ejected:
+                    self.logger.warning(
+                        f'Ejecting {self.name} endpoint {endpoint.url} for {self.eject_seconds:g}s '
+                        f'after {endpoint.failures} consecutive failures',
+                    )
+
+    def ejected(self) -> int:
+        now = self.clock()
+        return sum(endpoint.ejected_until > now for endpoint in self.endpoints)
+
+
+class BatchFormat(NamedTuple):
+    content_type: str
+    start: bytes
+    separator: bytes
+    end: bytes
+
+
+# 'ndjson' needs the json_lines codec on the Logstash http input (see
+# logstash-http-input.conf), 'json' is a plain array the json codec splits.
+BATCH_FORMATS = {
+    'ndjson': BatchFormat('application/x-ndjson', b'', b'\n', b'\n'),
+    'json': BatchFormat('application/json', b'[', b',', b']'),
+}
+
+# OpenSearch _bulk body: a create action before every document, which is
+# the only action a data stream accepts.
+BULK_FORMAT = BatchFormat(
+    'application/x-ndjson',
+    b'{"create":{}}\n',
+    b'\n{"create":{}}\n',
+    b'\n',
+)
+
+
+class Delivery(NamedTuple):
+    """Outcome of sending one body.
+
+    ``rejected`` documents were refused for good (e.g. mapping errors) and
+    are not retried; ``pending`` is a body of type ``content_type`` with
+    the ``pending_count`` documents that could not be delivered yet.
+    """
+
+    sent: int
+    rejected: int = 0
+    pending: bytes = b''
+    pending_count: int = 0
+    content_type: str = ''
+
+
+class HTTPOutput:
+    """POST request bodies to one of several endpoints, compressed if configured.
+
+    Subclasses implement ``send(payload, content_type, count) -> Delivery``
+    on top of ``_post``, which fails over between endpoints and records
+    every attempt in the forwarder metrics.
+    """
+
+    name = 'HTTP'
+
+    def __init__(
+        self,
+        urls: list[str],
+        timeout: float,
+        metrics: ForwarderMetrics,
+        compressor: Compressor | None = None,
+        balance: str = 'round-robin',
+        eject_after: int = 3,
+        eject_seconds: float = 30.0,
+        pool_size: int = 1,
+        auth: tuple[str, str] | None = None,
+    ):
+        self.timeout = timeout
+        self.metrics = metrics
+        self.compressor = compressor
+        self.auth = auth
+        self.logger = logging.getLogger(__name__)
+        self.endpoints = EndpointPool(
+            urls,
+            balance=balance,
+            eject_after=eject_after,
+            eject_seconds=eject_seconds,
+            name=self.name,
+        )
+        for endpoint in self.endpoints.endpoints:
+            session.mount(endpoint.url, HTTPAdapter(pool_maxsize=pool_size))
+
+    def _post(self, payload: bytes, content_type: str, count: int, path: str = '') -> requests.Response | None:
+        """POST a body to an endpoint, trying the others if it fails."""
+        headers = {'Content-Type': content_type}
+        body = payload
+        if self.compressor is not None:
+            body = self.compressor.compress(payload)
+            headers['Content-Encoding'] = self.compressor.encoding
+        headers['Content-Length'] = str(len(body))
+
+        tried: tuple[Endpoint, ...] = ()
+        while True:
+            endpoint = self.endpoints.acquire(tried)
+            if endpoint is None:
+                return None
+            tried += (endpoint,)
+            start = time.monotonic()
+            req = None
+            try:
+                self.logger.debug(
+                    f'Posting {count} documents ({len(payload)} bytes, {len(body)} on the wire) to {endpoint.url}',
+                )
+                req = session.post(
+                    endpoint.url.rstrip('/') + path if path else endpoint.url,
+                    data=body,
+                    headers=headers,
+                    timeout=self.timeout,
+                    auth=self.auth,
+                )
+
+                if req.status_code != 200:
+                    self.logger.warning(
+                        f'Unexpected status code from {self.name} at {endpoint.url}: {req.status_code}',
+                    )
+                    req = None
+
+            except Exception as e:
+                self.logger.error(
+                    f'Failed to send data to {self.name} at {endpoint.url}: {str(e)}',
+                )
+
+            finally:
+                self.endpoints.release(endpoint, req is not None)
+            self.metrics.observe_post(
+                count,
+                len(body),
+                time.monotonic() - start,
+                req is not None,
+            )
+            if req is not None:
+                return req
+
+
+class LogstashOutput(HTTPOutput):
+    """Post bodies to the Logstash http input, which accepts or refuses them whole."""
+
+    name = 'Logstash'
+
+    def __init__(self, urls: list[str], timeout: float, metrics: ForwarderMetrics, batch_format: str = 'ndjson', **kwargs: Any):
+        super().__init__(urls, timeout, metrics, **kwargs)
+        self.batch_format = BATCH_FORMATS[batch_format]
+
+    def send(self, payload: bytes, content_type: str, count: int) -> Delivery:
+        if self._post(payload, content_type, count) is not None:
+            return Delivery(count)
+        return Delivery(0, 0, payload, count, content_type)
+
+
+class OpenSearchOutput(HTTPOutput):
+    """Write batches to a data stream through the OpenSearch ``_bulk`` API.
+
+    A bulk request succeeds or fails per document. Documents refused with
+    a retryable status (429 when the write queues are full, or a shard
+    being unavailable) are sent again on their own, with exponential
+    backoff, up to ``max_retries`` times; other refusals are logged and
+    dropped since sending them again cannot succeed.
+    """
+
+    name = 'OpenSearch'
+    batch_format = BULK_FORMAT
+    RETRY_STATUSES = frozenset({429, 502, 503, 504})
+    # Only what is needed to find the failed items, instead of echoing
+    # index, id and version for every document.
+    FILTER_PATH = 'filter_path=errors,items.*.status,items.*.error.type,items.*.error.reason'
+
+    def __init__(
+        self,
+        urls: list[str],
+        timeout: float,
+        metrics: ForwarderMetrics,
+        data_stream: str = 'metrics-prometheus-default',
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        **kwargs: Any,
+    ):
+        super().__init__(urls, timeout, metrics, **kwargs)
+        self.path = f'/{data_stream}/_bulk?{self.FILTER_PATH}'
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def send(self, payload: bytes, content_type: str, count: int) -> Delivery:
+        if content_type != self.batch_format.content_type:
+            # A single document from --send-mode single.
+            payload = self.batch_format.start + payload + self.batch_format.end
+        fmt = self.batch_format
+        sent = rejected = 0
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = min(self.backoff * 2 ** (attempt - 1), 30.0)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+            req = self._post(payload, fmt.content_type, count, self.path)
+            if req is None:
+                continue
+            try:
+                result = req.json()
+            except ValueError:
+                self.logger.error(
+                    f'Unparseable bulk response from {self.name}',
+                )
+                continue
+            if not result.get('errors'):
+                return Delivery(sent + count, rejected)
+
+            # Action and document lines alternate; items follow the documents.
+            documents = payload.split(b'\n')[1::2]
+            retry = []
+            refused = []
+            for document, item in zip(documents, result.get('items', [])):
+                status = item['create']['status']
+                if status < 300:
+                    sent += 1
+                elif status in self.RETRY_STATUSES:
+                    retry.append(document)
+                else:
+                    refused.append(item['create'].get('error', {}))
+            if refused:
+                rejected += len(refused)
+                error = refused[0]
+                self.logger.warning(
+                    f'{self.name} refused {len(refused)} documents, '
+                    f"e.g. {error.get('type')}: {error.get('reason')}",
+                )
+            if not retry:
+                return Delivery(sent, rejected)
+            self.logger.debug(
+                f'Retrying {len(retry)} of {count} documents refused by {self.name}',
+            )
+            payload = fmt.start + fmt.separator.join(retry) + fmt.end
+            count = len(retry)
+        return Delivery(sent, rejected, payload, count, fmt.content_type)
+
+
+class LogstashBatcher:
+    """Accumulate encoded documents and post them as a single request.
+
+    A batch is flushed once it holds ``max_docs`` documents or ``max_bytes``
+    bytes, or when its oldest document has waited ``linger`` seconds.
+    """
+
+    def __init__(
+        self,
+        post: Callable[[bytes, str, int], bool],
+        batch_format: BatchFormat,
+        max_docs: int = 500,
+        max_bytes: int = 1024 * 1024,
+        linger: float = 1.0,
+    ):
+        self.post = post
+        self.batch_format = batch_format
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.linger = linger
+        # Documents are written straight into one body buffer as they arrive.
+        self._buffer = bytearray()
+        self._count = 0
+        self._first_added = 0.0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def due(self) -> bool:
+        """Return True when the oldest pending document has lingered long enough."""
+        return self._count > 0 and time.monotonic() - self._first_added >= self.linger
+
+    def time_until_due(self) -> float | None:
+        """Seconds until the pending batch must be flushed, or None if empty."""
+        if not self._count:
+            return None
+        return max(0.0, self._first_added + self.linger - time.monotonic())
+
+    def add(self, document: bytes) -> None:
+        fmt = self.batch_format
+        if self._count and len(self._buffer) + len(fmt.separator) + len(document) + len(fmt.end) > self.max_bytes:
+            self.flush()
+        if self._count:
+            self._buffer += fmt.separator
+        else:
+            self._first_added = time.monotonic()
+            self._buffer += fmt.start
+        self._buffer += document
+        self._count += 1
+        if self._count >= self.max_docs or len(self._buffer) >= self.max_bytes or self.due():
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._count:
+            return
+        self._buffer += self.batch_format.end
+        body = bytes(self._buffer)
+        count = self._count
+        del self._buffer[:]
+        self._count = 0
+        self.post(body, self.batch_format.content_type, count)
+
+
+class SpoolRecord(NamedTuple):
+    segment: int
+    offset: int
+    next_offset: int
+    content_type: str
+    count: int
+    created: float
+    body: bytes
+
+
+class DiskSpool:
+    """Append-only on-disk spool for request bodies Logstash did not accept.
+
+    Bodies are appended as checksummed records to numbered segment files and
+    read back through mmap in the order they were written. The replay
+    position is checkpointed to a cursor file so a restart carries on where
+    replay stopped, and a torn record left at the end of the newest segment
+    by a crash is truncated away when the spool is opened. Whole segments
+    are evicted oldest first once the spool exceeds ``max_bytes`` or its
+    segments are older than ``max_age`` seconds.
+    """
+
+    _HEADER = struct.Struct('<4sIIIdH')
+    _MAGIC = b'P2LS'
+    _SUFFIX = '.seg'
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 1024 * 1024 * 1024,
+        max_age: float = 7 * 24 * 3600,
+        segment_bytes: int = 16 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Eviction works on whole segments, so keep several per spool.
+        self.segment_bytes = min(segment_bytes, max(1, max_bytes // 4))
+        self.logger = logging.getLogger(__name__)
+        self.evicted_bytes = 0
+        self._lock = threading.Lock()
+        self._writer: BinaryIO | None = None
+        self._write_size = 0
+        self._map: mmap.mmap | None = None
+        self._map_segment = -1
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(
+            int(name[:-len(self._SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(self._SUFFIX)
+        )
+        if self._segments:
+            self._recover(self._segments[-1])
+        self._next_segment = self._segments[-1] + 1 if self._segments else 0
+        self._read_segment, self._read_offset = self._load_cursor()
+        self.bytes = sum(
+            os.path.getsize(self._path(seg))
+            for seg in self._segments
+        )
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:020d}{self._SUFFIX}')
+
+    def _cursor_path(self) -> str:
+        return os.path.join(self.directory, 'cursor')
+
+    def _recover(self, segment: int) -> None:
+        """Truncate the newest segment after its last complete record."""
+        path = self._path(segment)
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while True:
+            record = self._decode(segment, data, offset)
+            if record is None:
+                break
+            offset = record.next_offset
+        if offset < len(data):
+            self.logger.warning(
+                f'Truncating {len(data) - offset} bytes of incomplete spool data from {path}',
+            )
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+
+    def _load_cursor(self) -> tuple[int, int]:
+        oldest = self._segments[0] if self._segments else 0
+        try:
+            with open(self._cursor_path()) as f:
+                cursor = json.load(f)
+            segment, offset = int(cursor['segment']), int(cursor['offset'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return oldest, 0
+        if segment not in self._segments:
+            return oldest, 0
+        return segment, offset
+
+    def _save_cursor(self) -> None:
+        tmp = self._cursor_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(
+                {'segment': self._read_segment, 'offset': self._read_offset},
+                f,
+            )
+        os.replace(tmp, self._cursor_path())
+
+    def _decode(self, segment: int, data: Any, offset: int) -> SpoolRecord | None:
+        header_end = offset + self._HEADER.size
+        if header_end > len(data):
+            return None
+        fields = self._HEADER.unpack_from(data, offset)
+        magic, length, crc, count, created, ct_length = fields
+        end = header_end + ct_length + length
+        if magic != self._MAGIC or end > len(data):
+            return None
+        payload = data[header_end:end]
+        if zlib.crc32(payload) != crc:
+            return None
+        return SpoolRecord(
+            segment=segment,
+            offset=offset,
+            next_offset=end,
+            content_type=bytes(payload[:ct_length]).decode('ascii'),
+            count=count,
+            created=created,
+            body=bytes(payload[ct_length:]),
+        )
+
+    def empty(self) -> bool:
+        with self._lock:
+            if not self._segments:
+                return True
+            return (
+                self._read_segment == self._segments[-1]
+                and self._read_offset >= os.path.getsize(self._path(self._read_segment))
+            )
+
+    def append(self, body: bytes, content_type: str, count: int) -> None:
+        ct = content_type.encode('ascii')
+        payload = ct + body
+        record = self._HEADER.pack(
+            self._MAGIC,
+            len(body),
+            zlib.crc32(payload),
+            count,
+            time.time(),
+            len(ct),
+        ) + payload
+        with self._lock:
+            if self._writer is None or (
+                self._write_size
+                and self._write_size + len(record) > self.segment_bytes
+            ):
+                self._roll()
+            self._writer.write(record)
+            self._writer.flush()
+            self._write_size += len(record)
+            self.bytes += len(record)
+            self._enforce_limits()
+
+    def _roll(self) -> None:
+        if self._writer is not None:
+            os.fsync(self._writer.fileno())
+            self._writer.close()
+        segment = self._next_segment
+        self._next_segment += 1
+        if not self._segments:
+            self._read_segment, self._read_offset = segment, 0
+        self._segments.append(segment)
+        self._writer = open(self._path(segment), 'ab')
+        self._write_size = 0
+
+    def _enforce_limits(self) -> None:
+        cutoff = time.time() - self.max_age
+        while self._segments:
+            oldest = self._segments[0]
+            path = self._path(oldest)
+            too_big = self.bytes > self.max_bytes
+            too_old = os.path.getmtime(path) < cutoff
+            if not too_big and not too_old:
+                break
+            size = os.path.getsize(path)
+            self.logger.warning(
+                f'Evicting spool segment {path} ({size} bytes, '
+                f"{'over size limit' if too_big else 'over age limit'})",
+            )
+            self._drop_segment(oldest)
+            self.bytes -= size
+            self.evicted_bytes += size
+
+    def _drop_segment(self, segment: int) -> None:
+        if self._map_segment == segment:
+            self._map.close()
+            self._map = None
+            self._map_segment = -1
+        if self._writer is not None and segment == self._segments[-1]:
+            self._writer.close()
+            self._writer = None
+        os.remove(self._path(segment))
+        self._segments.remove(segment)
+        if self._read_segment == segment:
+            self._read_segment = self._segments[0] if self._segments else self._next_segment
+            self._read_offset = 0
+            self._save_cursor()
+
+    def _mapped(self, segment: int) -> mmap.mmap | None:
+        size = os.path.getsize(self._path(segment))
+        if self._map is not None and self._map_segment == segment and len(self._map) == size:
+            return self._map
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._map_segment = -1
+        if size == 0:
+            return None
+        with open(self._path(segment), 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._map_segment = segment
+        return self._map
+
+    def peek(self) -> SpoolRecord | None:
+        """Return the oldest record that has not been committed yet."""
+        with self._lock:
+            self._enforce_limits()
+            while self._segments:
+                segment = self._read_segment
+                data = self._mapped(segment)
+                record = None
+                if data is not None:
+                    record = self._decode(segment, data, self._read_offset)
+                if record is not None:
+                    return record
+                size = os.path.getsize(self._path(segment))
+                if segment == self._segments[-1] and self._read_offset < size:
+                    # A record is being written or was torn; wait for more.
+                    return None
+                # Finished (or unreadable past this point): move to the next segment.
+                if data is not None and self._read_offset < len(data):
+                    self.logger.error(
+                        f'Skipping corrupt spool data in {self._path(segment)} '
+                        f'at offset {self._read_offset}',
+                    )
+                self._drop_segment(segment)
+                self.bytes -= size
+            return None
+
+    def commit(self, record: SpoolRecord) -> None:
+        """Mark ``record`` as delivered so it is not replayed again."""
+        with self._lock:
+            if record.segment == self._read_segment:
+                self._read_offset = record.next_offset
+                self._save_cursor()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._writer is not None:
+                os.fsync(self._writer.fileno())
+                self._writer.close()
+                self._writer = None
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+                self._map_segment = -1
+
+
+class ScheduledTarget:
+    """Scheduling state for one target."""
+
+    __slots__ = (
+        'target',
+        'interval',
+        'next_due',
+        'running',
+        'missed',
+        'overruns',
+        'last_duration',
+        'removed',
+    )
+
+    def __init__(self, target: str, interval: float, next_due: float):
+        self.target = target
+        self.interval = interval
+        self.next_due = next_due
+        self.running = False
+        self.missed = 0
+        self.overruns = 0
+        self.last_duration = 0.0
+        self.removed = False
+
+
+class Scheduler:
+    """Fire each target on its own cadence against the monotonic clock.
+
+    Deadlines advance by a whole interval from the previous deadline rather
+    than from when the scrape finished, so slow scrapes do not push later
+    cycles back. Deadlines that have already passed are skipped and counted
+    as missed instead of being run late in a burst.
+    """
+
+    def __init__(
+        self,
+        intervals: dict[str, float],
+        jitter: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.clock = clock
+        self.jitter = jitter
+        self.logger = logging.getLogger(__name__)
+        self.entries: dict[str, ScheduledTarget] = {}
+        self._heap: list[tuple[float, int, ScheduledTarget]] = []
+        self._seq = 0
+        # Missed deadlines of removed targets, so the total never drops.
+        self.retired_missed = 0
+        for target, interval in intervals.items():
+            self.add(target, interval)
+
+    def add(self, target: str, interval: float) -> None:
+        # Spread first scrapes over the interval so that every target does
+        # not hit snmp_exporter in the same instant.
+        entry = ScheduledTarget(
+            target,
+            interval,
+            self.clock() + random.uniform(0, interval * self.jitter),
+        )
+        self.entries[target] = entry
+        self._push(entry)
+
+    def remove(self, target: str) -> ScheduledTarget | None:
+        """Stop scheduling a target; a scrape already running is left to finish."""
+        entry = self.entries.pop(target, None)
+        if entry is not None:
+            # Dropped from the heap when it next comes up.
+            entry.removed = True
+            self.retired_missed += entry.missed
+        return entry
+
+    def missed(self) -> int:
+        """Deadlines missed since the scheduler started, removed targets included."""
+        return self.retired_missed + sum(
+            entry.missed for entry in self.entries.values()
+        )
+
+    def reschedule(self, target: str, interval: float) -> None:
+        entry = self.entries.get(target)
+        if entry is None or entry.interval == interval:
+            return
+        entry.interval = interval
+        # Keep the current deadline unless the new interval brings it closer.
+        next_due = self.clock() + interval
+        if next_due < entry.next_due:
+            entry.next_due = next_due
+            self._push(entry)
+
+    def _push(self, entry: ScheduledTarget) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (entry.next_due, self._seq, entry))
+
+    def time_until_next(self) -> float | None:
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self.clock())
+
+    def pop_due(self) -> list[ScheduledTarget]:
+        """Return the targets whose deadline has arrived and reschedule them."""
+        now = self.clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, entry = heapq.heappop(self._heap)
+            if entry.removed or deadline != entry.next_due:
+                # Removed, or a stale heap item left behind by reschedule().
+                continue
+            late = now - entry.next_due
+            if late >= entry.interval:
+                skipped = int(late // entry.interval)
+                entry.missed += skipped
+                entry.next_due += skipped * entry.interval
+                self.logger.warning(
+                    f'Missed {skipped} deadline(s) for {entry.target}, '
+                    f'scheduler was {late:.1f}s late',
+                )
+            entry.next_due += entry.interval
+            self._push(entry)
+            due.append(entry)
+        return due
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+class Serializer(NamedTuple):
+    name: str
+    dumps: Callable[[Any], bytes]
+
+
+# Compact JSON encoders, fastest first. orjson and msgspec write NaN and the
+# infinities as null where the json module writes NaN/Infinity; sample values
+# never go through these (see _json_number), only names, labels and tags.
+SERIALIZERS = {}
+if msgspec is not None:
+    SERIALIZERS['msgspec'] = Serializer('msgspec', msgspec.json.encode)
+if orjson is not None:
+    SERIALIZERS['orjson'] = Serializer('orjson', orjson.dumps)
+SERIALIZERS['json'] = Serializer('json', _stdlib_dumps)
+
+
+def get_serializer(name: str = 'auto') -> Serializer:
+    """Return the named serializer, or the fastest one installed for 'auto'."""
+    if name == 'auto':
+        return next(iter(SERIALIZERS.values()))
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(f'JSON serializer {name!r} is not available')
+
+
+class _LazyJSON:
+    """Indented JSON for a log message, rendered only if the record is emitted."""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        obj = self.obj
+        if isinstance(obj, (bytes, bytearray)):
+            obj = json.loads(obj)
+        return json.dumps(obj, indent=2)
+
+
+def _json_number(value: float) -> bytes:
+    # repr() is what json.dumps() uses for finite floats; NaN and the
+    # infinities keep json.dumps()'s spelling.
+    if value != value or value in (math.inf, -math.inf):
+        return json.dumps(value).encode('ascii')
+    return repr(value).encode('ascii')
+
+
+class DocumentTemplate:
+    """Pre-rendered JSON for the parts of a document shared by a target's samples.
+
+    The agent, event and tag fields are rendered once per target and the
+    timestamps once per scrape, so rendering a sample only encodes its name,
+    labels and value. ``render_batch`` goes further and encodes a series'
+    name and labels once, caching the fragment in its SeriesTable.
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        agent_name: str,
+        target_info: Target,
+        dumps: Callable[[Any], bytes] = _stdlib_dumps,
+    ):
+        agent = dumps(
+            {
+                'hostname': hostname,
+                'name': agent_name,
+                'type': 'prometheus-to-logstash',
+                'version': '1.0.0',
+            },
+        )
+        event = dumps(
+            {'module': 'prometheus', 'dataset': 'prometheus.metrics'},
+        )
+        tags = dumps(
+            {
+                'auth': target_info.auth,
+                'module': target_info.modules,
+                **dict(target_info.labels),
+            },
+        )
+        self.dumps = dumps
+        self._head = (
+            b',"agent":' + agent
+            + b',"event":' + event
+            + b',"prometheus":{"metric":{"name":'
+        )
+        self._tail = (
+            b',"target":' + dumps(target_info.host)
+            + b'},"tags":' + tags + b'}}'
+        )
+        self._names: dict[str, bytes] = {}
+        self._scrape: tuple[int, bytes, bytes] = (-1, b'', b'')
+
+    def _for_scrape(self, timestamp: int) -> tuple[int, bytes, bytes]:
+        iso = datetime.fromtimestamp(
+            timestamp / 1000, tz=timezone.utc,
+        ).isoformat()
+        scrape = (
+            timestamp,
+            b'{"@timestamp":"' + iso.encode('ascii') + b'"' + self._head,
+            b',"timestamp":%d' % timestamp + self._tail,
+        )
+        # Replaced as one tuple so concurrent scrapes never mix halves.
+        self._scrape = scrape
+        return scrape
+
+    def fragment(self, name: str, labels: dict[str, str]) -> bytes:
+        """The part of a document that identifies a series: its name and labels."""
+        encoded_name = self._names.get(name)
+        if encoded_name is None:
+            encoded_name = self._names[name] = self.dumps(name)
+        return encoded_name + b',"labels":' + self.dumps(labels) + b',"value":'
+
+    def render(
+        self,
+        name: str,
+        labels: dict[str, str],
+        value: float,
+        timestamp: int,
+        rate: float | None = None,
+    ) -> bytes:
+        scrape = self._scrape
+        if scrape[0] != timestamp:
+            scrape = self._for_scrape(timestamp)
+        return b''.join((
+            scrape[1],
+            self.fragment(name, labels),
+            _json_number(value),
+            b'' if rate is None else b',"rate":' + _json_number(rate),
+            scrape[2],
+        ))
+
+    def render_batch(self, batch: SampleBatch) -> list[bytes]:
+        """Render every sample of a batch, without rates."""
+        scrape = self._scrape
+        if scrape[0] != batch.timestamp:
+            scrape = self._for_scrape(batch.timestamp)
+        head, tail = scrape[1], scrape[2]
+        table = batch.table
+        fragments = table.fragments
+        documents = []
+        append = documents.append
+        for series_id, value in zip(batch.ids, batch.values):
+            fragment = fragments[series_id]
+            if fragment is None:
+                fragment = fragments[series_id] = self.fragment(
+                    table.names[series_id], table.labels[series_id],
+                )
+            append(head + fragment + _json_number(value) + tail)
+        return documents
+
+    def render_series(
+        self,
+        table: SeriesTable,
+        series_id: int,
+        value: float,
+        timestamp: int,
+        rate: float | None = None,
+    ) -> bytes:
+        """Render one sample of a batch, with its rate if there is one."""
+        scrape = self._scrape
+        if scrape[0] != timestamp:
+            scrape = self._for_scrape(timestamp)
+        fragment = table.fragments[series_id]
+        if fragment is None:
+            fragment = table.fragments[series_id] = self.fragment(
+                table.names[series_id], table.labels[series_id],
+            )
+        return b''.join((
+            scrape[1],
+            fragment,
+            _json_number(value),
+            b'' if rate is None else b',"rate":' + _json_number(rate),
+            scrape[2],
+        ))
+
+
+COUNTER32_MODULUS = 2 ** 32
+
+# Metric names of Counter32 objects. snmp_exporter exposes Counter32 and
+# Counter64 alike as counters, so the width comes from the name; in IF-MIB
+# every ifIn*/ifOut* counter is 32 bit and the ifHC* ones are 64 bit.
+DEFAULT_COUNTER32_PATTERNS = [r'if(In|Out)\w*']
+
+
+def counter_rate(previous: float, value: float, elapsed: float, counter32: bool = False) -> float | None:
+    """Per-second rate between two readings of an SNMP counter.
+
+    A drop in a ``counter32`` is treated as a wrap when going round the 32
+    bit range covers less than half of it. Any other drop means the device
+    restarted its counter from zero, as Prometheus' rate() assumes; a 64
+    bit counter does not wrap in the lifetime of a device.
+    """
+    if elapsed <= 0:
+        return None
+    increase = value - previous
+    if increase < 0:
+        increase = value
+        if counter32 and 0 <= previous < COUNTER32_MODULUS and value == int(value):
+            wrapped = int(value) + COUNTER32_MODULUS - int(previous)
+            if wrapped <= COUNTER32_MODULUS // 2:
+                increase = wrapped
+    return increase / elapsed
+
+
+class SeriesIndex:
+    """Last known value of every series, keyed by target, name and labels.
+
+    Each target has its own dict from ``(name, label items)`` to a slot, and
+    the per-series state (value, millisecond timestamp and the scrape it was
+    last seen in) lives in flat arrays indexed by slot rather than in a
+    Python object per series. A series not seen for ``stale_scrapes``
+    scrapes of its target is evicted and its slot reused. Once
+    ``max_series`` slots are in use, new series are not tracked at all.
+    """
+
+    def __init__(self, max_series: int = 1000000, stale_scrapes: int = 5):
+        self.max_series = max_series
+        self.stale_scrapes = stale_scrapes
+        self.logger = logging.getLogger(__name__)
+        self.values = array('d')
+        self.times = array('d')
+        self.seen = array('q')
+        self._free: list[int] = []
+        self._series: dict[str, dict[tuple, int]] = {}
+        self._scrapes: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._full_warned = False
+
+    def __len__(self) -> int:
+        return len(self.values) - len(self._free)
+
+    def begin_scrape(self, target: str) -> tuple[int, dict[tuple, int]]:
+        """Start a scrape of ``target``; return its scrape number and series."""
+        scrape = self._scrapes.get(target, 0) + 1
+        self._scrapes[target] = scrape
+        return scrape, self._series.setdefault(target, {})
+
+    def _allocate(self) -> int:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            if len(self.values) >= self.max_series:
+                if not self._full_warned:
+                    self._full_warned = True
+                    self.logger.warning(
+                        f'Series index is full ({self.max_series} series), '
+                        'new series will not be tracked',
+                    )
+                return -1
+            self.values.append(0.0)
+            self.times.append(0.0)
+            self.seen.append(0)
+            return len(self.values) - 1
+
+    def update(
+        self,
+        series: dict[tuple, int],
+        key: tuple,
+        value: float,
+        timestamp: int,
+        scrape: int,
+        counter: bool = False,
+        counter32: bool = False,
+    ) -> tuple[bool, float | None]:
+        """Record a sample; return whether its value changed and, for counters, its rate."""
+        slot = series.get(key)
+        if slot is None:
+            slot = self._allocate()
+            if slot < 0:
+                return True, None
+            series[key] = slot
+            self.values[slot] = value
+            self.times[slot] = timestamp
+            self.seen[slot] = scrape
+            return True, None
+        previous = self.values[slot]
+        previous_time = self.times[slot]
+        self.values[slot] = value
+        self.times[slot] = timestamp
+        self.seen[slot] = scrape
+        # NaN never equals itself, but NaN followed by NaN is no change.
+        changed = previous != value and not (
+            previous != previous and value != value
+        )
+        if not counter:
+            return changed, None
+        return changed, counter_rate(previous, value, (timestamp - previous_time) / 1000, counter32)
+
+    def end_scrape(self, target: str) -> None:
+        """Evict the target's series that have stopped appearing."""
+        scrape = self._scrapes.get(target, 0)
+        if scrape % self.stale_scrapes:
+            return
+        series = self._series.get(target, {})
+        seen = self.seen
+        stale = [
+            key for key, slot in series.items()
+            if scrape - seen[slot] >= self.stale_scrapes
+        ]
+        if not stale:
+            return
+        with self._lock:
+            for key in stale:
+                self._free.append(series.pop(key))
+        self.logger.debug(f'Evicted {len(stale)} stale series of {target}')
+
+    def drop_target(self, target: str) -> None:
+        series = self._series.pop(target, {})
+        self._scrapes.pop(target, None)
+        with self._lock:
+            self._free.extend(series.values())
+
+    def export(self) -> dict[str, list]:
+        """Every tracked series as ``[name, label items, value, timestamp]`` per target."""
+        values = self.values
+        times = self.times
+        return {
+            target: [
+                [name, items, values[slot], times[slot]]
+                # Copied first, as scrapes may add series meanwhile.
+                for (name, items), slot in list(series.items())
+            ]
+            for target, series in list(self._series.items())
+        }
+
+    def restore(self, state: dict[str, list], targets: set[str] | None = None) -> int:
+        """Load series from ``export()``, keeping only ``targets`` if given."""
+        restored = 0
+        for target, entries in state.items():
+            if targets is not None and target not in targets:
+                continue
+            self.drop_target(target)
+            series = self._series[target] = {}
+            self._scrapes[target] = 0
+            for name, items, value, timestamp in entries:
+                slot = self._allocate()
+                if slot < 0:
+                    return restored
+                series_key = (
+                    sys.intern(name),
+                    tuple((sys.intern(key), label) for key, label in items),
+                )
+                series[series_key] = slot
+                self.values[slot] = value
+                self.times[slot] = timestamp
+                self.seen[slot] = 0
+                restored += 1
+        return restored
+
+
+# Prefix of the forwarder's own metrics on /metrics.
+METRICS_PREFIX = 'prometheus_to_logstash'
+
+# Documents travel from the scrape workers to the sender thread in chunks so
+# the queue is not touched once per sample.
+CHUNK_SIZE = 256
+
+# How often run() logs the forwarder counters, in seconds.
+STATS_INTERVAL = 60
+
+# Control items for the sender queue.
+_FLUSH = object()
+_STOP = object()
+
+# Buckets for the per-stage durations, from a sub-millisecond parse of a
+# small module up to a walk of a large switch stack.
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+
+
+class _ForwarderStatsCollector:
+    """Expose the forwarder's counters and gauges as they stand at scrape time."""
+
+    def __init__(self, forwarder: PrometheusToLogstash) -> None:
+        self.forwarder = forwarder
+
+    def collect(self) -> Iterator[Any]:
+        forwarder = self.forwarder
+        stats = forwarder.stats()
+        for key, documentation in (
+            ('metrics_collected', 'Documents handed to the sender'),
+            ('metrics_sent', 'Documents accepted by the output'),
+            ('metrics_spooled', 'Documents written to the spool'),
+            ('metrics_unchanged', 'Samples not shipped by delta mode'),
+            ('metrics_filtered', 'Samples dropped by the filter rules'),
+            ('errors', 'Documents dropped because of errors'),
+            (
+                'missed_deadlines',
+                'Scrapes skipped because the previous one was still running',
+            ),
+            ('cycle_overruns', 'Scrapes that took longer than their interval'),
+            ('breaker_skips', 'Scrapes skipped because the target\'s circuit was open'),
+        ):
+            yield CounterMetricFamily(f'{METRICS_PREFIX}_{key}', documentation, value=stats[key])
+        yield GaugeMetricFamily(
+            f'{METRICS_PREFIX}_queue_chunks',
+            f'Chunks of up to {CHUNK_SIZE} documents waiting for the sender',
+            value=forwarder.queue.qsize(),
+        )
+        yield GaugeMetricFamily(
+            f'{METRICS_PREFIX}_batch_pending_documents',
+            'Documents in the batch being built',
+            value=len(forwarder.batcher) if forwarder.batcher is not None else 0,
+        )
+        yield GaugeMetricFamily(
+            f'{METRICS_PREFIX}_spool_bytes',
+            'Bytes held in the spool',
+            value=stats['spool_bytes'],
+        )
+        yield GaugeMetricFamily(
+            f'{METRICS_PREFIX}_series_tracked',
+            'Series whose previous value is remembered',
+            value=stats['series_tracked'],
+        )
+        yield GaugeMetricFamily(
+            f'{METRICS_PREFIX}_endpoints_ejected',
+            'Output endpoints out of rotation after repeated failures',
+            value=stats['endpoints_ejected'],
+        )
+        yield GaugeMetricFamily(
+            f'{METRICS_PREFIX}_breakers_open',
+            'Targets not scraped after repeated failures until their next probe',
+            value=stats['breakers_open'],
+        )
+
+
+# Values of the outcome label of the per-scrape histograms.
+SCRAPE_OUTCOMES = ('success', 'timeout', 'failure')
+
+
+def scrape_outcome(error: Exception) -> str:
+    """'timeout' for a scrape that timed out, however requests reported it, else 'failure'."""
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    # A timeout while streaming the body surfaces as a ConnectionError.
+    if isinstance(error, requests.ConnectionError) and error.args and isinstance(error.args[0], ReadTimeoutError):
+        return 'timeout'
+    return 'failure'
+
+
+class ForwarderMetrics:
+    """Self-instrumentation of the forwarder, served on ``/metrics``.
+
+    The histograms are observed once per scrape or per POST, never per
+    sample, so they are always kept; the HTTP server only starts when
+    ``--metrics-port`` is given. Per-scrape histograms carry an ``outcome``
+    label so that slow failures and timeouts are counted, and a target's
+    label sets are removed when it leaves the target list.
+    """
+
+    def __init__(self, forwarder: PrometheusToLogstash) -> None:
+        self.registry = CollectorRegistry()
+        stage_labels = ['host', 'module', 'outcome']
+        self.scrape_duration = Histogram(
+            f'{METRICS_PREFIX}_scrape_duration_seconds',
+            'Time spent fetching an exposition from snmp_exporter',
+            stage_labels,
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.slot_wait_duration = Histogram(
+            f'{METRICS_PREFIX}_host_slot_wait_seconds',
+            'Time spent waiting for another scrape of the same host to finish',
+            stage_labels,
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.parse_duration = Histogram(
+            f'{METRICS_PREFIX}_parse_duration_seconds',
+            'Time spent parsing an exposition',
+            stage_labels,
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.serialize_duration = Histogram(
+            f'{METRICS_PREFIX}_serialize_duration_seconds',
+            'Time spent turning the samples of a scrape into documents',
+            stage_labels,
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.queue_wait_duration = Histogram(
+            f'{METRICS_PREFIX}_queue_wait_seconds',
+            'Time a scrape spent blocked on a full sender queue',
+            stage_labels,
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.post_duration = Histogram(
+            f'{METRICS_PREFIX}_post_duration_seconds',
+            'Latency of POST requests to Logstash',
+            ['outcome'],
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.post_documents = Histogram(
+            f'{METRICS_PREFIX}_post_documents',
+            'Documents per POST request to Logstash',
+            buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+            registry=self.registry,
+        )
+        self.post_bytes = Histogram(
+            f'{METRICS_PREFIX}_post_bytes',
+            'Body size of POST requests to Logstash',
+            buckets=tuple(1024 * 4 ** exponent for exponent in range(8)),
+            registry=self.registry,
+        )
+        self.registry.register(_ForwarderStatsCollector(forwarder))
+
+    def observe_scrape(
+        self,
+        target_info: Target,
+        stats: TargetStats,
+        elapsed: float,
+        queue_wait: float,
+        outcome: str = 'success',
+    ) -> None:
+        labels = (target_info.host, target_info.module, outcome)
+        self.scrape_duration.labels(*labels).observe(stats.last_latency)
+        self.slot_wait_duration.labels(*labels).observe(stats.last_slot_wait)
+        self.parse_duration.labels(*labels).observe(stats.last_parse_time)
+        self.queue_wait_duration.labels(*labels).observe(queue_wait)
+        # Whatever is left of the scrape was spent building documents.
+        serialize = (
+            elapsed - stats.last_slot_wait - stats.last_latency
+            - stats.last_parse_time - queue_wait
+        )
+        self.serialize_duration.labels(*labels).observe(max(0.0, serialize))
+
+    def forget(self, target_info: Target) -> None:
+        """Drop the label sets of a target that is no longer scraped."""
+        for histogram in (
+            self.scrape_duration,
+            self.slot_wait_duration,
+            self.parse_duration,
+            self.serialize_duration,
+            self.queue_wait_duration,
+        ):
+            for outcome in SCRAPE_OUTCOMES:
+                try:
+                    histogram.remove(
+                        target_info.host,
+                        target_info.module,
+                        outcome,
+                    )
+                except KeyError:
+                    pass
+
+    def observe_post(self, documents: int, size: int, duration: float, ok: bool) -> None:
+        self.post_duration.labels(
+            'success' if ok else 'failure',
+        ).observe(duration)
+        self.post_documents.observe(documents)
+        self.post_bytes.observe(size)
+
+    def serve(self, port: int, address: str = '') -> None:
+        start_http_server(port, addr=address, registry=self.registry)
+
+
+# From Python 3.12 cProfile hooks sys.monitoring, which covers every thread
+# and accepts a single profiler at a time; before that a profiler only sees
+# the thread that enabled it.
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+# Stages of a scrape in the order they happen, followed by the sender's.
+PROFILE_STAGES = (
+    'slot_wait', 'fetch', 'read', 'parse',
+    'serialize', 'queue_wait', 'send',
+)
+
+
+class ScrapeTrace:
+    """Wall and CPU time per stage of one profiled scrape (or sender step).
+
+    Every stage span is also kept as an event for the Chrome trace. CPU time
+    comes from ``time.thread_time()``, so it only covers the calling thread.
+    """
+
+    __slots__ = ('target', 'thread', 'start', 'stages', 'events', 'profile')
+
+    def __init__(self, target: str, profile: cProfile.Profile | None = None) -> None:
+        self.target = target
+        self.thread = threading.current_thread()
+        self.start = time.monotonic()
+        self.stages: dict[str, list[float]] = {}
+        self.events: list[tuple[str, float, float]] = []
+        self.profile = profile
+
+    def add(self, stage: str, start: float, wall: float, cpu: float) -> None:
+        totals = self.stages.get(stage)
+        if totals is None:
+            totals = self.stages[stage] = [0.0, 0.0]
+        totals[0] += wall
+        totals[1] += cpu
+        self.events.append((stage, start, wall))
+
+
+class CycleProfiler:
+    """Per-stage timings of the next ``cycles`` forwarder cycles.
+
+    A cycle ends once every target has finished a scrape since it began or
+    been skipped (its circuit is open or its last scrape is still running),
+    or after ``max_seconds`` so that targets on long intervals do not hold
+    it open. Each finished cycle is logged as a table of wall and CPU time per target
+    and stage; when the last one ends, the merged cProfile statistics and a
+    Chrome trace (``chrome://tracing`` or Perfetto) are written if paths for
+    them were given. Sender work is charged to the cycle in progress.
+
+    Where profilers are process-wide, a single one runs from the first
+    profiled scrape until the last cycle ends; otherwise every scrape is
+    profiled on its own thread and the statistics are merged.
+    """
+
+    def __init__(
+        self,
+        cycles: int,
+        targets: list[str],
+        pstats_path: str | None = None,
+        trace_path: str | None = None,
+        max_seconds: float | None = None,
+    ) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.cycles = cycles
+        self.targets = set(targets)
+        self.pstats_path = pstats_path
+        self.trace_path = trace_path
+        self.max_seconds = max_seconds
+        self.active = cycles > 0
+        self.completed = 0
+        self._lock = threading.Lock()
+        self._pending = set(self.targets)
+        self._cycle_start: float | None = None
+        self._totals: dict[tuple[str, str], list[float]] = {}
+        self._events: list[dict[str, Any]] = []
+        self._threads: dict[int, str] = {}
+        self._stats: pstats.Stats | None = None
+        self._profile: cProfile.Profile | None = None
+
+    def set_targets(self, targets: list[str]) -> None:
+        """Follow a reload of the targets file."""
+        with self._lock:
+            added = set(targets) - self.targets
+            self.targets = set(targets)
+            self._pending = (self._pending & self.targets) | added
+
+    def begin(self, target: str) -> ScrapeTrace | None:
+        """Start tracing a scrape of ``target``; ``None`` once profiling is over."""
+        if not self.active:
+            return None
+        profile = None
+        if self.pstats_path and not PROCESS_WIDE_PROFILER:
+            profile = self._enable_profile()
+        trace = ScrapeTrace(target, profile)
+        with self._lock:
+            if self.pstats_path and PROCESS_WIDE_PROFILER and self._profile is None and self.active:
+                self._profile = self._enable_profile()
+            if self._cycle_start is None:
+                self._cycle_start = trace.start
+        return trace
+
+    def _enable_profile(self) -> cProfile.Profile | None:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiler or debugger holds the hook; keep the stage timings.
+            self.logger.warning(
+                f'Cannot enable cProfile, writing stage timings only: {str(e)}',
+            )
+            self.pstats_path = None
+            return None
+        return profile
+
+    def _add_profile(self, profile: cProfile.Profile) -> None:
+        if self._stats is None:
+            self._stats = pstats.Stats(profile)
+        else:
+            self._stats.add(profile)
+
+    def finish(self, trace: ScrapeTrace, scrape: bool = True) -> None:
+        """Fold a finished trace into the current cycle.
+
+        Sender steps pass ``scrape=False`` so that they do not count towards
+        completing the cycle.
+        """
+        if trace.profile is not None:
+            trace.profile.disable()
+        with self._lock:
+            if not self.active:
+                return
+            if trace.profile is not None:
+                self._add_profile(trace.profile)
+            for stage, (wall, cpu) in trace.stages.items():
+                totals = self._totals.get((trace.target, stage))
+                if totals is None:
+                    totals = self._totals[(trace.target, stage)] = [0.0, 0.0]
+                totals[0] += wall
+                totals[1] += cpu
+            if self.trace_path:
+                self._add_events(trace)
+            if scrape:
+                self._pending.discard(trace.target)
+            if not self._pending or self._overdue():
+                self._end_cycle()
+
+    def skip(self, target: str) -> None:
+        """Stop waiting for a target that will not be scraped this cycle."""
+        with self._lock:
+            if not self.active or self._cycle_start is None:
+                return
+            self._pending.discard(target)
+            if not self._pending or self._overdue():
+                self._end_cycle()
+
+    def _overdue(self) -> bool:
+        return (
+            self.max_seconds is not None
+            and self._cycle_start is not None
+            and time.monotonic() - self._cycle_start >= self.max_seconds
+        )
+
+    def _add_events(self, trace: ScrapeTrace) -> None:
+        pid = os.getpid()
+        tid = trace.thread.ident
+        self._threads[tid] = trace.thread.name
+        for stage, start, wall in trace.events:
+            self._events.append({
+                'name': stage,
+                'cat': trace.target,
+                'ph': 'X',
+                'ts': round(start * 1e6),
+                'dur': round(wall * 1e6),
+                'pid': pid,
+                'tid': tid,
+            })
+        if trace.target != 'sender':
+            self._events.append({
+                'name': trace.target,
+                'cat': 'scrape',
+                'ph': 'X',
+                'ts': round(trace.start * 1e6),
+                'dur': round((time.monotonic() - trace.start) * 1e6),
+                'pid': pid,
+                'tid': tid,
+            })
+
+    def _end_cycle(self) -> None:
+        self.completed += 1
+        elapsed = time.monotonic() - self._cycle_start
+        lines = [
+            f'Profiled cycle {self.completed}/{self.cycles} took {elapsed:.3f}s',
+            f"  {'target':<40} {'stage':<12} {'wall':>10} {'cpu':>10}",
+        ]
+        order = {
+            stage: position
+            for position, stage in enumerate(PROFILE_STAGES)
+        }
+        for (target, stage), (wall, cpu) in sorted(
+            self._totals.items(),
+            key=lambda item: (item[0][0], order.get(item[0][1], len(order))),
+        ):
+            lines.append(
+                f'  {target:<40} {stage:<12} {wall:>9.4f}s {cpu:>9.4f}s',
+            )
+        if self._pending:
+            lines.append(
+                f'  {len(self._pending)} targets did not finish a scrape '
+                f'within {self.max_seconds:g}s',
+            )
+        self.logger.info('\n'.join(lines))
+
+        self._totals = {}
+        self._pending = set(self.targets)
+        self._cycle_start = None
+        if self.completed >= self.cycles:
+            self.active = False
+            if self._profile is not None:
+                self._profile.disable()
+                self._add_profile(self._profile)
+                self._profile = None
+            self._write()
+
+    def _write(self) -> None:
+        if self.pstats_path and self._stats is not None:
+            try:
+                self._stats.dump_stats(self.pstats_path)
+                self.logger.info(
+                    f'Wrote cProfile statistics to {self.pstats_path}',
+                )
+            except OSError as e:
+                self.logger.error(
+                    f'Failed to write cProfile statistics: {str(e)}',
+                )
+        if self.trace_path:
+            metadata = [
+                {
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {'name': name},
+                }
+                for tid, name in self._threads.items()
+            ]
+            try:
+                with open(self.trace_path, 'w') as f:
+                    json.dump(
+                        {
+                            'traceEvents': metadata + self._events,
+                            'displayTimeUnit': 'ms',
+                        },
+                        f,
+                    )
+                self.logger.info(f'Wrote Chrome trace to {self.trace_path}')
+            except OSError as e:
+                self.logger.error(f'Failed to write Chrome trace: {str(e)}')
+        self._events = []
+        self._stats = None
+
+
+class PrometheusToLogstash:
+    def __init__(self, config: dict[str, Any]):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.hostname = socket.gethostname()
+        self.agent_name = platform.node()
+        self.templates: dict[str, DocumentTemplate] = {}
+        self.serializer = get_serializer(config.get('serializer', 'auto'))
+        self._targets_stamp: tuple[int, int, int] | None = None
+        file_targets: dict[str, Target] = {}
+        if config.get('targets_file'):
+            self._targets_stamp = self._stamp(config['targets_file'])
+            file_targets = self.read_targets_file()
+        self.prometheus_collector = PrometheusCollector(
+            url=config['prometheus_url'],
+            targets=config['targets'] or list(file_targets),
+            timeout=config['timeout'],
+            concurrency=config.get('concurrency', 8),
+            per_host_concurrency=config.get('per_host_concurrency', 1),
+            filters=(
+                load_filter_file(config['filter_file'])
+                if config.get('filter_file') else None
+            ),
+            timeout_factor=config.get('timeout_factor', 3.0),
+            min_timeout=config.get('min_timeout', 1.0),
+            breaker_failures=config.get('breaker_failures', 5),
+            breaker_backoff=config.get('breaker_backoff', 60.0),
+            breaker_max_backoff=config.get('breaker_max_backoff', 3600.0),
+        )
+        self.prometheus_collector.target_info.update(file_targets)
+        self.metrics_collected = 0
+        self.metrics_sent = 0
+        self.metrics_spooled = 0
+        self.metrics_unchanged = 0
+        self.metrics_filtered = 0
+        self.errors = 0
+        # Kept for delta mode, where unchanged samples are not shipped except
+        # in a full keyframe every keyframe_interval scrapes, and for counter
+        # rates, which need each series' previous reading.
+        self.series_index: SeriesIndex | None = None
+        self._counter32_pattern = _alternation(
+            config.get('counter32', DEFAULT_COUNTER32_PATTERNS),
+        )
+        self._counter32: dict[str, bool] = {}
+        if config.get('delta') or config.get('rates'):
+            self.series_index = SeriesIndex(
+                max_series=config.get('max_series', 1000000),
+                stale_scrapes=config.get('stale_scrapes', 5),
+            )
+        # Series state is saved per shard so delta and rate state survive a
+        # restart; see load_state().
+        self.state_path: str | None = None
+        if config.get('state_dir') and self.series_index is not None:
+            self.state_path = os.path.join(
+                config['state_dir'], f"shard-{config.get('shard', 0)}.state",
+            )
+            self.load_state()
+        self._counter_lock = threading.Lock()
+        self.spool: DiskSpool | None = None
+        self._replayer: threading.Thread | None = None
+        # Cleared while Logstash is failing or the spool still holds a
+        # backlog; new bodies then go straight to the spool so that they are
+        # replayed after the older ones instead of timing out one by one.
+        self.logstash_available = threading.Event()
+        self.logstash_available.set()
+        if config.get('spool_dir'):
+            self.spool = DiskSpool(
+                config['spool_dir'],
+                max_bytes=config.get('spool_max_bytes', 1024 * 1024 * 1024),
+                max_age=config.get('spool_max_age', 7 * 24 * 3600),
+            )
+            if not self.spool.empty():
+                self.logstash_available.clear()
+        self.metrics = ForwarderMetrics(self)
+        compressor = None
+        if config.get('compression', 'none') != 'none':
+            compressor = Compressor(
+                config['compression'], config.get('compression_level'),
+            )
+        # Up to sender_concurrency bodies are posted at once; one more
+        # connection per endpoint is left for the spool replayer.
+        self.sender_concurrency = config.get('sender_concurrency', 1)
+        output_options = {
+            'compressor': compressor,
+            'balance': config.get('endpoint_balance', 'round-robin'),
+            'eject_after': config.get('endpoint_eject_after', 3),
+            'eject_seconds': config.get('endpoint_eject_seconds', 30.0),
+            'pool_size': self.sender_concurrency + 1,
+        }
+        self.output: LogstashOutput | OpenSearchOutput
+        if config.get('output', 'logstash') == 'opensearch':
+            urls = config['opensearch_url']
+            auth = None
+            if config.get('opensearch_username'):
+                auth = (
+                    config['opensearch_username'],
+                    config.get('opensearch_password') or '',
+                )
+            self.output = OpenSearchOutput(
+                [urls] if isinstance(urls, str) else urls,
+                config['timeout'],
+                self.metrics,
+                data_stream=config.get(
+                    'opensearch_data_stream', 'metrics-prometheus-default',
+                ),
+                max_retries=config.get('opensearch_max_retries', 3),
+                auth=auth,
+                **output_options,
+            )
+        else:
+            urls = config['logstash_url']
+            self.output = LogstashOutput(
+                [urls] if isinstance(urls, str) else urls,
+                config['timeout'],
+                self.metrics,
+                batch_format=config.get('batch_format', 'ndjson'),
+                **output_options,
+            )
+        self._post_slots = threading.BoundedSemaphore(self.sender_concurrency)
+        self._post_executor: ThreadPoolExecutor | None = None
+        if self.sender_concurrency > 1:
+            self._post_executor = ThreadPoolExecutor(
+                max_workers=self.sender_concurrency,
+                thread_name_prefix='post',
+            )
+        self.batcher: LogstashBatcher | None = None
+        if config.get('send_mode', 'batch') == 'batch':
+            self.batcher = LogstashBatcher(
+                post=self.dispatch_post,
+                batch_format=self.output.batch_format,
+                max_docs=config.get('batch_max_docs', 500),
+                max_bytes=config.get('batch_max_bytes', 1024 * 1024),
+                linger=config.get('batch_linger', 1.0),
+            )
+        # Bounded so that a slow Logstash blocks the scrape workers instead of
+        # letting documents pile up in memory.
+        self.queue: queue.Queue = queue.Queue(
+            maxsize=max(1, config.get('max_in_flight', 20000) // CHUNK_SIZE),
+        )
+        self._sender: threading.Thread | None = None
+        self._stop = threading.Event()
+        self.scheduler: Scheduler | None = None
+        self.cycle_overruns = 0
+        # Called with every stats() snapshot that is logged; the supervisor
+        # uses it to collect its workers' stats.
+        self.stats_reporter: Callable[[dict[str, Any]], None] | None = None
+        self.profiler: CycleProfiler | None = None
+        if config.get('profile_cycles'):
+            self.profiler = CycleProfiler(
+                config['profile_cycles'],
+                self.prometheus_collector.targets,
+                pstats_path=config.get('profile_pstats'),
+                trace_path=config.get('profile_trace'),
+                max_seconds=config['interval'],
+            )
+
+    @staticmethod
+    def _stamp(path: str) -> tuple[int, int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def read_targets_file(self) -> dict[str, Target]:
+        """Targets from ``--targets-file``, limited to this worker's shard under a supervisor."""
+        targets = load_targets_file(self.config['targets_file'])
+        workers = self.config.get('workers', 1)
+        if workers > 1:
+            ring = HashRing(workers)
+            shard = self.config.get('shard', 0)
+            targets = {
+                key: target
+                for key, target in targets.items()
+                if ring.shard(target.host) == shard
+            }
+        return targets
+
+    def reload_targets(self) -> None:
+        """Re-read the targets file if it changed since it was last read."""
+        path = self.config['targets_file']
+        try:
+            stamp = self._stamp(path)
+        except OSError as e:
+            self.logger.error(f'Cannot read targets file {path}: {str(e)}')
+            return
+        if stamp == self._targets_stamp:
+            return
+        self._targets_stamp = stamp
+        try:
+            targets = self.read_targets_file()
+        except Exception as e:
+            self.logger.error(
+                f'Ignoring invalid targets file {path}: {str(e)}',
+            )
+            return
+        self.apply_targets(targets)
+
+    def apply_targets(self, targets: dict[str, Target]) -> None:
+        """Bring the running target set in line with ``targets``.
+
+        Added targets are scheduled, removed ones stop being scheduled and
+        their state is dropped once any scrape in flight has finished, and
+        targets whose interval or labels changed are updated in place. The
+        others, and their delta and rate state, are left alone.
+        """
+        collector = self.prometheus_collector
+        current = set(collector.targets)
+        removed = [
+            target for target in collector.targets if target not in targets
+        ]
+        added = [target for target in targets if target not in current]
+        changed = [
+            target
+            for target in targets
+            if target in current and collector.target_info.get(target) != targets[target]
+        ]
+
+        for target in removed:
+            collector.remove_target(target)
+            entry = (
+                self.scheduler.remove(target)
+                if self.scheduler is not None else None
+            )
+            if entry is None or not entry.running:
+                self.forget_target(target)
+            # Otherwise _run_scheduled() forgets it when the scrape ends.
+        for target in changed:
+            collector.target_info[target] = targets[target]
+            self.templates.pop(target, None)
+            if self.scheduler is not None:
+                self.scheduler.reschedule(target, self.target_interval(target))
+        for target in added:
+            collector.add_target(target, targets[target])
+            if self.scheduler is not None:
+                self.scheduler.add(target, self.target_interval(target))
+        if self.profiler is not None:
+            self.profiler.set_targets(collector.targets)
+
+        if removed or added or changed:
+            self.logger.info(
+                f'Targets reloaded: {len(added)} added, {len(removed)} removed, '
+                f'{len(changed)} changed, {len(collector.targets)} in total',
+            )
+
+    def forget_target(self, target: str) -> None:
+        target_info = self.prometheus_collector.parse_target(target)
+        self.templates.pop(target, None)
+        self.prometheus_collector.forget_target(target)
+        # Another target may scrape the same host and module with other credentials.
+        if not any(
+            (info.host, info.module) == (target_info.host, target_info.module)
+            for info in map(self.prometheus_collector.parse_target, self.prometheus_collector.targets)
+        ):
+            self.metrics.forget(target_info)
+        if self.series_index is not None:
+            self.series_index.drop_target(target)
+
+    def load_state(self) -> None:
+        """Restore the series state of this forwarder's targets.
+
+        Every shard's file in the state directory is read, oldest first, so
+        targets that moved here after a change of ``--workers`` keep their
+        state as well.
+        """
+        directory = self.config['state_dir']
+        try:
+            paths = [
+                os.path.join(directory, name)
+                for name in os.listdir(directory)
+                if name.endswith('.state')
+            ]
+        except FileNotFoundError:
+            return
+        targets = set(self.prometheus_collector.targets)
+        for path in sorted(paths, key=os.path.getmtime):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                self.logger.warning(
+                    f'Ignoring unreadable state file {path}: {str(e)}',
+                )
+                continue
+            self.series_index.restore(state, targets)
+        if len(self.series_index):
+            self.logger.info(
+                f'Restored {len(self.series_index)} series from {directory}',
+            )
+
+    def save_state(self) -> None:
+        if self.state_path is None:
+            return
+        temporary = self.state_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(temporary, 'w') as f:
+                json.dump(self.series_index.export(), f)
+            os.replace(temporary, self.state_path)
+        except OSError as e:
+            self.logger.error(f'Failed to save series state: {str(e)}')
+
+    def dispatch_post(self, payload: bytes, content_type: str, count: int) -> None:
+        """Hand a body to a post worker, or post it inline without sender concurrency."""
+        if self._post_executor is None:
+            self.post_to_logstash(payload, content_type, count)
+            return
+        # Blocks while every post worker is busy, which keeps the sender, and
+        # through its queue the scrapers, to the rate Logstash accepts.
+        self._post_slots.acquire()
+        future = self._post_executor.submit(
+            self.post_to_logstash, payload, content_type, count,
+        )
+        future.add_done_callback(lambda _: self._post_slots.release())
+
+    def _wait_for_posts(self) -> None:
+        if self._post_executor is None:
+            return
+        for _ in range(self.sender_concurrency):
+            self._post_slots.acquire()
+        for _ in range(self.sender_concurrency):
+            self._post_slots.release()
+
+    def _count(
+        self,
+        sent: int = 0,
+        spooled: int = 0,
+        errors: int = 0,
+        unchanged: int = 0,
+        filtered: int = 0,
+    ) -> None:
+        with self._counter_lock:
+            self.metrics_sent += sent
+            self.metrics_spooled += spooled
+            self.metrics_unchanged += unchanged
+            self.metrics_filtered += filtered
+            self.errors += errors
+
+    def post_to_logstash(self, payload: bytes, content_type: str, count: int) -> bool:
+        """Send an encoded body holding ``count`` documents to the output.
+
+        With a spool configured, documents that cannot be delivered are
+        written to it for the replayer instead of being dropped.
+        """
+        if self.spool is None or self.logstash_available.is_set():
+            delivery = self.output.send(payload, content_type, count)
+            self._count(sent=delivery.sent, errors=delivery.rejected)
+            if not delivery.pending_count:
+                return True
+            payload, content_type, count = delivery.pending, delivery.content_type, delivery.pending_count
+            if self.spool is None:
+                self._count(errors=count)
+                return False
+            self.logger.warning(
+                f'{self.output.name} unavailable, spooling documents to disk',
+            )
+            self.logstash_available.clear()
+
+        try:
+            self.spool.append(payload, content_type, count)
+        except Exception as e:
+            self.logger.error(f'Failed to spool data: {str(e)}')
+            self._count(errors=count)
+            return False
+        self._count(spooled=count)
+        return False
+
+    def _replay_loop(self) -> None:
+        """Drain the spool in order once the output accepts requests again.
+
+        The first record the output accepts switches live batches back to
+        direct delivery; only the backlog is held to the replay rate.
+        """
+        rate = self.config.get('spool_replay_rate', 5000)
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                record = self.spool.peek()
+            except Exception as e:
+                self.logger.error(f'Failed to read spool: {str(e)}')
+                self._stop.wait(backoff)
+                continue
+
+            if record is None:
+                if not self.logstash_available.is_set():
+                    self.logger.info('Spool drained, resuming direct delivery')
+                    self.logstash_available.set()
+                self._stop.wait(1.0)
+                continue
+
+            delivery = self.output.send(
+                record.body, record.content_type, record.count,
+            )
+            self._count(sent=delivery.sent, errors=delivery.rejected)
+            if delivery.pending_count == record.count:
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+                continue
+
+            backoff = 1.0
+            if not self.logstash_available.is_set():
+                self.logger.info(
+                    f'{self.output.name} is back, resuming direct delivery',
+                )
+                self.logstash_available.set()
+            if delivery.pending_count:
+                # Part of the body was accepted; only the rest goes back,
+                # at the tail, so accepted documents are not sent twice.
+                self.spool.append(
+                    delivery.pending, delivery.content_type, delivery.pending_count,
+                )
+            self.spool.commit(record)
+            # Replay at a bounded rate so a large backlog does not swamp
+            # Logstash the moment it comes back.
+            self._stop.wait(record.count / rate)
+
+    def start_replayer(self) -> None:
+        if self.spool is None or (self._replayer is not None and self._replayer.is_alive()):
+            return
+        self._replayer = threading.Thread(
+            target=self._replay_loop,
+            name='replayer',
+            daemon=True,
+        )
+        self._replayer.start()
+
+    def template_for(self, target: str) -> DocumentTemplate:
+        template = self.templates.get(target)
+        if template is None:
+            template = self.templates[target] = DocumentTemplate(
+                self.hostname,
+                self.agent_name,
+                self.prometheus_collector.parse_target(target),
+                dumps=self.serializer.dumps,
+            )
+        return template
+
+    def is_counter32(self, name: str) -> bool:
+        counter32 = self._counter32.get(name)
+        if counter32 is None:
+            pattern = self._counter32_pattern
+            counter32 = self._counter32[name] = (
+                pattern is not None and pattern.fullmatch(name) is not None
+            )
+        return counter32
+
+    def scrape_target(self, target: str) -> None:
+        """Scrape one target, handing its documents to the sender as they are built.
+
+        ``queue.put`` blocks while the sender is behind, which throttles the
+        scrape workers to the rate Logstash accepts documents.
+        """
+        trace = (
+            self.profiler.begin(target) if self.profiler is not None else None
+        )
+        try:
+            self._scrape_target(target, trace)
+        finally:
+            if trace is not None:
+                self.profiler.finish(trace)
+
+    def _scrape_target(self, target: str, trace: ScrapeTrace | None) -> None:
+        start = time.monotonic()
+        if trace is not None:
+            cpu_start = time.thread_time()
+        queue_wait = 0.0
+        template = self.template_for(target)
+        index = self.series_index
+        delta = self.config.get('delta', False)
+        counters = (
+            self.prometheus_collector.counter_names
+            if self.config.get('rates') else ()
+        )
+        keyframe = True
+        rate = None
+        if index is not None:
+            scrape, series = index.begin_scrape(target)
+            if delta:
+                keyframe_interval = self.config.get('keyframe_interval', 10)
+                keyframe = (scrape - 1) % keyframe_interval == 0
+        unchanged = 0
+        chunk: list[bytes] = []
+        outcome = 'failure'
+        try:
+            for batch in self.prometheus_collector.iter_batches(target, trace):
+                if index is None:
+                    chunk += template.render_batch(batch)
+                else:
+                    table = batch.table
+                    timestamp = batch.timestamp
+                    for series_id, value in zip(batch.ids, batch.values):
+                        name = table.names[series_id]
+                        counter = name in counters
+                        changed, rate = index.update(
+                            series,
+                            table.index_key(series_id),
+                            value,
+                            timestamp,
+                            scrape,
+                            counter,
+                            counter and self.is_counter32(name),
+                        )
+                        if not changed and not keyframe:
+                            unchanged += 1
+                            continue
+                        chunk.append(
+                            template.render_series(
+                                table, series_id, value, timestamp, rate,
+                            ),
+                        )
+                while len(chunk) >= CHUNK_SIZE:
+                    put_start = time.monotonic()
+                    self.queue.put(chunk[:CHUNK_SIZE])
+                    queue_wait += time.monotonic() - put_start
+                    if trace is not None:
+                        trace.add(
+                            'queue_wait', put_start,
+                            time.monotonic() - put_start, 0.0,
+                        )
+                    del chunk[:CHUNK_SIZE]
+            outcome = 'success'
+        except Exception as e:
+            outcome = scrape_outcome(e)
+            raise
+        finally:
+            # Rendered documents are queued even if the scrape fails partway:
+            # their values are already in the series index, so dropping them
+            # would hide those changes in delta mode until the next keyframe.
+            if chunk:
+                put_start = time.monotonic()
+                self.queue.put(chunk)
+                queue_wait += time.monotonic() - put_start
+                if trace is not None:
+                    trace.add(
+                        'queue_wait', put_start,
+                        time.monotonic() - put_start, 0.0,
+                    )
+            # Failed and timed-out scrapes are observed too, under their outcome.
+            elapsed = time.monotonic() - start
+            target_stats = self.prometheus_collector.target_stats.get(target)
+            if target_stats is not None:
+                self.metrics.observe_scrape(
+                    self.prometheus_collector.parse_target(target),
+                    target_stats,
+                    elapsed,
+                    queue_wait,
+                    outcome,
+                )
+        if index is not None:
+            index.end_scrape(target)
+        self._count(
+            unchanged=unchanged,
+            filtered=target_stats.last_filtered if target_stats else 0,
+        )
+        if trace is not None:
+            # As in the metrics, serializing is what the other stages leave.
+            other_wall = sum(wall for wall, cpu in trace.stages.values())
+            other_cpu = sum(cpu for wall, cpu in trace.stages.values())
+            trace.stages['serialize'] = [
+                max(0.0, elapsed - other_wall),
+                max(0.0, time.thread_time() - cpu_start - other_cpu),
+            ]
+
+    def start_sender(self) -> None:
+        if self._sender is not None and self._sender.is_alive():
+            return
+        self._sender = threading.Thread(
+            target=self._sender_loop,
+            name='sender',
+            daemon=True,
+        )
+        self._sender.start()
 
-    logging.basicConfig(
-        level=numeric_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    )
+    def _sender_loop(self) -> None:
+        while True:
+            timeout = None
+            if self.batcher is not None:
+                timeout = self.batcher.time_until_due()
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.batcher.flush()
+                continue
 
+            trace = None
+            if self.profiler is not None and isinstance(item, list):
+                trace = self.profiler.begin('sender')
+                if trace is not None:
+                    send_start = time.monotonic()
+                    cpu_start = time.thread_time()
+            try:
+                if item is _STOP:
+                    if self.batcher is not None:
+                        self.batcher.flush()
+                    self._wait_for_posts()
+                    return
+                elif item is _FLUSH:
+                    if self.batcher is not None:
+                        self.batcher.flush()
+                    self._wait_for_posts()
+                elif self.batcher is not None:
+                    self.metrics_collected += len(item)
+                    for document in item:
+                        self.batcher.add(document)
+                else:
+                    self.metrics_collected += len(item)
+                    for document in item:
+                        self.logger.debug(
+                            'Sending metric to Logstash: %s',
+                            _LazyJSON(document),
+                        )
+                        self.dispatch_post(document, 'application/json', 1)
+            except Exception as e:
+                self.logger.error(
+                    f'Error sending documents to Logstash: {str(e)}',
+                )
+            finally:
+                if trace is not None:
+                    trace.add(
+                        'send',
+                        send_start,
+                        time.monotonic() - send_start,
+                        time.thread_time() - cpu_start,
+                    )
+                    self.profiler.finish(trace, scrape=False)
+                self.queue.task_done()
 
-class PrometheusCollector:
-    def __init__(self, url: str, targets: list[str], timeout: int = 10):
-        self.base_url = url
-        self.targets = targets
-        self.timeout = timeout
-        self.logger = logging.getLogger(__name__)
+    def flush(self) -> None:
+        """Block until every queued document has been handed to Logstash."""
+        self.queue.put(_FLUSH)
+        self.queue.join()
 
-    def parse_target(self, target: str) -> dict[str, str]:
-        """Parse target string into components."""
-        parts = target.split('&')
-        result = {
-            'host': parts[0],  # The IP/hostname is always the first part
-            'auth': '',
-            'module': '',
-        }
+    def close(self) -> None:
+        # Scrapes already handed to the executor still queue their documents;
+        # let them finish while the sender is there to take them. Scrapes
+        # that have not started yet are dropped.
+        self.prometheus_collector.executor.shutdown(
+            wait=True, cancel_futures=True,
+        )
+        if self._sender is not None and self._sender.is_alive():
+            self.queue.put(_STOP)
+            self._sender.join()
+        if self._post_executor is not None:
+            self._post_executor.shutdown()
+        self._stop.set()
+        if self._replayer is not None:
+            self._replayer.join()
+        if self.spool is not None:
+            self.spool.close()
+        self.save_state()
 
-        for part in parts[1:]:
-            if '=' in part:
-                key, value = part.split('=', 1)
-                result[key] = value
+    def collect_and_send_prometheus_metrics(self) -> None:
+        self.start_sender()
+        self.start_replayer()
+        try:
+            collector = self.prometheus_collector
+            futures = {}
+            for target in collector.targets:
+                if collector.allow(target):
+                    future = collector.executor.submit(
+                        self.scrape_target, target,
+                    )
+                    futures[future] = target
+                elif self.profiler is not None:
+                    self.profiler.skip(target)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(
+                        f'Failed to collect metrics from {futures[future]}: {str(e)}',
+                    )
+
+        except Exception as e:
+            self.logger.error(f'Error collecting Prometheus metrics: {str(e)}')
+            self.errors += 1
 
-        return result
+        self.flush()
 
-    def collect(self) -> list:
-        all_metrics = []
-        for target in self.targets:
-            try:
-                target_info = self.parse_target(target)
-                url = f"{self.base_url}/snmp?target={target_info['host']}&auth={target_info['auth']}&module={target_info['module']}"
-                self.logger.debug(f'Collecting metrics from {url}')
-                response = session.get(url, timeout=self.timeout)
-                response.raise_for_status()
-
-                metrics = []
-                for family in text_string_to_metric_families(response.text):
-                    for sample in family.samples:
-                        metric = {
-                            'name': sample.name,
-                            'labels': sample.labels,
-                            'value': sample.value,
-                            # Milliseconds
-                            'timestamp': int(time.time() * 1000),
-                            'target': target_info['host'],
-                            'tags': {
-                                'auth': target_info['auth'],
-                                'module': target_info['module'].split(',') if target_info['module'] else [],
-                            },
-                        }
-                        metrics.append(metric)
-                all_metrics.extend(metrics)
-                self.logger.debug(
-                    f"Collected {len(metrics)} metrics from {target_info['host']}",
+    def target_interval(self, target: str) -> float:
+        """Interval for a target: its own ``interval=``, else its modules', else ``--interval``."""
+        target_info = self.prometheus_collector.parse_target(target)
+        if target_info.interval:
+            return target_info.interval
+        module_intervals = self.config.get('module_intervals', {})
+        intervals = [
+            module_intervals[module]
+            for module in target_info.modules
+            if module in module_intervals
+        ]
+        if intervals:
+            return min(intervals)
+        return self.config['interval']
+
+    def _run_scheduled(self, entry: ScheduledTarget) -> None:
+        start = time.monotonic()
+        try:
+            self.scrape_target(entry.target)
+        except Exception as e:
+            self.logger.error(
+                f'Failed to collect metrics from {entry.target}: {str(e)}',
+            )
+        finally:
+            entry.last_duration = time.monotonic() - start
+            entry.running = False
+            if entry.removed and entry.target not in self.prometheus_collector.targets:
+                self.forget_target(entry.target)
+            if entry.last_duration > entry.interval:
+                entry.overruns += 1
+                self.cycle_overruns += 1
+                self.logger.warning(
+                    f'Scrape of {entry.target} took {entry.last_duration:.1f}s, '
+                    f'longer than its {entry.interval:g}s interval',
                 )
 
-            except Exception as e:
-                self.logger.error(
-                    f'Failed to collect metrics from {target}: {str(e)}',
+    def dispatch_due(self) -> None:
+        for entry in self.scheduler.pop_due():
+            if entry.running:
+                entry.missed += 1
+                self.logger.warning(
+                    f'Previous scrape of {entry.target} is still running, '
+                    'skipping this deadline',
                 )
+                if self.profiler is not None:
+                    self.profiler.skip(entry.target)
                 continue
+            if not self.prometheus_collector.allow(entry.target):
+                if self.profiler is not None:
+                    self.profiler.skip(entry.target)
+                continue
+            entry.running = True
+            self.prometheus_collector.executor.submit(
+                self._run_scheduled, entry,
+            )
 
-        return all_metrics
+    def stats(self) -> dict[str, Any]:
+        missed = self.scheduler.missed() if self.scheduler is not None else 0
+        return {
+            'metrics_collected': self.metrics_collected,
+            'metrics_sent': self.metrics_sent,
+            'metrics_spooled': self.metrics_spooled,
+            'metrics_unchanged': self.metrics_unchanged,
+            'metrics_filtered': self.metrics_filtered,
+            'series_tracked': len(self.series_index) if self.series_index is not None else 0,
+            'spool_bytes': self.spool.bytes if self.spool is not None else 0,
+            'endpoints_ejected': self.output.endpoints.ejected(),
+            'errors': self.errors,
+            'missed_deadlines': missed,
+            'cycle_overruns': self.cycle_overruns,
+            'breakers_open': self.prometheus_collector.breakers_open(),
+            'breaker_skips': self.prometheus_collector.breaker_skips(),
+        }
 
+    def log_stats(self) -> None:
+        stats = self.stats()
+        self.logger.info(
+            ', '.join(f'{key}={value}' for key, value in stats.items()),
+        )
+        if self.stats_reporter is not None:
+            self.stats_reporter(stats)
 
-class PrometheusToLogstash:
-    def __init__(self, config: dict[str, Any]):
-        self.config = config
-        self.logger = logging.getLogger(__name__)
-        self.hostname = socket.gethostname()
-        self.prometheus_collector = PrometheusCollector(
-            url=config['prometheus_url'],
-            targets=config['targets'],
-            timeout=config['timeout'],
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run(self) -> None:
+        self.logger.info(
+            f'Starting Prometheus to Logstash forwarder (JSON serializer: {self.serializer.name})',
         )
-        self.metrics_collected = 0
-        self.metrics_sent = 0
-        self.errors = 0
 
-    def send_to_logstash(self, data: dict[str, Any]) -> None:
+        if self.config.get('metrics_port'):
+            self.metrics.serve(
+                self.config['metrics_port'],
+                self.config.get('metrics_address', ''),
+            )
+            self.logger.info(
+                f"Serving forwarder metrics on port {self.config['metrics_port']}",
+            )
+
+        self.start_sender()
+        self.start_replayer()
+        self.scheduler = Scheduler(
+            {
+                target: self.target_interval(target)
+                for target in self.prometheus_collector.targets
+            },
+            jitter=self.config.get('jitter', 1.0),
+        )
+        next_stats = time.monotonic() + STATS_INTERVAL
+        state_interval = self.config.get('state_interval', 300)
+        next_state = time.monotonic() + state_interval
+        reload_interval = self.config.get('targets_reload_interval', 10)
+        next_reload = (
+            time.monotonic() + reload_interval
+            if self.config.get('targets_file') else math.inf
+        )
         try:
-            if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
-                # Milliseconds for consistency
-                current_time = int(time.time() * 1000)
-                timestamp_in_data = data.get('@timestamp')
-                self.logger.debug(f'Current Unix time: {current_time}')
-                self.logger.debug(f'Timestamp in data: {timestamp_in_data}')
-                self.logger.debug(
-                    f'Sending metric to Logstash: {json.dumps(data, indent=2)}',
+            while not self._stop.is_set():
+                if time.monotonic() >= next_reload:
+                    self.reload_targets()
+                    next_reload += reload_interval
+                self.dispatch_due()
+                if time.monotonic() >= next_stats:
+                    self.log_stats()
+                    next_stats += STATS_INTERVAL
+                if self.state_path is not None and time.monotonic() >= next_state:
+                    self.save_state()
+                    next_state += state_interval
+                wait = self.scheduler.time_until_next()
+                wait = STATS_INTERVAL if wait is None else wait
+                deadline = min(next_stats, next_reload)
+                self._stop.wait(
+                    min(wait, max(0.0, deadline - time.monotonic())),
                 )
+        finally:
+            self.close()
 
-            payload = json.dumps(data).encode('utf-8')
-            headers = {
-                'Content-Type': 'application/json',
-                'Content-Length': str(len(payload)),
-            }
 
-            req = session.post(
-                self.config['logstash_url'],
-                data=payload,
-                headers=headers,
-                timeout=self.config['timeout'],
+class HashRing:
+    """Consistent hashing of target hosts onto shards.
+
+    Each shard owns ``replicas`` points on the ring, so a host keeps its
+    shard across restarts and only about 1/N of the hosts move when the
+    number of shards changes.
+    """
+
+    def __init__(self, shards: int, replicas: int = 128):
+        points = sorted(
+            (self._hash(f'shard-{shard}-{replica}'), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+    def shard(self, host: str) -> int:
+        position = bisect.bisect(self._points, self._hash(host))
+        return self._shards[position % len(self._points)]
+
+
+def _run_worker(config: dict[str, Any], reports: Any) -> None:
+    forwarder = PrometheusToLogstash(config)
+    forwarder.stats_reporter = lambda stats: reports.put(
+        (config['shard'], stats),
+    )
+    forwarder.run()
+
+
+# Keys of PrometheusToLogstash.stats() that only ever grow over a worker's
+# life. The others are gauges of its current state.
+STATS_COUNTERS = frozenset({
+    'metrics_collected',
+    'metrics_sent',
+    'metrics_spooled',
+    'metrics_unchanged',
+    'metrics_filtered',
+    'errors',
+    'missed_deadlines',
+    'cycle_overruns',
+    'breaker_skips',
+})
+
+
+class Supervisor:
+    """Run the forwarder as ``workers`` processes, each scraping one shard of the targets.
+
+    Targets are sharded by host with a HashRing, so every module of a device
+    is scraped by the same worker. Each worker gets its own spool directory
+    and state file, and metrics port ``--metrics-port`` + shard. Workers
+    that exit are restarted, backing off while they keep failing, and the
+    stats they report are summed and logged by the supervisor.
+    """
+
+    def __init__(self, config: dict[str, Any], workers: int):
+        self.config = config
+        self.workers = workers
+        self.logger = logging.getLogger(__name__)
+        ring = HashRing(workers)
+        self.shards: dict[int, list[str]] = {}
+        if config.get('targets_file'):
+            # Every worker reads the file itself and keeps its own hosts.
+            self.shards = {shard: [] for shard in range(workers)}
+        for target in config['targets']:
+            host = target.split('&', 1)[0]
+            self.shards.setdefault(ring.shard(host), []).append(target)
+        # Forked rather than spawned: the forwarder is a single script that
+        # cannot be imported by name.
+        self.context = multiprocessing.get_context('fork')
+        self.reports = self.context.Queue()
+        self.processes: dict[int, Any] = {}
+        self.started: dict[int, float] = {}
+        self.restart_at: dict[int, float] = {}
+        self.backoff: dict[int, float] = {}
+        self.restarts = 0
+        self.current: dict[int, dict[str, Any]] = {}
+        self.retired: dict[str, int] = {}
+        self._stop = threading.Event()
+
+    def shard_config(self, shard: int) -> dict[str, Any]:
+        config = dict(
+            self.config, shard=shard,
+            workers=self.workers, targets=self.shards[shard],
+        )
+        if config.get('spool_dir'):
+            config['spool_dir'] = os.path.join(
+                config['spool_dir'], f'shard-{shard}',
             )
+        if config.get('metrics_port'):
+            config['metrics_port'] += shard
+        for key in ('profile_pstats', 'profile_trace'):
+            if config.get(key):
+                config[key] = f'{config[key]}.{shard}'
+        return config
 
-            if req.status_code == 200:
-                self.metrics_sent += 1
-                return True
+    def start_worker(self, shard: int) -> None:
+        process = self.context.Process(
+            target=_run_worker,
+            args=(self.shard_config(shard), self.reports),
+            name=f'prometheus-to-logstash-{shard}',
+        )
+        process.start()
+        self.processes[shard] = process
+        self.started[shard] = time.monotonic()
+        if self.config.get('targets_file'):
+            self.logger.info(f'Started worker {shard} (pid {process.pid})')
+        else:
+            self.logger.info(
+                f'Started worker {shard} (pid {process.pid}) for {len(self.shards[shard])} targets',
+            )
+
+    def check_workers(self) -> None:
+        now = time.monotonic()
+        for shard, process in self.processes.items():
+            if shard in self.restart_at or process.is_alive():
+                continue
+            # A worker that ran for a while gets restarted straight away, one
+            # that keeps dying waits longer each time.
+            if now - self.started[shard] > 60:
+                self.backoff[shard] = 1.0
             else:
-                self.logger.warning(
-                    f'Unexpected status code from Logstash: {req.status_code}',
+                self.backoff[shard] = min(
+                    self.backoff.get(shard, 0.5) * 2, 60.0,
                 )
-                self.errors += 1
-                return False
+            self.logger.error(
+                f'Worker {shard} exited with code {process.exitcode}, '
+                f'restarting in {self.backoff[shard]:g}s',
+            )
+            self.retire(shard)
+            self.restart_at[shard] = now + self.backoff[shard]
+        for shard, when in list(self.restart_at.items()):
+            if now >= when:
+                del self.restart_at[shard]
+                self.restarts += 1
+                self.start_worker(shard)
 
-        except Exception as e:
-            self.logger.error(f'Failed to send data to Logstash: {str(e)}')
-            self.errors += 1
-            return False
+    def retire(self, shard: int) -> None:
+        """Fold the counters of a dead worker into the running totals.
 
-    def collect_and_send_prometheus_metrics(self) -> None:
-        try:
-            metrics = self.prometheus_collector.collect()
-            for metric in metrics:
-                self.metrics_collected += 1
-                data = {
-                    '@timestamp': datetime.fromtimestamp(metric['timestamp'] / 1000, tz=timezone.utc).isoformat(),
-                    'agent': {
-                        'hostname': self.hostname,
-                        'name': platform.node(),
-                        'type': 'prometheus-to-logstash',
-                        'version': '1.0.0',
-                    },
-                    'event': {
-                        'module': 'prometheus',
-                        'dataset': 'prometheus.metrics',
-                    },
-                    'prometheus': {
-                        'metric': {
-                            'name': metric['name'],
-                            'labels': metric['labels'],
-                            'value': metric['value'],
-                            'timestamp': metric['timestamp'],
-                            'target': metric['target'],
-                        },
-                        'tags': metric['tags'],
-                    },
-                }
-                self.send_to_logstash(data)
+        Its gauges described only that worker and are dropped with it.
+        """
+        for key, value in self.current.pop(shard, {}).items():
+            if key in STATS_COUNTERS:
+                self.retired[key] = self.retired.get(key, 0) + value
 
-        except Exception as e:
-            self.logger.error(f'Error collecting Prometheus metrics: {str(e)}')
-            self.errors += 1
+    def stats(self) -> dict[str, Any]:
+        totals: dict[str, Any] = {}
+        for stats in list(self.current.values()) + [self.retired]:
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+        totals['workers'] = sum(
+            process.is_alive()
+            for process in self.processes.values()
+        )
+        totals['worker_restarts'] = self.restarts
+        return totals
 
-    def run(self) -> None:
-        self.logger.info('Starting Prometheus to Logstash forwarder')
+    def log_stats(self) -> None:
+        summary = ', '.join(
+            f'{key}={value}' for key, value in self.stats().items()
+        )
+        self.logger.info(f'All workers: {summary}')
 
-        while True:
-            self.collect_and_send_prometheus_metrics()
-            time.sleep(self.config['interval'])
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run(self) -> None:
+        source = (
+            self.config.get('targets_file')
+            or f"{len(self.config['targets'])} targets"
+        )
+        self.logger.info(f'Starting {len(self.shards)} workers for {source}')
+        for shard in sorted(self.shards):
+            self.start_worker(shard)
+        next_stats = time.monotonic() + STATS_INTERVAL
+        try:
+            while not self._stop.is_set():
+                try:
+                    shard, stats = self.reports.get(timeout=1.0)
+                    self.current[shard] = stats
+                except queue.Empty:
+                    pass
+                self.check_workers()
+                if time.monotonic() >= next_stats:
+                    self.log_stats()
+                    next_stats += STATS_INTERVAL
+        finally:
+            for process in self.processes.values():
+                if process.is_alive():
+                    process.terminate()
+            for process in self.processes.values():
+                process.join()
 
 
 def create_parser() -> argparse.ArgumentParser:
@@ -201,22 +3695,110 @@ def create_parser() -> argparse.ArgumentParser:
         required=True,
         help='URL of the Prometheus metrics endpoint (e.g., http://localhost:9116)',
     )
-    parser.add_argument(
+    targets = parser.add_mutually_exclusive_group(required=True)
+    # --target is what the shipped unit passes; it must stay an exact
+    # option now that --targets-file makes it an ambiguous prefix.
+    targets.add_argument(
         '--targets',
-        required=True,
+        '--target',
         nargs='+',
         help='Target devices to monitor (space separated)',
     )
+    targets.add_argument(
+        '--targets-file',
+        help='file_sd-style JSON or YAML file listing the targets, re-read when it changes',
+    )
+    parser.add_argument(
+        '--targets-reload-interval',
+        type=float,
+        default=10,
+        help='Seconds between checks of --targets-file for changes (default: 10)',
+    )
+    parser.add_argument(
+        '--output',
+        default='logstash',
+        choices=['logstash', 'opensearch'],
+        help='Send documents to the Logstash http input or straight to the OpenSearch bulk API (default: logstash)',
+    )
     parser.add_argument(
         '--logstash-url',
-        required=True,
-        help='URL of the Logstash HTTP input plugin',
+        nargs='+',
+        help='URL of the Logstash HTTP input plugin; give several to spread batches across them',
+    )
+    parser.add_argument(
+        '--opensearch-url',
+        nargs='+',
+        help='URL of an OpenSearch node for --output opensearch; give several to spread batches across them',
+    )
+    parser.add_argument(
+        '--opensearch-data-stream',
+        default='metrics-prometheus-default',
+        help='Data stream the documents are written to (default: metrics-prometheus-default)',
+    )
+    parser.add_argument(
+        '--opensearch-username',
+        help='User for HTTP basic authentication; the password is read from OPENSEARCH_PASSWORD',
+    )
+    parser.add_argument(
+        '--opensearch-max-retries',
+        type=int,
+        default=3,
+        help='Times documents refused with a retryable status are sent again (default: 3)',
+    )
+    parser.add_argument(
+        '--endpoint-balance',
+        default='round-robin',
+        choices=['round-robin', 'least-loaded'],
+        help='How requests are spread over several output URLs (default: round-robin)',
+    )
+    parser.add_argument(
+        '--endpoint-eject-after',
+        type=int,
+        default=3,
+        help='Consecutive failures after which an output URL is taken out of rotation (default: 3)',
+    )
+    parser.add_argument(
+        '--endpoint-eject-seconds',
+        type=float,
+        default=30,
+        help='Seconds an ejected output URL stays out of rotation (default: 30)',
+    )
+    parser.add_argument(
+        '--compression',
+        default='none',
+        choices=['none', *sorted(COMPRESSION_LEVELS)],
+        help='Content-Encoding for request bodies; zstd needs the zstandard package (default: none)',
+    )
+    parser.add_argument(
+        '--compression-level',
+        type=int,
+        help='Compression level (default: 6 for gzip, 3 for zstd)',
+    )
+    parser.add_argument(
+        '--sender-concurrency',
+        type=int,
+        default=1,
+        help='Maximum requests to Logstash in flight at once; also sizes the connection pool (default: 1)',
     )
     parser.add_argument(
         '--interval',
         type=int,
         default=60,
-        help='Prometheus scraping interval in seconds (default: 60)',
+        help='Default scraping interval in seconds for targets without their own (default: 60)',
+    )
+    parser.add_argument(
+        '--module-interval',
+        nargs='*',
+        default=[],
+        metavar='MODULE=SECONDS',
+        help='Scraping interval for targets using a module, e.g. apcups=300. '
+        'An interval=SECONDS option on the target itself takes precedence',
+    )
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=1.0,
+        help='Fraction of each interval over which first scrapes are spread (default: 1.0)',
     )
     parser.add_argument(
         '--timeout',
@@ -224,6 +3806,192 @@ def create_parser() -> argparse.ArgumentParser:
         default=10,
         help='HTTP request timeout in seconds (default: 10)',
     )
+    parser.add_argument(
+        '--timeout-factor',
+        type=float,
+        default=3.0,
+        help='Per-target timeout as a multiple of its p99 response time, capped by --timeout; 0 disables (default: 3)',
+    )
+    parser.add_argument(
+        '--min-timeout',
+        type=float,
+        default=1.0,
+        help='Lowest adaptive timeout in seconds (default: 1)',
+    )
+    parser.add_argument(
+        '--breaker-failures',
+        type=int,
+        default=5,
+        help='Consecutive failures after which a target is only probed occasionally; 0 disables (default: 5)',
+    )
+    parser.add_argument(
+        '--breaker-backoff',
+        type=float,
+        default=60,
+        help='Seconds before the first probe of a failing target, doubling after each failed probe (default: 60)',
+    )
+    parser.add_argument(
+        '--breaker-max-backoff',
+        type=float,
+        default=3600,
+        help='Longest wait between probes of a failing target in seconds (default: 3600)',
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='Maximum number of targets scraped at the same time (default: 8)',
+    )
+    parser.add_argument(
+        '--per-host-concurrency',
+        type=int,
+        default=1,
+        help='Maximum concurrent scrapes of the same device (default: 1)',
+    )
+    parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        default=20000,
+        help='Maximum documents queued between the scrapers and the sender (default: 20000)',
+    )
+    parser.add_argument(
+        '--send-mode',
+        default='batch',
+        choices=['batch', 'single'],
+        help='Post documents to Logstash in batches or one per request (default: batch)',
+    )
+    parser.add_argument(
+        '--batch-format',
+        default='ndjson',
+        choices=sorted(BATCH_FORMATS),
+        help='Body format for batches: ndjson (json_lines codec) or a json array (default: ndjson)',
+    )
+    parser.add_argument(
+        '--batch-max-docs',
+        type=int,
+        default=500,
+        help='Maximum documents per batch (default: 500)',
+    )
+    parser.add_argument(
+        '--batch-max-bytes',
+        type=int,
+        default=1024 * 1024,
+        help='Maximum encoded bytes per batch (default: 1048576)',
+    )
+    parser.add_argument(
+        '--batch-linger',
+        type=float,
+        default=1.0,
+        help='Maximum seconds a document waits in a batch before it is flushed (default: 1.0)',
+    )
+    parser.add_argument(
+        '--filter-file',
+        help='JSON or YAML file of per-module allow/deny rules and label drop/rename applied before shipping',
+    )
+    parser.add_argument(
+        '--delta',
+        action='store_true',
+        help='Only ship samples whose value changed since the previous scrape of their target',
+    )
+    parser.add_argument(
+        '--rates',
+        action='store_true',
+        help='Add the per-second rate of counter samples as prometheus.metric.rate',
+    )
+    parser.add_argument(
+        '--counter32',
+        nargs='*',
+        default=DEFAULT_COUNTER32_PATTERNS,
+        metavar='PATTERN',
+        help='Regular expressions for the names of 32 bit counters, whose drops are taken as wraps '
+        'rather than resets when computing rates (default: IF-MIB ifIn*/ifOut*)',
+    )
+    parser.add_argument(
+        '--keyframe-interval',
+        type=int,
+        default=10,
+        help='In delta mode, ship every sample on every Nth scrape of a target (default: 10)',
+    )
+    parser.add_argument(
+        '--max-series',
+        type=int,
+        default=1000000,
+        help='Maximum series whose last value is remembered (default: 1000000)',
+    )
+    parser.add_argument(
+        '--stale-scrapes',
+        type=int,
+        default=5,
+        help='Forget a series after this many scrapes of its target without it (default: 5)',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Shard targets by host across this many worker processes (default: 1)',
+    )
+    parser.add_argument(
+        '--state-dir',
+        help='Directory where delta and rate state is saved so that it survives restarts',
+    )
+    parser.add_argument(
+        '--state-interval',
+        type=float,
+        default=300,
+        help='Seconds between saves of the delta and rate state (default: 300)',
+    )
+    parser.add_argument(
+        '--serializer',
+        default='auto',
+        choices=['auto'] + sorted(SERIALIZERS),
+        help='JSON encoder for documents; auto picks msgspec or orjson when installed (default: auto)',
+    )
+    parser.add_argument(
+        '--spool-dir',
+        help='Directory for spooling documents while Logstash is unavailable (disabled by default)',
+    )
+    parser.add_argument(
+        '--spool-max-bytes',
+        type=int,
+        default=1024 * 1024 * 1024,
+        help='Maximum size of the spool before the oldest data is evicted (default: 1073741824)',
+    )
+    parser.add_argument(
+        '--spool-max-age',
+        type=float,
+        default=7 * 24 * 3600,
+        help='Maximum age in seconds of spooled data before it is evicted (default: 604800)',
+    )
+    parser.add_argument(
+        '--spool-replay-rate',
+        type=float,
+        default=5000,
+        help='Maximum documents per second replayed from the spool (default: 5000)',
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        help='Serve the forwarder\'s own metrics on /metrics at this port, plus one per worker with --workers (disabled by default)',
+    )
+    parser.add_argument(
+        '--metrics-address',
+        default='',
+        help='Address to bind the metrics endpoint to (default: all interfaces)',
+    )
+    parser.add_argument(
+        '--profile-cycles',
+        type=int,
+        default=0,
+        help='Log wall and CPU time per target and stage for the next N cycles (default: 0, disabled)',
+    )
+    parser.add_argument(
+        '--profile-pstats',
+        help='With --profile-cycles, write merged cProfile statistics to this file',
+    )
+    parser.add_argument(
+        '--profile-trace',
+        help='With --profile-cycles, write a Chrome trace (JSON) of the profiled cycles to this file',
+    )
     parser.add_argument(
         '--log-level',
         default='INFO',
@@ -234,11 +4002,130 @@ def create_parser() -> argparse.ArgumentParser:
     return parser
 
 
+def _positive_float(value: str) -> bool:
+    try:
+        return float(value) > 0
+    except ValueError:
+        return False
+
+
+def parse_module_intervals(values: list[str]) -> dict[str, float]:
+    intervals = {}
+    for value in values:
+        module, sep, seconds = value.partition('=')
+        if not sep or not module or not _positive_float(seconds):
+            raise ValueError(
+                f'module-interval must look like MODULE=SECONDS, got {value!r}',
+            )
+        intervals[module] = float(seconds)
+    return intervals
+
+
 def validate_args(args: argparse.Namespace) -> None:
     if args.interval < 1:
         raise ValueError('interval must be greater than 0')
     if args.timeout < 1:
         raise ValueError('timeout must be greater than 0')
+    if not 0 <= args.jitter <= 1:
+        raise ValueError('jitter must be between 0 and 1')
+    parse_module_intervals(args.module_interval)
+    for target in args.targets or []:
+        for part in target.split('&')[1:]:
+            key, _, value = part.partition('=')
+            if key == 'interval':
+                try:
+                    _parse_seconds(value)
+                except ValueError:
+                    raise ValueError(
+                        f'interval in target {target!r} must be a positive duration',
+                    )
+    if args.timeout_factor < 0:
+        raise ValueError('timeout-factor must not be negative')
+    if args.min_timeout <= 0:
+        raise ValueError('min-timeout must be greater than 0')
+    if args.breaker_failures < 0:
+        raise ValueError('breaker-failures must not be negative')
+    if args.breaker_backoff <= 0:
+        raise ValueError('breaker-backoff must be greater than 0')
+    if args.breaker_max_backoff < args.breaker_backoff:
+        raise ValueError(
+            'breaker-max-backoff must not be less than breaker-backoff',
+        )
+    if args.concurrency < 1:
+        raise ValueError('concurrency must be greater than 0')
+    if args.per_host_concurrency < 1:
+        raise ValueError('per-host-concurrency must be greater than 0')
+    if args.max_in_flight < 1:
+        raise ValueError('max-in-flight must be greater than 0')
+    if args.keyframe_interval < 1:
+        raise ValueError('keyframe-interval must be greater than 0')
+    if args.max_series < 1:
+        raise ValueError('max-series must be greater than 0')
+    if args.stale_scrapes < 1:
+        raise ValueError('stale-scrapes must be greater than 0')
+    if args.targets_reload_interval <= 0:
+        raise ValueError('targets-reload-interval must be greater than 0')
+    if args.targets_file:
+        try:
+            load_targets_file(args.targets_file)
+        except Exception as e:
+            raise ValueError(
+                f'invalid targets file {args.targets_file}: {str(e)}',
+            )
+    if args.filter_file:
+        try:
+            load_filter_file(args.filter_file)
+        except Exception as e:
+            raise ValueError(
+                f'invalid filter file {args.filter_file}: {str(e)}',
+            )
+    if args.workers < 1:
+        raise ValueError('workers must be greater than 0')
+    if args.state_interval <= 0:
+        raise ValueError('state-interval must be greater than 0')
+    if args.spool_max_bytes < 1:
+        raise ValueError('spool-max-bytes must be greater than 0')
+    if args.spool_max_age <= 0:
+        raise ValueError('spool-max-age must be greater than 0')
+    if args.spool_replay_rate <= 0:
+        raise ValueError('spool-replay-rate must be greater than 0')
+    if args.output == 'logstash' and not args.logstash_url:
+        raise ValueError('logstash-url is required with --output logstash')
+    if args.output == 'opensearch' and not args.opensearch_url:
+        raise ValueError('opensearch-url is required with --output opensearch')
+    if args.opensearch_max_retries < 0:
+        raise ValueError('opensearch-max-retries must not be negative')
+    if args.endpoint_eject_after < 1:
+        raise ValueError('endpoint-eject-after must be greater than 0')
+    if args.endpoint_eject_seconds < 0:
+        raise ValueError('endpoint-eject-seconds must not be negative')
+    if args.sender_concurrency < 1:
+        raise ValueError('sender-concurrency must be greater than 0')
+    if args.compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+    if args.compression_level is not None:
+        if args.compression == 'gzip' and not 0 <= args.compression_level <= 9:
+            raise ValueError(
+                'compression-level must be between 0 and 9 for gzip',
+            )
+        if args.compression == 'zstd' and not 1 <= args.compression_level <= 22:
+            raise ValueError(
+                'compression-level must be between 1 and 22 for zstd',
+            )
+    if args.batch_max_docs < 1:
+        raise ValueError('batch-max-docs must be greater than 0')
+    if args.batch_max_bytes < 1:
+        raise ValueError('batch-max-bytes must be greater than 0')
+    if args.batch_linger < 0:
+        raise ValueError('batch-linger must not be negative')
+    if args.profile_cycles < 0:
+        raise ValueError('profile-cycles must not be negative')
+    if (args.profile_pstats or args.profile_trace) and not args.profile_cycles:
+        raise ValueError(
+            'profile-pstats and profile-trace need profile-cycles',
+        )
+    if args.metrics_port is not None and not 0 < args.metrics_port < 65536:
+        raise ValueError('metrics-port must be between 1 and 65535')
 
 
 def signal_handler(signum: int, frame: Any) -> NoReturn:
@@ -261,14 +4148,66 @@ def main() -> None:
 
     config = {
         'prometheus_url': args.prometheus_url,
+        'output': args.output,
         'logstash_url': args.logstash_url,
-        'targets': args.targets,
+        'opensearch_url': args.opensearch_url,
+        'opensearch_data_stream': args.opensearch_data_stream,
+        'opensearch_username': args.opensearch_username,
+        'opensearch_password': os.environ.get('OPENSEARCH_PASSWORD'),
+        'opensearch_max_retries': args.opensearch_max_retries,
+        'endpoint_balance': args.endpoint_balance,
+        'endpoint_eject_after': args.endpoint_eject_after,
+        'endpoint_eject_seconds': args.endpoint_eject_seconds,
+        'compression': args.compression,
+        'compression_level': args.compression_level,
+        'sender_concurrency': args.sender_concurrency,
+        'targets': args.targets or [],
+        'targets_file': args.targets_file,
+        'targets_reload_interval': args.targets_reload_interval,
+        'workers': args.workers,
         'interval': args.interval,
+        'module_intervals': parse_module_intervals(args.module_interval),
+        'jitter': args.jitter,
         'timeout': args.timeout,
+        'timeout_factor': args.timeout_factor,
+        'min_timeout': args.min_timeout,
+        'breaker_failures': args.breaker_failures,
+        'breaker_backoff': args.breaker_backoff,
+        'breaker_max_backoff': args.breaker_max_backoff,
+        'concurrency': args.concurrency,
+        'per_host_concurrency': args.per_host_concurrency,
+        'max_in_flight': args.max_in_flight,
+        'send_mode': args.send_mode,
+        'batch_format': args.batch_format,
+        'batch_max_docs': args.batch_max_docs,
+        'batch_max_bytes': args.batch_max_bytes,
+        'batch_linger': args.batch_linger,
+        'serializer': args.serializer,
+        'filter_file': args.filter_file,
+        'delta': args.delta,
+        'rates': args.rates,
+        'counter32': args.counter32,
+        'keyframe_interval': args.keyframe_interval,
+        'max_series': args.max_series,
+        'stale_scrapes': args.stale_scrapes,
+        'state_dir': args.state_dir,
+        'state_interval': args.state_interval,
+        'spool_dir': args.spool_dir,
+        'spool_max_bytes': args.spool_max_bytes,
+        'spool_max_age': args.spool_max_age,
+        'spool_replay_rate': args.spool_replay_rate,
+        'metrics_port': args.metrics_port,
+        'metrics_address': args.metrics_address,
+        'profile_cycles': args.profile_cycles,
+        'profile_pstats': args.profile_pstats,
+        'profile_trace': args.profile_trace,
     }
 
-    forwarder = PrometheusToLogstash(config)
-    forwarder.run()
+    if args.workers > 1:
+        Supervisor(config, args.workers).run()
+    else:
+        forwarder = PrometheusToLogstash(config)
+        forwarder.run()
 
 
 if __name__ == '__main__':
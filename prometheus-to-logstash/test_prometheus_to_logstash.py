@@ -0,0 +1,705 @@
+from __future__ import annotations
+
+import importlib.util
+import json
+import math
+import os
+import random
+import re
+import shlex
+import sys
+import time
+
+import pytest
+from prometheus_client.parser import text_string_to_metric_families
+
+FORWARDER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'prometheus-to-logstash.py',
+)
+
+
+def _load_forwarder():
+    """Import prometheus-to-logstash.py, which is not importable by name."""
+    spec = importlib.util.spec_from_file_location(
+        'prometheus_to_logstash',
+        FORWARDER_PATH,
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['prometheus_to_logstash'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+forwarder = _load_forwarder()
+
+
+class Posts:
+    """Collects what a batcher posts instead of sending it."""
+
+    def __init__(self):
+        self.bodies = []
+
+    def __call__(self, body, content_type, count):
+        self.bodies.append((body, content_type, count))
+        return True
+
+
+def test_batcher_formats():
+    posts = Posts()
+    batcher = forwarder.LogstashBatcher(
+        posts,
+        forwarder.BATCH_FORMATS['ndjson'],
+    )
+    batcher.add(b'{"a":1}')
+    batcher.add(b'{"b":2}')
+    assert len(batcher) == 2
+    assert posts.bodies == []
+    batcher.flush()
+    assert posts.bodies == [
+        (b'{"a":1}\n{"b":2}\n', 'application/x-ndjson', 2),
+    ]
+    assert len(batcher) == 0
+
+    posts = Posts()
+    batcher = forwarder.LogstashBatcher(
+        posts,
+        forwarder.BATCH_FORMATS['json'],
+    )
+    batcher.add(b'1')
+    batcher.add(b'2')
+    batcher.flush()
+    assert posts.bodies == [(b'[1,2]', 'application/json', 2)]
+
+
+def test_batcher_flushes_at_limits():
+    posts = Posts()
+    batcher = forwarder.LogstashBatcher(
+        posts,
+        forwarder.BATCH_FORMATS['ndjson'],
+        max_docs=2,
+    )
+    for document in (b'1', b'2', b'3'):
+        batcher.add(document)
+    assert posts.bodies == [(b'1\n2\n', 'application/x-ndjson', 2)]
+    assert len(batcher) == 1
+
+    # A third document of 10 bytes would take the body past 25 bytes.
+    posts = Posts()
+    batcher = forwarder.LogstashBatcher(
+        posts,
+        forwarder.BATCH_FORMATS['ndjson'],
+        max_bytes=25,
+    )
+    for document in (b'a' * 10, b'b' * 10, b'c' * 10):
+        batcher.add(document)
+    assert [count for _, _, count in posts.bodies] == [2]
+    assert len(batcher) == 1
+
+
+def test_batcher_flushes_after_linger():
+    posts = Posts()
+    batcher = forwarder.LogstashBatcher(
+        posts,
+        forwarder.BATCH_FORMATS['ndjson'],
+        linger=0.0,
+    )
+    batcher.add(b'1')
+    assert posts.bodies == [(b'1\n', 'application/x-ndjson', 1)]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_scheduler_counts_missed_deadlines():
+    clock = FakeClock()
+    scheduler = forwarder.Scheduler({'a': 10.0}, jitter=0.0, clock=clock)
+    [entry] = scheduler.pop_due()
+    assert entry.next_due == 10.0
+
+    clock.now = 12.0
+    assert scheduler.pop_due() == [entry]
+    assert (entry.missed, entry.next_due) == (0, 20.0)
+
+    # 25s late: the deadlines at 20 and 30 are skipped, 40 is run once.
+    clock.now = 45.0
+    assert scheduler.pop_due() == [entry]
+    assert (entry.missed, entry.next_due) == (2, 50.0)
+    assert scheduler.pop_due() == []
+    assert scheduler.time_until_next() == 5.0
+
+
+def _replay(spool):
+    bodies = []
+    while True:
+        record = spool.peek()
+        if record is None:
+            return bodies
+        bodies.append(record.body)
+        spool.commit(record)
+
+
+def test_spool_replays_in_order(tmp_path):
+    spool = forwarder.DiskSpool(str(tmp_path))
+    for n in range(3):
+        spool.append(f'body {n}'.encode(), 'application/x-ndjson', n + 1)
+    record = spool.peek()
+    assert record.body == b'body 0'
+    assert record.content_type == 'application/x-ndjson'
+    assert record.count == 1
+    # peek() does not advance until the record is committed.
+    assert spool.peek() == record
+    assert _replay(spool) == [b'body 0', b'body 1', b'body 2']
+    assert spool.empty()
+    spool.close()
+
+
+def test_spool_truncates_torn_record(tmp_path):
+    spool = forwarder.DiskSpool(str(tmp_path))
+    spool.append(b'complete', 'application/json', 1)
+    spool.close()
+    segment = os.path.join(str(tmp_path), f'{0:020d}.seg')
+    complete = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(forwarder.DiskSpool._MAGIC + b'\x00' * 10)
+
+    spool = forwarder.DiskSpool(str(tmp_path))
+    assert os.path.getsize(segment) == complete
+    spool.append(b'after crash', 'application/json', 1)
+    assert _replay(spool) == [b'complete', b'after crash']
+    spool.close()
+
+
+def test_spool_resumes_from_cursor(tmp_path):
+    spool = forwarder.DiskSpool(str(tmp_path))
+    for n in range(3):
+        spool.append(f'body {n}'.encode(), 'application/json', 1)
+    spool.commit(spool.peek())
+    spool.close()
+
+    spool = forwarder.DiskSpool(str(tmp_path))
+    assert _replay(spool) == [b'body 1', b'body 2']
+    spool.close()
+
+
+def test_spool_evicts_oldest_segments(tmp_path):
+    spool = forwarder.DiskSpool(
+        str(tmp_path),
+        max_bytes=1000,
+        segment_bytes=250,
+    )
+    bodies = [b'x' * 100 + str(n).encode() for n in range(20)]
+    for body in bodies:
+        spool.append(body, 'application/json', 1)
+    assert spool.bytes <= spool.max_bytes
+    assert spool.evicted_bytes > 0
+    replayed = _replay(spool)
+    # Whatever survived is the newest records, still in order.
+    assert replayed == bodies[len(bodies) - len(replayed):]
+    spool.close()
+
+
+class FlakyOutput:
+    """Refuses every body until ``up`` is set."""
+
+    name = 'Logstash'
+
+    def __init__(self):
+        self.up = False
+        self.bodies = []
+
+    def send(self, payload, content_type, count):
+        if not self.up:
+            return forwarder.Delivery(
+                0,
+                pending=payload,
+                pending_count=count,
+                content_type=content_type,
+            )
+        self.bodies.append(payload)
+        return forwarder.Delivery(count)
+
+
+def test_live_batches_skip_the_spool_once_the_output_is_back(tmp_path):
+    p2l = forwarder.PrometheusToLogstash({
+        'prometheus_url': 'http://127.0.0.1:9116',
+        'logstash_url': 'http://127.0.0.1:8080',
+        'targets': [],
+        'timeout': 1,
+        'interval': 60,
+        'spool_dir': str(tmp_path),
+        # One backlog document a minute, so the drain outlasts the test.
+        'spool_replay_rate': 1 / 60,
+    })
+    p2l.output = output = FlakyOutput()
+    for n in range(3):
+        assert not p2l.post_to_logstash(f'old {n}'.encode(), 'text/plain', 1)
+    assert not p2l.logstash_available.is_set()
+
+    output.up = True
+    p2l.start_replayer()
+    assert p2l.logstash_available.wait(5)
+    assert p2l.post_to_logstash(b'live', 'text/plain', 1)
+    assert output.bodies == [b'old 0', b'live']
+    assert not p2l.spool.empty()
+    started = time.monotonic()
+    p2l.close()
+    assert time.monotonic() - started < 5
+
+
+def _changed(index, series, key, value, scrape):
+    changed, _ = index.update(series, key, value, scrape * 1000, scrape)
+    return changed
+
+
+FIXTURES = os.path.join(
+    os.path.dirname(FORWARDER_PATH),
+    'benchmarks',
+    'fixtures',
+)
+
+
+def _comparable(samples):
+    """(name, labels, value) samples with NaN made equal to itself."""
+    return [
+        (name, labels, 'NaN' if math.isnan(value) else value)
+        for name, labels, value in samples
+    ]
+
+
+def _split(data, split):
+    sizes = {
+        'whole': [len(data)],
+        '1-byte': [1] * len(data),
+        'random': [random.Random(0).randint(1, 64) for _ in data],
+    }[split]
+    chunks = []
+    position = 0
+    for size in sizes:
+        if position >= len(data):
+            break
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+@pytest.mark.parametrize('filename', sorted(os.listdir(FIXTURES)))
+@pytest.mark.parametrize('split', ('whole', '1-byte', 'random'))
+def test_parser_matches_prometheus_client(filename, split):
+    with open(os.path.join(FIXTURES, filename), 'rb') as f:
+        data = f.read()
+    expected = _comparable(
+        (sample.name, sample.labels, sample.value)
+        for family in text_string_to_metric_families(data.decode('utf-8'))
+        for sample in family.samples
+    )
+    chunks = _split(data, split)
+
+    parser = forwarder.ExpositionParser()
+    samples = []
+    for chunk in chunks:
+        samples.extend(parser.feed(chunk))
+    samples.extend(parser.close())
+    assert _comparable(samples) == expected
+
+    # The first columnar pass fills the series table, the second hits it.
+    table = forwarder.SeriesTable()
+    for _ in range(2):
+        parser = forwarder.ExpositionParser()
+        samples = []
+        for chunk in chunks + [None]:
+            batch = forwarder.SampleBatch(table, 0)
+            parser.parse_into(chunk, batch)
+            samples.extend(batch)
+        assert _comparable(samples) == expected
+
+
+def test_series_index_reports_changes():
+    index = forwarder.SeriesIndex()
+    scrape, series = index.begin_scrape('t')
+    key = ('ifInOctets', (('ifIndex', '1'),))
+    assert _changed(index, series, key, 1.0, scrape)
+    index.end_scrape('t')
+    scrape, series = index.begin_scrape('t')
+    assert not _changed(index, series, key, 1.0, scrape)
+    assert _changed(index, series, key, 2.0, scrape)
+    nan = float('nan')
+    assert _changed(index, series, key, nan, scrape)
+    assert not _changed(index, series, key, nan, scrape)
+
+
+def test_series_index_evicts_stale_series():
+    index = forwarder.SeriesIndex(stale_scrapes=2)
+    scrape, series = index.begin_scrape('t')
+    _changed(index, series, ('gone', ()), 1.0, scrape)
+    _changed(index, series, ('kept', ()), 1.0, scrape)
+    for _ in range(3):
+        scrape, series = index.begin_scrape('t')
+        _changed(index, series, ('kept', ()), 1.0, scrape)
+        index.end_scrape('t')
+    assert list(series) == [('kept', ())]
+    assert len(index) == 1
+    # A series that comes back after eviction is shipped again.
+    scrape, series = index.begin_scrape('t')
+    assert _changed(index, series, ('gone', ()), 1.0, scrape)
+
+
+def test_series_index_ships_untracked_series_when_full():
+    index = forwarder.SeriesIndex(max_series=1)
+    scrape, series = index.begin_scrape('t')
+    _changed(index, series, ('a', ()), 1.0, scrape)
+    _changed(index, series, ('b', ()), 1.0, scrape)
+    scrape, series = index.begin_scrape('t')
+    assert not _changed(index, series, ('a', ()), 1.0, scrape)
+    assert _changed(index, series, ('b', ()), 1.0, scrape)
+
+
+@pytest.mark.parametrize(
+    ('previous', 'value', 'elapsed', 'counter32', 'expected'),
+    (
+        (100, 160, 60, False, 1.0),
+        (100, 100, 10, True, 0.0),
+        # Going round the 32 bit range.
+        (2 ** 32 - 1000, 1000, 1, True, 2000.0),
+        # Dropping by more than half the range is a reset.
+        (2 ** 31, 10, 1, True, 10.0),
+        # 64 bit counters do not wrap, whatever their previous value.
+        (2 ** 32 - 1000, 1000, 1, False, 1000.0),
+        (2 ** 64 - 1000, 1000, 1, False, 1000.0),
+        (4.2e9, 1e8, 1, False, 1e8),
+        (100, 200, 0, False, None),
+    ),
+)
+def test_counter_rate(previous, value, elapsed, counter32, expected):
+    rate = forwarder.counter_rate(previous, value, elapsed, counter32)
+    assert rate == expected
+
+
+def test_series_index_rates_counters():
+    index = forwarder.SeriesIndex()
+    key = ('ifHCInOctets', (('ifIndex', '1'),))
+    scrape, series = index.begin_scrape('t')
+    assert index.update(series, key, 1000, 0, scrape, True) == (True, None)
+    scrape, series = index.begin_scrape('t')
+    assert index.update(series, key, 4000, 30000, scrape, True) == (True, 100)
+    # Gauges get no rate.
+    assert index.update(series, ('ifSpeed', ()), 1, 0, scrape) == (True, None)
+
+
+def test_profiler_does_not_wait_for_skipped_targets():
+    profiler = forwarder.CycleProfiler(2, ['a', 'b', 'c'])
+    profiler.finish(profiler.begin('a'))
+    profiler.skip('b')
+    assert profiler.completed == 0
+    profiler.skip('c')
+    assert profiler.completed == 1
+
+
+def test_profiler_ends_cycles_after_max_seconds():
+    profiler = forwarder.CycleProfiler(1, ['fast', 'hourly'], max_seconds=0.0)
+    profiler.finish(profiler.begin('fast'))
+    assert profiler.completed == 1
+    assert not profiler.active
+
+
+def test_profiler_charges_late_sender_work_to_no_cycle():
+    profiler = forwarder.CycleProfiler(2, ['a'], max_seconds=60.0)
+    sender = profiler.begin('sender')
+    profiler.finish(profiler.begin('a'))
+    # The cycle ended while the sender was still working on it.
+    profiler.finish(sender, scrape=False)
+    assert profiler.completed == 1
+
+
+def test_hash_ring_is_stable():
+    hosts = [f'10.0.{n // 256}.{n % 256}' for n in range(2000)]
+    ring = forwarder.HashRing(4)
+    assert [ring.shard(host) for host in hosts] == [
+        forwarder.HashRing(4).shard(host) for host in hosts
+    ]
+
+    grown = forwarder.HashRing(5)
+    moved = [host for host in hosts if ring.shard(host) != grown.shard(host)]
+    # Only the new shard takes hosts, about 1/5 of them.
+    assert {grown.shard(host) for host in moved} == {4}
+    assert 0.1 < len(moved) / len(hosts) < 0.3
+
+
+def test_supervisor_keeps_only_counters_of_dead_workers():
+    supervisor = forwarder.Supervisor({'targets': ['10.0.0.1']}, workers=2)
+    supervisor.current = {
+        0: {'metrics_sent': 10, 'breakers_open': 3, 'spool_bytes': 100},
+        1: {'metrics_sent': 5, 'breakers_open': 1, 'spool_bytes': 50},
+    }
+    supervisor.retire(0)
+    supervisor.current[0] = {
+        'metrics_sent': 2,
+        'breakers_open': 0,
+        'spool_bytes': 0,
+    }
+    stats = supervisor.stats()
+    assert stats['metrics_sent'] == 17
+    assert (stats['breakers_open'], stats['spool_bytes']) == (1, 50)
+
+
+class TargetsFile:
+    def __init__(self, path):
+        self.path = str(path)
+        self.version = 0
+
+    def write(self, groups):
+        with open(self.path, 'w') as f:
+            json.dump(groups, f)
+        # The forwarder notices changes by mtime, size and inode.
+        self.version += 1
+        mtime = self.version * 1_000_000_000
+        os.utime(self.path, ns=(mtime, mtime))
+
+
+def test_load_targets_file(tmp_path):
+    targets_file = TargetsFile(tmp_path / 'targets.json')
+    targets_file.write([
+        {
+            'targets': ['10.0.0.1'],
+            'labels': {'module': 'if_mib', 'interval': '5m', 'site': 'a'},
+        },
+        {
+            'targets': ['10.0.0.2'],
+            'labels': {'__param_auth': 'v3', '__meta_x': 'dropped'},
+        },
+    ])
+    assert forwarder.load_targets_file(targets_file.path) == {
+        '10.0.0.1&module=if_mib': forwarder.Target(
+            host='10.0.0.1',
+            module='if_mib',
+            interval=300.0,
+            labels=(('site', 'a'),),
+        ),
+        '10.0.0.2&auth=v3': forwarder.Target(host='10.0.0.2', auth='v3'),
+    }
+
+
+def test_reload_targets(tmp_path):
+    targets_file = TargetsFile(tmp_path / 'targets.json')
+    targets_file.write([
+        {
+            'targets': ['10.0.0.1', '10.0.0.2'],
+            'labels': {'module': 'if_mib', 'site': 'a'},
+        },
+    ])
+    p2l = forwarder.PrometheusToLogstash({
+        'prometheus_url': 'http://127.0.0.1:9116',
+        'logstash_url': 'http://127.0.0.1:8080',
+        'targets': [],
+        'targets_file': targets_file.path,
+        'timeout': 1,
+        'interval': 60,
+    })
+    collector = p2l.prometheus_collector
+    p2l.scheduler = forwarder.Scheduler(
+        {target: 60 for target in collector.targets},
+        jitter=0.0,
+    )
+    kept = '10.0.0.1&module=if_mib'
+    stats = collector.target_stats[kept] = forwarder.TargetStats()
+
+    targets_file.write([
+        {'targets': ['10.0.0.1'], 'labels': {'module': 'if_mib', 'site': 'a'}},
+        {
+            'targets': ['10.0.0.3'],
+            'labels': {'module': 'if_mib', 'interval': 30},
+        },
+    ])
+    p2l.reload_targets()
+    assert collector.targets == [kept, '10.0.0.3&module=if_mib']
+    assert sorted(p2l.scheduler.entries) == collector.targets
+    assert p2l.scheduler.entries['10.0.0.3&module=if_mib'].interval == 30
+    # Targets that did not change keep their state.
+    assert collector.target_stats[kept] is stats
+
+    targets_file.write([
+        {'targets': ['10.0.0.1'], 'labels': {'module': 'if_mib', 'site': 'b'}},
+    ])
+    p2l.reload_targets()
+    assert collector.targets == [kept]
+    assert collector.parse_target(kept).labels == (('site', 'b'),)
+    assert collector.target_stats[kept] is stats
+
+    # A broken file is ignored.
+    with open(targets_file.path, 'w') as f:
+        f.write('[{')
+    p2l.reload_targets()
+    assert collector.targets == [kept]
+    p2l.close()
+
+
+def test_scheduler_drops_removed_targets():
+    clock = FakeClock()
+    scheduler = forwarder.Scheduler(
+        {'a': 10.0, 'b': 10.0},
+        jitter=0.0,
+        clock=clock,
+    )
+    scheduler.remove('a')
+    assert [entry.target for entry in scheduler.pop_due()] == ['b']
+
+
+def test_scheduler_keeps_missed_deadlines_of_removed_targets():
+    clock = FakeClock()
+    scheduler = forwarder.Scheduler(
+        {'a': 10.0, 'b': 10.0},
+        jitter=0.0,
+        clock=clock,
+    )
+    scheduler.pop_due()
+    clock.now = 45.0
+    scheduler.pop_due()
+    assert scheduler.missed() == 6
+    scheduler.remove('a')
+    assert scheduler.missed() == 6
+
+
+def _service_arguments():
+    """Expand the unit's ExecStart with the .default file, as systemd would."""
+    directory = os.path.dirname(FORWARDER_PATH)
+    environment = {}
+    with open(os.path.join(directory, 'prometheus-to-logstash.default')) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                name, _, value = shlex.split(line)[0].partition('=')
+                environment[name] = value
+    with open(os.path.join(directory, 'prometheus-to-logstash.service')) as f:
+        unit = f.read().replace('\\\n', ' ')
+    [command] = re.findall(r'^ExecStart=(.*)$', unit, re.MULTILINE)
+    arguments = []
+    for word in command.split():
+        # $NAME is split at whitespace, ${NAME} is always one argument.
+        split = re.fullmatch(r'\$(\w+)', word)
+        if split:
+            arguments += environment[split.group(1)].split()
+        else:
+            arguments.append(
+                re.sub(r'\$\{(\w+)\}', lambda m: environment[m[1]], word),
+            )
+    # Drop the interpreter and the script path.
+    return arguments[2:]
+
+
+def test_service_command_line_parses():
+    args = forwarder.create_parser().parse_args(_service_arguments())
+    assert args.targets == ['192.168.1.1']
+    assert args.logstash_url == ['http://localhost:8080']
+    assert args.spool_dir == '/var/lib/prometheus-to-logstash/spool'
+
+
+def test_filter_rules():
+    rules = forwarder.FilterRules({
+        '*': {'deny': ['.*Discards']},
+        'if_mib': {
+            'allow': ['if(HC)?(In|Out)\\w+', 'sysUpTime'],
+            'match': {'ifType': ['6|161']},
+            'exclude': {'ifAdminStatus': ['2']},
+            'drop_labels': ['ifName'],
+            'rename_labels': {'ifDescr': 'interface'},
+        },
+    })
+    series_filter = rules.for_module('if_mib')
+    assert series_filter.keep_name('ifHCInOctets')
+    assert series_filter.keep_name('sysUpTime')
+    assert not series_filter.keep_name('ifInDiscards')
+    assert not series_filter.keep_name('ifMtu')
+
+    assert series_filter.keep_labels({'ifType': '6', 'ifAdminStatus': '1'})
+    assert not series_filter.keep_labels({'ifType': '24'})
+    assert not series_filter.keep_labels({'ifType': '6', 'ifAdminStatus': '2'})
+
+    labels = {'ifDescr': 'eth0', 'ifName': 'eth0', 'ifIndex': '1'}
+    projected = series_filter.project(labels)
+    assert projected == {'interface': 'eth0', 'ifIndex': '1'}
+
+
+def test_filter_rules_combine_modules():
+    rules = forwarder.FilterRules({
+        'if_mib': {'allow': ['ifInOctets']},
+        'system': {'allow': ['sysUpTime']},
+        'ip_mib': {'deny': ['ipForwarding']},
+    })
+    series_filter = rules.for_module('if_mib,system')
+    assert series_filter.keep_name('ifInOctets')
+    assert series_filter.keep_name('sysUpTime')
+    assert not series_filter.keep_name('ifMtu')
+    # A module without an allow list keeps everything its deny list allows.
+    series_filter = rules.for_module('if_mib,ip_mib')
+    assert series_filter.keep_name('ifMtu')
+    assert not series_filter.keep_name('ipForwarding')
+    assert rules.for_module('other') is None
+
+
+def test_filter_rules_are_checked_up_front():
+    with pytest.raises(ValueError, match='unknown keys'):
+        forwarder.FilterRules({'if_mib': {'alow': ['ifInOctets']}})
+    with pytest.raises(ValueError, match='invalid pattern'):
+        forwarder.FilterRules({'if_mib': {'deny': ['(']}})
+
+
+class BulkResponse:
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def json(self):
+        if all(status < 300 for status in self.statuses):
+            return {'errors': False}
+        items = []
+        for status in self.statuses:
+            item = {'status': status}
+            if status >= 300:
+                item['error'] = {'type': 'error', 'reason': str(status)}
+            items.append({'create': item})
+        return {'errors': True, 'items': items}
+
+
+def _opensearch(responses, max_retries=3):
+    output = forwarder.OpenSearchOutput(
+        ['http://127.0.0.1:9200'],
+        timeout=1.0,
+        metrics=None,
+        max_retries=max_retries,
+        backoff=0.0,
+    )
+    output.bodies = []
+
+    def post(payload, content_type, count, path=''):
+        output.bodies.append((payload, count))
+        return BulkResponse(responses.pop(0))
+
+    output._post = post
+    return output
+
+
+def _bulk(*documents):
+    fmt = forwarder.BULK_FORMAT
+    return fmt.start + fmt.separator.join(documents) + fmt.end
+
+
+def test_opensearch_retries_refused_documents():
+    # One indexed, one refused for lack of capacity, one for its mapping.
+    output = _opensearch([[201, 429, 400], [201]])
+    delivery = output.send(_bulk(b'0', b'1', b'2'), 'application/x-ndjson', 3)
+    assert delivery == forwarder.Delivery(sent=2, rejected=1)
+    assert output.bodies[1] == (_bulk(b'1'), 1)
+
+
+def test_opensearch_returns_what_it_could_not_send():
+    output = _opensearch([[201, 429], [503]], max_retries=1)
+    delivery = output.send(_bulk(b'0', b'1'), 'application/x-ndjson', 2)
+    assert delivery == forwarder.Delivery(
+        sent=1,
+        pending=_bulk(b'1'),
+        pending_count=1,
+        content_type='application/x-ndjson',
+    )
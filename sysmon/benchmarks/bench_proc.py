@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""CPU cost per tick of the psutil and /proc paths for the counter sections.
+
+Writes a synthetic procfs with ``--cpus`` cores, ``--disks`` block devices
+and ``--nics`` interfaces, points psutil at it through ``PROCFS_PATH`` and
+reads it with ProcCounters, then times the cpu, disk_io and network_io
+collectors of each path as the daemon calls them on every tick. The
+counters move between ticks so that the CPU percentages are computed
+rather than short-circuited. CPU frequencies are read from sysfs either
+way and are left out.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sysmon  # noqa: E402
+
+
+def write_procfs(root: str, cpus: int, disks: int, nics: int, tick: int) -> None:
+    """Counters as the kernel formats them, advanced by ``tick``."""
+    lines = [
+        f'cpu  {tick * cpus} 0 {tick * cpus} {tick * cpus * 8} 0 0 0 0 0 0',
+    ]
+    for cpu in range(cpus):
+        busy = tick * (cpu % 10)
+        lines.append(
+            f'cpu{cpu} {busy} {tick} {busy} {tick * 100 - 2 * busy} {tick} 0 {cpu} 0 0 0',
+        )
+    lines += [
+        'intr 1 ' + ' '.join(['0'] * 512),
+        'ctxt 1', 'btime 1700000000', 'processes 1',
+    ]
+    with open(os.path.join(root, 'stat'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    lines = []
+    for disk in range(disks):
+        counters = ' '.join(str(tick * (disk + field)) for field in range(17))
+        lines.append(f'{259:4d} {disk:7d} nvme{disk}n1 {counters}')
+    with open(os.path.join(root, 'diskstats'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    lines = [
+        'Inter-|   Receive                                                |  Transmit',
+        ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed',
+    ]
+    for nic in range(nics):
+        counters = ' '.join(
+            f'{tick * (nic + field):7d}' for field in range(16)
+        )
+        lines.append(f'{f"eth{nic}":>6s}: {counters}')
+    with open(os.path.join(root, 'net', 'dev'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def measure(collect, refresh, ticks: int) -> float:
+    """Best CPU seconds of one ``collect()`` over ``ticks`` ticks."""
+    best = float('inf')
+    for tick in range(ticks):
+        refresh(tick)
+        start = time.process_time()
+        collect()
+        best = min(best, time.process_time() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--cpus', type=int, default=128,
+        help='Cores in /proc/stat (default: 128)',
+    )
+    parser.add_argument(
+        '--disks', type=int, default=128,
+        help='Devices in /proc/diskstats (default: 128)',
+    )
+    parser.add_argument(
+        '--nics', type=int, default=16,
+        help='Interfaces in /proc/net/dev (default: 16)',
+    )
+    parser.add_argument(
+        '--ticks', type=int, default=200,
+        help='Ticks per collector, best is reported (default: 200)',
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, 'net'))
+        write_procfs(root, args.cpus, args.disks, args.nics, 1)
+        psutil.PROCFS_PATH = root
+        proc = sysmon.ProcCounters(root)
+        sysmon.sample_cpu_percent(0)
+
+        def refresh(tick):
+            write_procfs(root, args.cpus, args.disks, args.nics, tick + 2)
+
+        sections = [
+            ('cpu', lambda: sysmon.sample_cpu_percent(0), proc.cpu_percent),
+            ('disk_io', sysmon.get_disk_io_data, proc.disk_io),
+            ('network_io', sysmon.get_network_io_data, proc.network_io),
+        ]
+        # Both paths agree on the same counters before either is timed.
+        refresh(0)
+        slow_percent, _ = sysmon.sample_cpu_percent(0)
+        fast_percent, _ = proc.cpu_percent()
+        assert len(slow_percent) == len(fast_percent) == args.cpus
+        pairs = zip(slow_percent, fast_percent)
+        assert all(abs(slow - fast) <= 0.05 for slow, fast in pairs)
+        assert sysmon.get_disk_io_data() == proc.disk_io()
+        assert sysmon.get_network_io_data() == proc.network_io()
+
+        print(
+            f'{args.cpus} cores, {args.disks} disks, {args.nics} interfaces; best CPU time of one tick',
+        )
+        print(f"{'section':<11} {'psutil us':>10} {'/proc us':>10} {'speedup':>8}")
+        total_slow = total_fast = 0.0
+        for name, slow, fast in sections:
+            slow_time = measure(slow, refresh, args.ticks)
+            fast_time = measure(fast, refresh, args.ticks)
+            total_slow += slow_time
+            total_fast += fast_time
+            print(
+                f'{name:<11} {slow_time * 1e6:>10.0f} {fast_time * 1e6:>10.0f} {slow_time / fast_time:>7.1f}x',
+            )
+        print(f"{'total':<11} {total_slow * 1e6:>10.0f} {total_fast * 1e6:>10.0f} {total_slow / total_fast:>7.1f}x")
+        proc.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""CPU cost of CPUSampler per sample and as a share of a core at each rate.
+
+For each of ``--cpus`` core counts, writes a synthetic /proc/stat (see
+bench_proc), advances its counters between samples so that every sample
+computes utilization, and times ``CPUSampler.sample`` alone. The cost
+of a rate is that time multiplied by the samples per second. Then runs
+the sampler's own thread against the host's /proc for ``--seconds`` at
+each rate and reports the process CPU time it used, which includes the
+thread's wake-ups.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from bench_proc import write_procfs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sysmon  # noqa: E402
+
+RATES = [10, 20, 50, 100]
+
+
+def measure_sample(cpus: int, samples: int) -> float:
+    """Mean thread CPU seconds of one sample over a /proc/stat of ``cpus`` cores."""
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, 'net'))
+        write_procfs(root, cpus, 0, 0, 1)
+        sampler = sysmon.CPUSampler(
+            rate=RATES[-1], window=samples / RATES[-1], root=root,
+        )
+        spent = 0.0
+        for tick in range(samples):
+            write_procfs(root, cpus, 0, 0, tick + 2)
+            start = time.thread_time()
+            sampler.sample()
+            spent += time.thread_time() - start
+        sampler.close()
+    return spent / samples
+
+
+def measure_thread(rate: float, seconds: float) -> tuple[float, int]:
+    """Share of one core the sampling thread used on this host, and the samples it took."""
+    sampler = sysmon.CPUSampler(rate=rate, window=seconds)
+    start = time.process_time()
+    sampler.start()
+    time.sleep(seconds)
+    sampler.close()
+    return (time.process_time() - start) / seconds, sampler.report()['samples']
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--cpus', type=int, nargs='+',
+        default=[16, 64, 128, 256], help='Core counts to time',
+    )
+    parser.add_argument(
+        '--samples', type=int, default=500,
+        help='Samples timed per core count (default: 500)',
+    )
+    parser.add_argument(
+        '--seconds', type=float, default=5.0,
+        help='Seconds the thread runs per rate (default: 5)',
+    )
+    args = parser.parse_args()
+
+    print('synthetic /proc/stat: CPU per sample, and % of one core at each rate')
+    rates = ' '.join(f'{f"{rate} Hz":>7}' for rate in RATES)
+    print(f"{'cores':>5} {'us/sample':>10} {rates}")
+    for cpus in args.cpus:
+        cost = measure_sample(cpus, args.samples)
+        loads = ' '.join(f'{cost * rate * 100:>6.2f}%' for rate in RATES)
+        print(f'{cpus:>5} {cost * 1e6:>10.0f} {loads}')
+
+    print()
+    print(
+        f'this host, {os.cpu_count()} cores: sampling thread for {args.seconds:g}s',
+    )
+    print(f"{'rate':>7} {'samples':>8} {'% of a core':>12}")
+    for rate in RATES:
+        share, samples = measure_thread(rate, args.seconds)
+        print(f'{f"{rate} Hz":>7} {samples:>8} {share * 100:>11.2f}%')
+
+
+if __name__ == '__main__':
+    main()